@@ -0,0 +1,156 @@
+from fastapi import Request
+from pydantic import BaseModel
+from typing import List, Optional, Dict, Any
+from datetime import datetime
+import os
+import logging
+import hashlib
+import asyncio
+
+from core import api_router, db, require_admin, read_collection, observe_read, parse_object_id
+
+logger = logging.getLogger(__name__)
+
+
+# ============ Auditoria de operações admin ============
+# Write-behind: as rotas só enfileiram (put_nowait, sem await no caminho da resposta);
+# uma task grava em lote com insert_many em admin_audit (TTL). Fila cheia descarta e
+# conta em `dropped`; o shutdown drena o que restou.
+
+AUDIT_QUEUE_SIZE = int(os.environ.get('AUDIT_QUEUE_SIZE', '10000'))
+AUDIT_BATCH_SIZE = int(os.environ.get('AUDIT_BATCH_SIZE', '500'))
+AUDIT_FLUSH_SECONDS = float(os.environ.get('AUDIT_FLUSH_SECONDS', '1'))
+AUDIT_TTL_DAYS = int(os.environ.get('AUDIT_TTL_DAYS', '365'))
+
+
+def admin_actor(request: Request) -> str:
+    # Nome declarado pelo cliente admin, senão uma impressão digital da credencial
+    named = (request.headers.get('x-admin-actor') or '').strip()[:64]
+    auth = request.headers.get('authorization') or ''
+    return named or f"admin:{hashlib.sha256(auth.encode()).hexdigest()[:12]}"
+
+
+class AuditLog:
+    def __init__(self, queue_size: int, batch_size: int, flush_seconds: float):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self._held: Optional[Dict[str, Any]] = None  # já retirado da fila, ainda não gravado
+        self._task: Optional[asyncio.Task] = None
+
+    def record(self, action: str, actor: str, *, key: Optional[str] = None, keys: Optional[List[str]] = None,
+               email: Optional[str] = None, order_id: Optional[str] = None, count: Optional[int] = None, **details):
+        entry: Dict[str, Any] = {'at': datetime.utcnow(), 'action': action, 'actor': actor}
+        all_keys = ([key] if key else []) + (keys or [])
+        if all_keys:
+            entry['keys'] = all_keys
+        for name, value in (('email', email), ('order_id', order_id), ('count', count)):
+            if value is not None:
+                entry[name] = value
+        if details:
+            entry['details'] = details
+        try:
+            self.queue.put_nowait(entry)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def _write(self, batch: List[Dict[str, Any]]):
+        try:
+            await db.admin_audit.insert_many(batch, ordered=False)
+            self.written += len(batch)
+        except Exception:
+            self.failed += len(batch)
+            logger.exception('Falha ao gravar %d registros de auditoria', len(batch))
+
+    def _drain(self, first: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        batch = [first] if first else []
+        while len(batch) < self.batch_size and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        return batch
+
+    async def flush(self):
+        held, self._held = self._held, None
+        if held:
+            await self._write(self._drain(held))
+        while not self.queue.empty():
+            await self._write(self._drain())
+
+    async def _run(self):
+        while True:
+            self._held = await self.queue.get()
+            # Espera um pouco para juntar um lote, a não ser que já esteja cheio
+            if self.queue.qsize() < self.batch_size - 1:
+                await asyncio.sleep(self.flush_seconds)
+            first, self._held = self._held, None
+            await self._write(self._drain(first))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        return {'queue_depth': self.queue.qsize(), 'queue_size': self.queue.maxsize, 'written': self.written,
+                'dropped': self.dropped, 'failed': self.failed}
+
+
+audit_log = AuditLog(AUDIT_QUEUE_SIZE, AUDIT_BATCH_SIZE, AUDIT_FLUSH_SECONDS)
+
+
+class AuditEntry(BaseModel):
+    id: str
+    at: datetime
+    action: str
+    actor: str
+    keys: List[str] = []
+    email: Optional[str] = None
+    order_id: Optional[str] = None
+    count: Optional[int] = None
+    details: Dict[str, Any] = {}
+
+
+class AuditPage(BaseModel):
+    items: List[AuditEntry]
+    next_before: Optional[str] = None
+
+
+@api_router.get('/admin/audit', response_model=AuditPage)
+async def admin_audit_query(request: Request, actor: Optional[str] = None, key: Optional[str] = None,
+                            email: Optional[str] = None, action: Optional[str] = None,
+                            since: Optional[datetime] = None, until: Optional[datetime] = None,
+                            before: Optional[str] = None, limit: int = 100):
+    require_admin(request)
+    limit = max(1, min(limit, 1000))
+    filt: Dict[str, Any] = {}
+    if actor:
+        filt['actor'] = actor
+    if key:
+        filt['keys'] = key.strip()
+    if email:
+        filt['email'] = email.lower().strip()
+    if action:
+        filt['action'] = action
+    if since or until:
+        filt['at'] = {**({'$gte': since} if since else {}), **({'$lt': until} if until else {})}
+    if before:
+        # Paginação por _id (ObjectId cresce com o tempo de inserção), do mais novo ao mais antigo
+        filt['_id'] = {'$lt': parse_object_id(before)}
+    coll, route = read_collection('admin_audit')
+    with observe_read(route):
+        docs = await coll.find(filt).sort('_id', -1).limit(limit + 1).to_list(limit + 1)
+    items = [AuditEntry(id=str(d.pop('_id')), **d) for d in docs[:limit]]
+    return AuditPage(items=items, next_before=items[-1].id if len(docs) > limit else None)
+
+
+@api_router.get('/admin/audit/stats')
+async def admin_audit_stats(request: Request):
+    require_admin(request)
+    return audit_log.stats()
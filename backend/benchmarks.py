@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+"""
+Benchmarks do backend (rodar a partir de backend/):
+
+    python benchmarks.py compression [--corpus arquivo.jsonl] [--n 2000]
+    python benchmarks.py keys [--n 2000] [--concurrency 50] [--emails 200]
+    python benchmarks.py replica [--n 2000]
+    python benchmarks.py startup [--runs 5] [--port 8765]
+    python benchmarks.py keytable [--n 1000000] [--lookups 200000]
+
+`replica` espera MONGO_URL apontando para um replica set. Um local de três membros:
+
+    for p in 27017 27018 27019; do mkdir -p /tmp/rs$p; mongod --replSet rs0 --port $p --dbpath /tmp/rs$p --fork --logpath /tmp/rs$p.log; done
+    mongosh --port 27017 --eval 'rs.initiate({_id: "rs0", members: [{_id: 0, host: "localhost:27017"}, {_id: 1, host: "localhost:27018"}, {_id: 2, host: "localhost:27019"}]})'
+    MONGO_URL='mongodb://localhost:27017,localhost:27018,localhost:27019/?replicaSet=rs0' python benchmarks.py replica
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+import zlib
+from datetime import datetime, timedelta
+from typing import List
+
+import core
+from codec import COMPRESSION_LEVEL, TextCodec, train_zdict
+from core import db, read_routing_stats
+from key_table import KeyTable
+from keys import PremiumKey, ensure_premium_key_indexes, generate_human_keys, issue_premium_key, revoke_keys
+from validation import lookup_key_status
+
+
+def _synthetic_summaries(n: int) -> List[str]:
+    # Resumos no formato que os prompts pedem: lista numerada, subitens e expansões
+    rnd = random.Random(42)
+    vocab = ['resultados', 'metodologia', 'amostra', 'crescimento', 'inflação', 'mercado', 'governo', 'empresa',
+             'pesquisa', 'dados', 'análise', 'impacto', 'estudo', 'participantes', 'variação', 'trimestre',
+             'receita', 'custos', 'política', 'tecnologia', 'usuários', 'modelo', 'desempenho', 'risco']
+    out = []
+    for _ in range(n):
+        lines = []
+        for i in range(1, rnd.randint(3, 8) + 1):
+            topic = ' '.join(rnd.choices(vocab, k=rnd.randint(3, 6))).capitalize()
+            lines.append(f'{i}. {topic}: o estudo mostra que {" ".join(rnd.choices(vocab, k=12))} em {rnd.randint(2, 98)}%.')
+            for _ in range(rnd.randint(0, 3)):
+                lines.append(f'- {" ".join(rnd.choices(vocab, k=rnd.randint(4, 9)))}')
+        out.append('\n'.join(lines))
+    return out
+
+
+def _load_corpus(path: str) -> List[str]:
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line)['summary'] for line in f if line.strip()]
+
+
+def bench_compression(args):
+    corpus = _load_corpus(args.corpus) if args.corpus else _synthetic_summaries(args.n)
+    split = max(10, len(corpus) // 5)
+    train, test = corpus[:split], corpus[split:]
+    raw_bytes = sum(len(t.encode('utf-8')) for t in test)
+    plain = sum(len(zlib.compress(t.encode('utf-8'), COMPRESSION_LEVEL)) for t in test)
+
+    codec = TextCodec()
+    started = time.perf_counter()
+    zdict = train_zdict(train)
+    train_s = time.perf_counter() - started
+    codec.dicts[1] = zdict
+    codec.active_id = 1
+
+    started = time.perf_counter()
+    packed = [codec.pack(t) for t in test]
+    pack_s = time.perf_counter() - started
+    started = time.perf_counter()
+    for p in packed:
+        codec.unpack(p)
+    unpack_s = time.perf_counter() - started
+    stored = sum(len(p) if isinstance(p, bytes) else len(p.encode('utf-8')) for p in packed)
+
+    print(f'documentos:            {len(test)} (dicionário treinado com {len(train)}, {len(zdict)} bytes, {train_s:.2f}s)')
+    print(f'bytes crus:            {raw_bytes}')
+    print(f'zlib sem dicionário:   {plain} ({plain / raw_bytes:.1%})')
+    print(f'zlib com dicionário:   {stored} ({stored / raw_bytes:.1%}), economia {raw_bytes - stored} bytes')
+    print(f'escrita (pack):        {pack_s / len(test) * 1e6:.1f} µs/doc')
+    print(f'leitura (unpack):      {unpack_s / len(test) * 1e6:.1f} µs/doc')
+
+
+def _percentile(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+async def _legacy_create_key(email: str, days: int):
+    # Fluxo antigo de admin_create_key: find_one + laço de unicidade + insert_one
+    now = datetime.utcnow()
+    existing = await db.premium_keys.find_one({'email': email, 'status': 'active'})
+    if existing and existing.get('expires_at') and now < existing['expires_at']:
+        return existing['key'], existing['expires_at']
+    for _ in range(10):
+        key_val = generate_human_keys(1)[0]
+        if not await db.premium_keys.find_one({'key': key_val}):
+            break
+    expires_at = now + timedelta(days=days)
+    pk = PremiumKey(key=key_val, email=email, expires_at=expires_at)
+    await db.premium_keys.insert_one(pk.model_dump())
+    return key_val, expires_at
+
+
+async def _bench_key_creation(args):
+    from motor.motor_asyncio import AsyncIOMotorClient
+    from pymongo import monitoring
+
+    class Counter(monitoring.CommandListener):
+        commands = 0
+
+        def started(self, event):
+            if event.command_name in ('find', 'insert', 'update', 'findAndModify'):
+                Counter.commands += 1
+
+        def succeeded(self, event):
+            pass
+
+        def failed(self, event):
+            pass
+
+    bench_client = AsyncIOMotorClient(os.environ['MONGO_URL'], event_listeners=[Counter()])
+    db_name = f"bench_keys_{int(time.time())}"
+    core._mongo.update(client=bench_client, db=bench_client[db_name])
+    rnd = random.Random(7)
+    emails = [f'bench{rnd.randrange(args.emails)}@example.com' for _ in range(args.n)]
+    try:
+        for label, create in (('antigo (find+ensure+insert)', _legacy_create_key), ('atômico (findOneAndUpdate)', issue_premium_key)):
+            await db.premium_keys.drop()
+            if create is issue_premium_key:
+                await ensure_premium_key_indexes()
+            sem = asyncio.Semaphore(args.concurrency)
+            latencies: List[float] = []
+
+            async def one(email):
+                async with sem:
+                    started = time.perf_counter()
+                    await create(email, 30)
+                    latencies.append(time.perf_counter() - started)
+
+            Counter.commands = 0
+            started = time.perf_counter()
+            await asyncio.gather(*(one(e) for e in emails))
+            total = time.perf_counter() - started
+            dupes = [d async for d in db.premium_keys.aggregate([
+                {'$match': {'status': 'active'}}, {'$group': {'_id': '$email', 'n': {'$sum': 1}}}, {'$match': {'n': {'$gt': 1}}}])]
+            print(f'{label}:')
+            print(f'  round trips/criação:  {Counter.commands / len(emails):.2f}')
+            print(f'  p50 / p99:            {_percentile(latencies, 0.5) * 1000:.1f} / {_percentile(latencies, 0.99) * 1000:.1f} ms')
+            print(f'  vazão:                {len(emails) / total:.0f} criações/s')
+            print(f'  e-mails com 2+ ativas: {len(dupes)}')
+    finally:
+        await bench_client.drop_database(db_name)
+        bench_client.close()
+
+
+def bench_keys(args):
+    asyncio.run(_bench_key_creation(args))
+
+
+async def _bench_replica(args):
+    from collections import Counter as Tally
+    from motor.motor_asyncio import AsyncIOMotorClient
+    from pymongo import WriteConcern, monitoring
+
+    served = Tally()
+
+    class Listener(monitoring.CommandListener):
+        def started(self, event):
+            if event.command_name in ('find', 'aggregate', 'getMore'):
+                served[event.connection_id] += 1
+
+        def succeeded(self, event):
+            pass
+
+        def failed(self, event):
+            pass
+
+    bench_client = AsyncIOMotorClient(os.environ['MONGO_URL'], event_listeners=[Listener()])
+    hello = await bench_client.admin.command('hello')
+    if not hello.get('setName'):
+        raise SystemExit('MONGO_URL não aponta para um replica set')
+    primary = hello['primary']
+    db_name = f"bench_replica_{int(time.time())}"
+    core._mongo.update(client=bench_client, db=bench_client[db_name])
+    core._secondary_collections.clear()
+    try:
+        await ensure_premium_key_indexes()
+        keys = generate_human_keys(args.n)
+        now = datetime.utcnow()
+        # w=majority: as KEYs já estão nos secundários quando as leituras começam
+        await db.premium_keys.with_options(write_concern=WriteConcern('majority')).insert_many(
+            [{'key': k, 'email': f'r{i}@example.com', 'status': 'active', 'expires_at': now + timedelta(days=30)}
+             for i, k in enumerate(keys)])
+
+        def report(label):
+            total = sum(served.values())
+            on_primary = sum(n for (host, port), n in served.items() if f'{host}:{port}' == primary)
+            print(f'{label}: {total} leituras, {on_primary} no primário, {total - on_primary} em secundários')
+            served.clear()
+
+        served.clear()
+        for k in random.sample(keys, min(len(keys), 500)):
+            await lookup_key_status(k)
+        report('validate (secondaryPreferred)')
+
+        # Read-your-writes: KEY recém-criada é validada no primário e já aparece ativa
+        fresh_ok = 0
+        for i in range(50):
+            key, _ = await issue_premium_key(f'fresh{i}@example.com', 30)
+            fresh_ok += (await lookup_key_status(key)).valid
+        report('validate logo após criar')
+        print(f'  válidas imediatamente: {fresh_ok}/50')
+
+        await revoke_keys(email='r0@example.com')
+        for k in random.sample(keys, min(len(keys), 100)):
+            await lookup_key_status(k)
+        report('validate logo após revogação ampla (*)')
+        print(json.dumps(read_routing_stats, indent=2))
+    finally:
+        await bench_client.drop_database(db_name)
+        bench_client.close()
+
+
+def bench_replica(args):
+    asyncio.run(_bench_replica(args))
+
+
+def _free_port() -> int:
+    import socket
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def bench_startup(args):
+    # Cada medida num processo novo, como um worker recém-criado
+    import statistics
+    import subprocess
+    import sys
+    import urllib.request
+    here = os.path.dirname(os.path.abspath(__file__))
+    probe = 'import time; t = time.perf_counter(); import server; print(time.perf_counter() - t)'
+    imports = []
+    for _ in range(args.runs):
+        out = subprocess.run([sys.executable, '-c', probe], cwd=here, capture_output=True, text=True, check=True)
+        imports.append(float(out.stdout.strip().splitlines()[-1]))
+    print(f'import server:           mediana {statistics.median(imports) * 1000:.0f} ms (min {min(imports) * 1000:.0f}, max {max(imports) * 1000:.0f})')
+
+    firsts = []
+    for _ in range(args.runs):
+        port = args.port or _free_port()
+        started = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'server:app', '--port', str(port), '--log-level', 'warning'], cwd=here)
+        try:
+            while True:
+                if proc.poll() is not None:
+                    raise SystemExit('uvicorn saiu antes de responder (MONGO_URL acessível?)')
+                try:
+                    with urllib.request.urlopen(f'http://127.0.0.1:{port}/api/', timeout=1) as resp:
+                        if resp.status == 200:
+                            break
+                except OSError:
+                    time.sleep(0.01)
+            firsts.append(time.perf_counter() - started)
+        finally:
+            proc.terminate()
+            proc.wait()
+    print(f'até o primeiro request:  mediana {statistics.median(firsts) * 1000:.0f} ms (min {min(firsts) * 1000:.0f}, max {max(firsts) * 1000:.0f})')
+
+
+def bench_keytable(args):
+    # Memória por milhão de KEYs: tabela compacta (arrays numpy) vs dict de PremiumKey
+    import gc
+    import tempfile
+    import tracemalloc
+    from datetime import datetime, timedelta
+    import numpy as np
+    rnd = random.Random(42)
+    now = datetime.utcnow()
+    keys = generate_human_keys(args.n)
+    table = KeyTable(tempfile.mkdtemp(prefix='key_table_'))
+    table._install(*table._arrays([k.encode('ascii') for k in keys],
+                                  [rnd.choice((0, 0, 0, 1, 2)) for _ in keys],
+                                  [int(time.time()) + rnd.randint(0, 400 * 86400) for _ in keys]), {})
+    per_key = (table.keys.nbytes + table.status.nbytes + table.expires.nbytes) / args.n
+    print(f'tabela compacta:   {per_key:.1f} bytes/KEY, {per_key * 1e6 / 2 ** 20:.1f} MB por milhão')
+
+    sample = min(args.n, 100000)
+    gc.collect()
+    tracemalloc.start()
+    resident = {k: PremiumKey(key=k, email=f'user{i}@example.com', status='active',
+                                     expires_at=now + timedelta(days=30)) for i, k in enumerate(keys[:sample])}
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'dict[PremiumKey]:  {used / sample:.0f} bytes/KEY, {used / sample * 1e6 / 2 ** 20:.0f} MB por milhão (amostra de {sample})')
+    del resident
+
+    table._save(table._meta())
+    mapped = KeyTable(table.dir)
+    started = time.perf_counter()
+    mapped._load()
+    print(f'carga por mmap:    {(time.perf_counter() - started) * 1000:.1f} ms para {args.n} KEYs')
+    probes = [rnd.choice(keys) for _ in range(args.lookups)]
+    latencies = []
+    for k in probes:
+        t = time.perf_counter()
+        mapped.get(k)
+        latencies.append(time.perf_counter() - t)
+    print(f'lookup:            p50 {_percentile(latencies, 0.5) * 1e6:.1f} us, p99 {_percentile(latencies, 0.99) * 1e6:.1f} us ({args.lookups} consultas)')
+    assert np.all(mapped.keys[:-1] <= mapped.keys[1:])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('compression', help='taxa e custo de CPU da compressão de textos armazenados')
+    p.add_argument('--corpus', help='JSONL com um campo "summary" por linha (padrão: corpus sintético)')
+    p.add_argument('--n', type=int, default=2000)
+    p.set_defaults(func=bench_compression)
+    p = sub.add_parser('keys', help='round trips e p99 da criação de KEY sob carga concorrente (usa MONGO_URL, banco temporário)')
+    p.add_argument('--n', type=int, default=2000, help='criações')
+    p.add_argument('--concurrency', type=int, default=50)
+    p.add_argument('--emails', type=int, default=200, help='e-mails distintos (repetições exercitam a reutilização)')
+    p.set_defaults(func=bench_keys)
+    p = sub.add_parser('replica', help='confere o roteamento de leituras contra um replica set (MONGO_URL)')
+    p.add_argument('--n', type=int, default=2000, help='KEYs de teste')
+    p.set_defaults(func=bench_replica)
+    p = sub.add_parser('startup', help='tempo de import e até o primeiro request de um worker novo (uvicorn)')
+    p.add_argument('--runs', type=int, default=5)
+    p.add_argument('--port', type=int, default=0, help='padrão: porta livre a cada execução')
+    p.set_defaults(func=bench_startup)
+    p = sub.add_parser('keytable', help='memória e latência da tabela residente de KEYs (sem Mongo)')
+    p.add_argument('--n', type=int, default=1000000, help='KEYs sintéticas')
+    p.add_argument('--lookups', type=int, default=200000)
+    p.set_defaults(func=bench_keytable)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+from fastapi import Request, HTTPException
+from pydantic import BaseModel, Field
+from bson import Binary
+from typing import List, Optional, Dict, Any
+from collections import Counter
+from datetime import datetime
+import os
+import asyncio
+import time
+import zlib
+
+from core import api_router, db, require_admin
+
+
+# ============ Compressão dos textos armazenados ============
+# Resumos e trechos de texto grandes vão para o Mongo comprimidos com zlib (deflate
+# cru) e um dicionário compartilhado treinado nos nossos próprios resumos, que têm
+# muita estrutura repetida ("1. ...: ...", "- ", "EXPANSÕES:"). O formato é
+# b'Z1' + id do dicionário (4 bytes) + deflate; strings antigas continuam legíveis.
+
+COMPRESSION_ENABLED = os.environ.get('COMPRESSION_ENABLED', '1') == '1'
+COMPRESSION_MIN_BYTES = int(os.environ.get('COMPRESSION_MIN_BYTES', '256'))
+COMPRESSION_LEVEL = int(os.environ.get('COMPRESSION_LEVEL', '6'))
+COMPRESSION_DICT_BYTES = 32 * 1024  # janela máxima do deflate
+
+_PACK_MAGIC = b'Z1'
+
+
+class UnknownDictionaryError(KeyError):
+    pass
+
+
+def train_zdict(samples: List[str], size: int = COMPRESSION_DICT_BYTES) -> bytes:
+    # Dicionário zlib = substrings frequentes; as mais úteis ficam no fim (distâncias menores)
+    counts: Counter = Counter()
+    for text in samples:
+        words = text.split(' ')
+        for n in (1, 2, 3, 4):
+            for i in range(len(words) - n + 1):
+                gram = ' '.join(words[i:i + n])
+                if 4 <= len(gram) <= 64:
+                    counts[gram] += 1
+    scored = sorted(((c * len(g.encode()), g) for g, c in counts.items() if c > 1), reverse=True)
+    chosen: List[bytes] = []
+    used = 0
+    for _, gram in scored:
+        b = (gram + ' ').encode('utf-8')
+        if used + len(b) > size:
+            continue
+        chosen.append(b)
+        used += len(b)
+        if used >= size - 4:
+            break
+    return b''.join(reversed(chosen))
+
+
+class TextCodec:
+    def __init__(self):
+        self.dicts: Dict[int, bytes] = {0: b''}
+        self.active_id = 0
+        self.stats = {'packed': 0, 'raw_bytes': 0, 'stored_bytes': 0, 'pack_seconds': 0.0,
+                      'unpacked': 0, 'unpack_seconds': 0.0}
+
+    def pack(self, text: Optional[str]):
+        if not text or not COMPRESSION_ENABLED:
+            return text
+        raw = text.encode('utf-8')
+        if len(raw) < COMPRESSION_MIN_BYTES:
+            return text
+        started = time.perf_counter()
+        zdict = self.dicts[self.active_id]
+        c = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -15, zdict=zdict) if zdict else zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -15)
+        data = c.compress(raw) + c.flush()
+        self.stats['pack_seconds'] += time.perf_counter() - started
+        if len(data) + 6 >= len(raw):
+            return text
+        self.stats['packed'] += 1
+        self.stats['raw_bytes'] += len(raw)
+        self.stats['stored_bytes'] += len(data) + 6
+        return Binary(_PACK_MAGIC + self.active_id.to_bytes(4, 'big') + data)
+
+    def unpack(self, value):
+        if not isinstance(value, bytes) or value[:2] != _PACK_MAGIC:
+            return value
+        dict_id = int.from_bytes(value[2:6], 'big')
+        if dict_id not in self.dicts:
+            raise UnknownDictionaryError(dict_id)
+        started = time.perf_counter()
+        zdict = self.dicts[dict_id]
+        d = zlib.decompressobj(-15, zdict=zdict) if zdict else zlib.decompressobj(-15)
+        out = (d.decompress(bytes(value[6:])) + d.flush()).decode('utf-8')
+        self.stats['unpack_seconds'] += time.perf_counter() - started
+        self.stats['unpacked'] += 1
+        return out
+
+    async def prepare(self, docs: List[Dict[str, Any]]):
+        # Garante que os dicionários usados nesses documentos estão carregados (outro worker pode ter treinado um novo)
+        for doc in docs:
+            for v in doc.values():
+                if isinstance(v, bytes) and v[:2] == _PACK_MAGIC and int.from_bytes(v[2:6], 'big') not in self.dicts:
+                    await self.load()
+                    return
+
+    async def inflate(self, value):
+        try:
+            return self.unpack(value)
+        except UnknownDictionaryError:
+            await self.load()
+            return self.unpack(value)
+
+    async def load(self):
+        async for doc in db.compression_dicts.find({}).sort('_id', 1):
+            self.dicts[doc['_id']] = bytes(doc['data'])
+            if doc.get('active'):
+                self.active_id = doc['_id']
+
+    async def train(self, samples: List[str]) -> Dict[str, Any]:
+        zdict = await asyncio.to_thread(train_zdict, samples)
+        last = await db.compression_dicts.find_one({}, sort=[('_id', -1)])
+        new_id = (last['_id'] if last else 0) + 1
+        await db.compression_dicts.insert_one({'_id': new_id, 'data': Binary(zdict), 'samples': len(samples),
+                                               'active': True, 'created_at': datetime.utcnow()})
+        await db.compression_dicts.update_many({'_id': {'$ne': new_id}}, {'$set': {'active': False}})
+        self.dicts[new_id] = zdict
+        self.active_id = new_id
+        return {'dict_id': new_id, 'dict_bytes': len(zdict), 'samples': len(samples)}
+
+    def report(self) -> Dict[str, Any]:
+        st = self.stats
+        return {
+            'active_dict_id': self.active_id,
+            'dicts_loaded': len(self.dicts) - 1,
+            'packed': st['packed'],
+            'raw_bytes': st['raw_bytes'],
+            'stored_bytes': st['stored_bytes'],
+            'bytes_saved': st['raw_bytes'] - st['stored_bytes'],
+            'pack_us_avg': round(st['pack_seconds'] / st['packed'] * 1e6, 1) if st['packed'] else None,
+            'unpack_us_avg': round(st['unpack_seconds'] / st['unpacked'] * 1e6, 1) if st['unpacked'] else None,
+        }
+
+
+text_codec = TextCodec()
+
+
+class CompressionTrainRequest(BaseModel):
+    sample_size: int = Field(default=2000, ge=10, le=50000)
+
+
+@api_router.post('/admin/compression/train')
+async def admin_compression_train(request: Request, body: CompressionTrainRequest):
+    require_admin(request)
+    samples: List[str] = []
+    async for doc in db.summary_history.aggregate([{'$sample': {'size': body.sample_size}}, {'$project': {'summary': 1}}]):
+        text = await text_codec.inflate(doc.get('summary'))
+        if text:
+            samples.append(text)
+    if len(samples) < 10:
+        raise HTTPException(status_code=400, detail='Histórico insuficiente para treinar o dicionário')
+    return await text_codec.train(samples)
+
+
+@api_router.get('/admin/compression/stats')
+async def admin_compression_stats(request: Request):
+    require_admin(request)
+    return text_codec.report()
@@ -0,0 +1,187 @@
+from fastapi import Request
+from typing import List, Optional, Dict
+from urllib.parse import urlsplit
+import os
+import re
+import threading
+
+from core import api_router, require_admin
+from text_utils import SENTENCE_RE, estimate_tokens
+
+
+# ============ Compactação da entrada ============
+# O innerText da página chega com menus, banners de cookies e parágrafos repetidos.
+# Antes de resumir: remove quase-duplicatas, descarta linhas estruturais (menus,
+# rodapés) vistas em muitos sites diferentes e ajusta ao orçamento de tokens do nível.
+# Frases nunca contam como boilerplate: só linhas curtas que não são frases.
+
+COMPACTION_BUDGETS = {
+    'short': int(os.environ.get('COMPACTION_BUDGET_SHORT', '8000')),
+    'medium': int(os.environ.get('COMPACTION_BUDGET_MEDIUM', '12000')),
+    'long': int(os.environ.get('COMPACTION_BUDGET_LONG', '24000')),
+    'profundo': int(os.environ.get('COMPACTION_BUDGET_PROFUNDO', '60000')),
+}
+BOILERPLATE_MIN_ORIGINS = int(os.environ.get('BOILERPLATE_MIN_ORIGINS', '5'))
+BOILERPLATE_MAX_CHARS = 120
+BOILERPLATE_MAX_WORDS = 6  # acima disso, só conta se não terminar como frase
+BOILERPLATE_MAX_ENTRIES = int(os.environ.get('BOILERPLATE_MAX_ENTRIES', '200000'))
+NEAR_DUP_PARAGRAPH_JACCARD = float(os.environ.get('NEAR_DUP_PARAGRAPH_JACCARD', '0.8'))
+LOW_INFORMATION_SCORE = 6.0
+
+_NORMALIZE_RE = re.compile(r'[\W\d_]+', re.UNICODE)
+
+compaction_totals = {'requests': 0, 'tokens_in': 0, 'tokens_out': 0}
+
+
+class BoilerplateModel:
+    # Em quantos sites (origens) distintos cada linha estrutural normalizada apareceu.
+    # Contar origens, e não textos, impede que visitas repetidas à mesma página (com
+    # comentários ou horários mudando) transformem o próprio artigo em boilerplate.
+    def __init__(self, min_origins: int, max_entries: int):
+        self.min_origins = min_origins
+        self.max_entries = max_entries
+        self.origins: Dict[int, set] = {}  # hash da linha -> hashes das origens (até min_origins)
+        self._lock = threading.Lock()
+
+    def observe(self, origin: str, unit_hashes: set):
+        origin_hash = hash(origin)
+        with self._lock:
+            for h in unit_hashes:
+                seen = self.origins.setdefault(h, set())
+                if len(seen) < self.min_origins:
+                    seen.add(origin_hash)
+            if len(self.origins) > self.max_entries:
+                # Esquece as linhas vistas num site só; se não bastar, fica só o boilerplate
+                self.origins = {h: s for h, s in self.origins.items() if len(s) > 1}
+                if len(self.origins) > self.max_entries // 2:
+                    self.origins = {h: s for h, s in self.origins.items() if len(s) >= self.min_origins}
+
+    def is_boilerplate(self, h: int) -> bool:
+        return len(self.origins.get(h, ())) >= self.min_origins
+
+
+boilerplate_model = BoilerplateModel(BOILERPLATE_MIN_ORIGINS, BOILERPLATE_MAX_ENTRIES)
+
+
+def _origin(url: Optional[str]) -> Optional[str]:
+    try:
+        parts = urlsplit(url or '')
+    except ValueError:
+        return None
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        return None
+    return f'{parts.scheme}://{parts.hostname}'
+
+
+def _split_units(text: str) -> tuple:
+    # Páginas web chegam com o espaço colapsado numa linha só: aí a unidade é a frase
+    lines = [l.strip() for l in text.splitlines()]
+    lines = [l for l in lines if l]
+    if len(lines) >= 3:
+        return lines, '\n'
+    return [u.strip() for u in SENTENCE_RE.split(text) if u.strip()], ' '
+
+
+def _is_structural(unit: str) -> bool:
+    # Itens de menu, rodapé, rótulos: linhas curtas que não são uma frase completa
+    if len(unit) > BOILERPLATE_MAX_CHARS:
+        return False
+    return len(unit.split()) <= BOILERPLATE_MAX_WORDS or unit[-1] not in '.!?…'
+
+
+def _unit_score(unit: str) -> float:
+    words = unit.split()
+    if not words:
+        return 0.0
+    return len(set(w.lower() for w in words)) * min(1.0, len(words) / 8)
+
+
+def compact_input(text: str, detail_level: str, url: Optional[str] = None) -> tuple:
+    units, sep = _split_units(text)
+    norms = [_NORMALIZE_RE.sub(' ', u.lower()).strip() for u in units]
+    hashes = [hash(n) for n in norms]
+    # Texto numa linha só vira frases: aí não há linhas estruturais para aprender
+    structural = [sep == '\n' and _is_structural(u) for u in units]
+    origin = _origin(url)
+    if origin:
+        boilerplate_model.observe(origin, {h for h, s in zip(hashes, structural) if s})
+    kept: List[int] = []
+    seen_exact: set = set()
+    shingle_index: Dict[int, List[int]] = {}
+    shingle_sets: Dict[int, set] = {}
+    removed_dupes = removed_boilerplate = 0
+    for i, (unit, norm, h) in enumerate(zip(units, norms, hashes)):
+        if not norm:
+            continue
+        if structural[i] and boilerplate_model.is_boilerplate(h):
+            removed_boilerplate += 1
+            continue
+        if h in seen_exact:
+            removed_dupes += 1
+            continue
+        seen_exact.add(h)
+        words = norm.split()
+        if len(words) >= 8:
+            shingles = {hash(tuple(words[j:j + 3])) for j in range(len(words) - 2)}
+            counts: Dict[int, int] = {}
+            for sh in shingles:
+                for other in shingle_index.get(sh, ()):
+                    counts[other] = counts.get(other, 0) + 1
+            dup = False
+            for other, inter in counts.items():
+                union = len(shingles) + len(shingle_sets[other]) - inter
+                if inter / union >= NEAR_DUP_PARAGRAPH_JACCARD:
+                    dup = True
+                    break
+            if dup:
+                removed_dupes += 1
+                continue
+            shingle_sets[i] = shingles
+            for sh in shingles:
+                shingle_index.setdefault(sh, []).append(i)
+        kept.append(i)
+    # Ainda acima do orçamento: descarta fragmentos pouco informativos, mantendo a ordem.
+    # Conteúdo substancial nunca é cortado aqui; o que sobrar vai para o map-reduce.
+    budget = COMPACTION_BUDGETS.get(detail_level.lower(), COMPACTION_BUDGETS['medium'])
+    total = sum(estimate_tokens(units[i]) for i in kept)
+    trimmed = 0
+    if total > budget:
+        drop = set()
+        for i in sorted(kept, key=lambda i: _unit_score(units[i])):
+            if total <= budget or _unit_score(units[i]) >= LOW_INFORMATION_SCORE:
+                break
+            drop.add(i)
+            total -= estimate_tokens(units[i])
+            trimmed += 1
+        kept = [i for i in kept if i not in drop]
+    out = sep.join(units[i] for i in kept)
+    reverted = len(out) < 50
+    if reverted:
+        # Não sobrou conteúdo útil: resume o original e o relatório diz isso
+        out = text
+        removed_dupes = removed_boilerplate = trimmed = 0
+    tokens_in = estimate_tokens(text)
+    tokens_out = estimate_tokens(out)
+    compaction_totals['requests'] += 1
+    compaction_totals['tokens_in'] += tokens_in
+    compaction_totals['tokens_out'] += tokens_out
+    return out, {
+        'tokens_in': tokens_in,
+        'tokens_out': tokens_out,
+        'tokens_saved': tokens_in - tokens_out,
+        'removed_duplicates': removed_dupes,
+        'removed_boilerplate': removed_boilerplate,
+        'trimmed_units': trimmed,
+        'reverted': int(reverted),
+        'budget': budget,
+    }
+
+
+@api_router.get('/admin/compaction/stats')
+async def admin_compaction_stats(request: Request):
+    require_admin(request)
+    return {
+        **compaction_totals,
+        'tokens_saved': compaction_totals['tokens_in'] - compaction_totals['tokens_out'],
+        'boilerplate_lines_tracked': len(boilerplate_model.origins),
+    }
@@ -0,0 +1,189 @@
+from fastapi import APIRouter, Request, HTTPException
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.read_preferences import SecondaryPreferred
+from bson import ObjectId
+from bson.errors import InvalidId
+from pydantic import BaseModel
+from typing import List, Optional, Dict, Any
+from pathlib import Path
+import os
+import logging
+import hashlib
+import contextlib
+import time
+
+
+ROOT_DIR = Path(__file__).parent
+# Fica no import: os limites do módulo (os.environ.get abaixo) dependem do .env
+load_dotenv(ROOT_DIR / '.env')
+
+logger = logging.getLogger(__name__)
+
+
+class AppSettings(BaseModel):
+    mongo_url: Optional[str] = None
+    db_name: Optional[str] = None
+    cors_origins: List[str] = ['*']
+    log_level: str = 'INFO'
+
+    @classmethod
+    def from_env(cls) -> 'AppSettings':
+        return cls(mongo_url=os.environ.get('MONGO_URL'), db_name=os.environ.get('DB_NAME'),
+                   cors_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
+                   log_level=os.environ.get('LOG_LEVEL', 'INFO'))
+
+
+settings = AppSettings.from_env()
+
+# MongoDB connection: criada no primeiro uso, então importar o módulo (ferramentas,
+# testes, benchmarks) não exige MONGO_URL nem abre conexões
+_mongo: Dict[str, Any] = {}
+
+
+def get_client():
+    if 'client' not in _mongo:
+        if not settings.mongo_url:
+            raise RuntimeError('MONGO_URL não configurada')
+        _mongo['client'] = AsyncIOMotorClient(settings.mongo_url)
+    return _mongo['client']
+
+
+def get_db():
+    if 'db' not in _mongo:
+        if not settings.db_name:
+            raise RuntimeError('DB_NAME não configurado')
+        _mongo['db'] = get_client()[settings.db_name]
+    return _mongo['db']
+
+
+class _LazyMongo:
+    def __init__(self, resolve):
+        self._resolve = resolve
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __getitem__(self, name):
+        return self._resolve()[name]
+
+
+client = _LazyMongo(get_client)
+db = _LazyMongo(get_db)
+
+
+def use_settings(app_settings: AppSettings):
+    global settings
+    settings = app_settings
+    _mongo.clear()
+    _secondary_collections.clear()
+
+
+def close_client():
+    if 'client' in _mongo:
+        _mongo.pop('client').close()
+        _mongo.pop('db', None)
+
+# Create a router with the /api prefix
+api_router = APIRouter(prefix="/api")
+
+
+# Utility functions
+
+
+def constant_time_equals(a: str, b: str) -> bool:
+    return hashlib.sha256(a.encode()).digest() == hashlib.sha256(b.encode()).digest()
+
+
+def sha256_hex(s: str) -> str:
+    return hashlib.sha256(s.encode('utf-8')).hexdigest()
+
+
+def parse_object_id(value: str):
+    try:
+        return ObjectId(value)
+    except (InvalidId, TypeError):
+        raise HTTPException(status_code=400, detail='after inválido')
+
+
+# ============ Admin APIs ============
+
+def _get_admin_key() -> Optional[str]:
+    return os.environ.get('ADMIN_KEY')
+
+
+def require_admin(request: Request):
+    auth = request.headers.get('authorization') or request.headers.get('Authorization')
+    if not auth or not auth.lower().startswith('bearer '):
+        raise HTTPException(status_code=401, detail='Unauthorized')
+    provided = auth.split(' ', 1)[1].strip()
+    configured = _get_admin_key()
+    if not configured:
+        raise HTTPException(status_code=500, detail='ADMIN_KEY not configured')
+    if not constant_time_equals(provided, configured):
+        raise HTTPException(status_code=401, detail='Unauthorized')
+
+
+# ============ Roteamento de leituras ============
+# Validações e listagens/exportações leem com secondaryPreferred (staleness limitada);
+# mutações e leituras dentro do mesmo fluxo seguem no primário (db.<coleção> padrão).
+# Read-your-writes entre requisições: após uma escrita, leituras com a mesma tag vão ao
+# primário durante READ_YOUR_WRITES_SECONDS ('*' = todas as leituras roteadas).
+
+MONGO_SECONDARY_READS = os.environ.get('MONGO_SECONDARY_READS', '1') == '1'
+MONGO_MAX_STALENESS_SECONDS = int(os.environ.get('MONGO_MAX_STALENESS_SECONDS', '90'))  # mínimo aceito pelo driver: 90
+READ_YOUR_WRITES_SECONDS = float(os.environ.get('READ_YOUR_WRITES_SECONDS', str(MONGO_MAX_STALENESS_SECONDS)))
+
+_secondary_collections: Dict[str, Any] = {}
+_recent_writes: Dict[str, float] = {}  # tag -> válido até (monotonic)
+read_routing_stats: Dict[str, Dict[str, float]] = {}
+
+
+def note_write(*tags: str):
+    until = time.monotonic() + READ_YOUR_WRITES_SECONDS
+    for tag in tags:
+        _recent_writes[tag] = until
+    if len(_recent_writes) > 10000:
+        now = time.monotonic()
+        for tag in [t for t, u in _recent_writes.items() if u <= now]:
+            _recent_writes.pop(tag, None)
+
+
+def recently_written(tag: Optional[str] = None) -> bool:
+    now = time.monotonic()
+    return _recent_writes.get('*', 0) > now or (tag is not None and _recent_writes.get(tag, 0) > now)
+
+
+def read_collection(name: str, tag: Optional[str] = None):
+    if not MONGO_SECONDARY_READS or recently_written(tag):
+        return db[name], 'primary'
+    coll = _secondary_collections.get(name)
+    if coll is None:
+        coll = db[name].with_options(read_preference=SecondaryPreferred(max_staleness=MONGO_MAX_STALENESS_SECONDS))
+        _secondary_collections[name] = coll
+    return coll, 'secondaryPreferred'
+
+
+@contextlib.contextmanager
+def observe_read(route: str):
+    st = read_routing_stats.setdefault(route, {'reads': 0, 'errors': 0, 'seconds': 0.0})
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        st['errors'] += 1
+        raise
+    finally:
+        st['reads'] += 1
+        st['seconds'] += time.perf_counter() - started
+
+
+@api_router.get('/admin/db/reads')
+async def admin_read_routing_stats(request: Request):
+    require_admin(request)
+    return {
+        'secondary_reads': MONGO_SECONDARY_READS,
+        'max_staleness_seconds': MONGO_MAX_STALENESS_SECONDS,
+        'routes': {route: {**st, 'avg_ms': round(st['seconds'] / st['reads'] * 1000, 2) if st['reads'] else None}
+                   for route, st in read_routing_stats.items()},
+    }
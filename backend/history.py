@@ -0,0 +1,368 @@
+from fastapi import Request, HTTPException
+from pydantic import BaseModel, Field
+from pymongo import ReturnDocument
+from bson import ObjectId
+from typing import List, Optional, Dict, Any
+from datetime import datetime, timedelta, timezone
+import os
+import hashlib
+import asyncio
+import sqlite3
+import threading
+import logging
+
+from core import ROOT_DIR, api_router, client, db, note_write, read_collection, observe_read
+from codec import text_codec
+from text_utils import WORD_RE
+
+logger = logging.getLogger(__name__)
+
+# ============ Histórico de resumos ============
+# Substitui o array summaryHistory (reescrito inteiro e cortado em 50 a cada resumo).
+# Cada dono (device ou KEY) tem um contador de sequência; o cursor é esse número,
+# então a sincronização busca só o que veio depois do último cursor do cliente.
+# O append reserva as seqs ($inc) antes de gravar os itens: com appends concorrentes
+# uma seq menor pode aparecer depois de uma maior, então o cursor para no primeiro
+# buraco recente em vez de pular por cima dele.
+
+HISTORY_MAX_PAGE = 200
+HISTORY_GAP_GRACE_SECONDS = int(os.environ.get('HISTORY_GAP_GRACE_SECONDS', '30'))
+
+
+class HistoryItemIn(BaseModel):
+    title: str = 'Página sem título'
+    url: str = 'URL desconhecida'
+    favicon: Optional[str] = None
+    is_pdf: bool = False
+    source: str = 'web'
+    persona: str = ''
+    original_text: str = ''
+    summary: str
+    timestamp: datetime = Field(default_factory=datetime.utcnow)
+    word_count: int = 0
+
+class HistoryItem(HistoryItemIn):
+    id: str
+    seq: int
+
+class HistoryAppendRequest(BaseModel):
+    device_id: Optional[str] = None
+    key: Optional[str] = None
+    items: List[HistoryItemIn] = Field(min_length=1, max_length=100)
+
+class HistoryPage(BaseModel):
+    items: List[HistoryItem]
+    next_cursor: int
+    has_more: bool
+    reset: bool = False
+
+
+def _history_owner(device_id: Optional[str], key: Optional[str]) -> str:
+    key = (key or '').strip()
+    if key:
+        return 'key:' + hashlib.sha256(key.encode()).hexdigest()
+    device_id = (device_id or '').strip()
+    if device_id:
+        return 'device:' + device_id
+    raise HTTPException(status_code=400, detail='Informe device_id ou key')
+
+
+_HISTORY_TEXT_FIELDS = ('summary', 'original_text')
+
+
+def _history_item(doc: Dict[str, Any]) -> HistoryItem:
+    # Descompacta aqui, só os campos que de fato vão na resposta
+    fields = {k: v for k, v in doc.items() if k in HistoryItem.model_fields and k != 'id'}
+    for k in _HISTORY_TEXT_FIELDS:
+        fields[k] = text_codec.unpack(fields.get(k)) or ''
+    return HistoryItem(id=str(doc['_id']), **fields)
+
+
+def _contiguous_prefix(start: int, docs: List[Dict[str, Any]]) -> tuple:
+    # docs em ordem crescente de seq. Um buraco antes de um item gravado há pouco é
+    # uma seq reservada que ainda não foi gravada; se o item depois do buraco já é
+    # antigo, o append daquela seq falhou e o buraco é permanente.
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=HISTORY_GAP_GRACE_SECONDS)
+    last = start
+    for i, d in enumerate(docs):
+        if d['seq'] != last + 1 and d['_id'].generation_time > cutoff:
+            return last, docs[:i]
+        last = d['seq']
+    return last, docs
+
+
+@api_router.post('/history', response_model=HistoryPage)
+async def history_append(req: HistoryAppendRequest):
+    owner = _history_owner(req.device_id, req.key)
+    n = len(req.items)
+    counter = await db.history_counters.find_one_and_update(
+        {'_id': owner}, {'$inc': {'seq': n}}, upsert=True, return_document=ReturnDocument.AFTER)
+    first = counter['seq'] - n + 1
+    docs = []
+    for i, item in enumerate(req.items):
+        doc = item.model_dump()
+        doc['original_text'] = doc['original_text'][:500] + ('...' if len(doc['original_text']) > 500 else '')
+        doc.update({'owner': owner, 'seq': first + i})
+        docs.append(doc)
+    stored = [{**d, **{k: text_codec.pack(d[k]) for k in _HISTORY_TEXT_FIELDS}} for d in docs]
+    await db.summary_history.insert_many(stored)
+    for d, st in zip(docs, stored):
+        d['_id'] = st['_id']
+    await asyncio.to_thread(history_search_index.add, docs)
+    note_write(f'history:{owner}')
+    return HistoryPage(items=[_history_item(d) for d in docs], next_cursor=counter['seq'], has_more=False)
+
+
+@api_router.get('/history', response_model=HistoryPage)
+async def history_list(request: Request, device_id: Optional[str] = None, cursor: int = 0,
+                       before: Optional[int] = None, limit: int = 50, include_text: bool = True):
+    # key vai no header para não aparecer em logs de URL
+    owner = _history_owner(device_id, request.headers.get('x-premium-key'))
+    limit = max(1, min(limit, HISTORY_MAX_PAGE))
+    # Listagens enxutas nem trazem (nem descompactam) os textos grandes
+    projection = None if include_text else {k: 0 for k in _HISTORY_TEXT_FIELDS}
+    counters, route = read_collection('history_counters', f'history:{owner}')
+    items_coll, _ = read_collection('summary_history', f'history:{owner}')
+    # Sessão causal: a leitura dos itens vê pelo menos o que a leitura do contador viu,
+    # mesmo que cada uma caia num secundário diferente
+    async with await client.start_session(causal_consistency=True) as session:
+        with observe_read(route):
+            counter = await counters.find_one({'_id': owner}, session=session) or {}
+        cleared = counter.get('cleared_seq', 0)
+        if before is not None:
+            # Paginação para trás (mais recentes primeiro), para a carga inicial
+            filt = {'owner': owner, 'seq': {'$lt': before, '$gt': cleared}}
+            with observe_read(route):
+                docs = await items_coll.find(filt, projection, session=session).sort('seq', -1).limit(limit + 1).to_list(limit + 1)
+            has_more = len(docs) > limit
+            docs = docs[:limit]
+            # O cursor para sincronizar daqui em diante não passa de um buraco recente
+            ascending = docs[::-1]
+            start = ascending[0]['seq'] - 1 if has_more else cleared
+            next_cursor, _ = _contiguous_prefix(start, ascending)
+            await text_codec.prepare(docs)
+            return HistoryPage(items=[_history_item(d) for d in docs], next_cursor=next_cursor, has_more=has_more)
+        reset = cursor < cleared
+        start = max(cursor, cleared)
+        filt = {'owner': owner, 'seq': {'$gt': start}}
+        with observe_read(route):
+            docs = await items_coll.find(filt, projection, session=session).sort('seq', 1).limit(limit + 1).to_list(limit + 1)
+    has_more = len(docs) > limit
+    next_cursor, visible = _contiguous_prefix(start, docs[:limit])
+    if len(visible) < len(docs[:limit]):
+        has_more = False  # o resto aparece quando o append pendente gravar
+    docs = visible
+    await text_codec.prepare(docs)
+    return HistoryPage(items=[_history_item(d) for d in docs], next_cursor=next_cursor, has_more=has_more, reset=reset)
+
+
+@api_router.delete('/history')
+async def history_clear(request: Request, device_id: Optional[str] = None):
+    owner = _history_owner(device_id, request.headers.get('x-premium-key'))
+    counter = await db.history_counters.find_one({'_id': owner})
+    if not counter:
+        return {'cleared': 0}
+    # Marca o ponto de corte (O(1)); clientes com cursor anterior recebem reset=true
+    await db.history_counters.update_one({'_id': owner}, {'$set': {'cleared_seq': counter['seq']}})
+    result = await db.summary_history.delete_many({'owner': owner, 'seq': {'$lte': counter['seq']}})
+    note_write(f'history:{owner}')
+    await asyncio.to_thread(history_search_index.remove_owner, owner, counter['seq'])
+    return {'cleared': result.deleted_count}
+
+# ============ Busca textual no histórico ============
+# Índice SQLite FTS5 ao lado do Mongo: ranking bm25, prefixos ("resum*") e filtro
+# de período como o filterTime de history.js, sem varrer o histórico inteiro.
+# O sidecar é local de cada host: appends feitos por outro worker/host entram pela
+# sincronização periódica, que guarda por dono a última seq indexada (history_sync)
+# e busca no Mongo só o que veio depois dela.
+
+HISTORY_FTS_PATH = os.environ.get('HISTORY_FTS_PATH', str(ROOT_DIR / 'history_fts.sqlite3'))
+HISTORY_FTS_SYNC_SECONDS = float(os.environ.get('HISTORY_FTS_SYNC_SECONDS', '60'))
+
+
+class HistorySearchHit(BaseModel):
+    item: HistoryItem
+    snippet: str
+    rank: float
+
+class HistorySearchPage(BaseModel):
+    results: List[HistorySearchHit]
+    page: int
+    limit: int
+    has_more: bool
+
+
+def _owner_tag(owner: str) -> str:
+    # Um único token alfanumérico, para filtrar o dono dentro do próprio MATCH
+    return 'o' + hashlib.sha1(owner.encode()).hexdigest()[:24]
+
+
+def _fts_query(q: str) -> Optional[str]:
+    terms = WORD_RE.findall(q.lower())
+    if not terms:
+        return None
+    return '{title summary url} : (' + ' '.join(f'"{t}"*' for t in terms[:16]) + ')'
+
+
+class HistorySearchIndex:
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS history_meta (rowid INTEGER PRIMARY KEY, hist_id TEXT UNIQUE, owner_tag TEXT, ts INTEGER)')
+            conn.execute('CREATE INDEX IF NOT EXISTS history_meta_owner_ts ON history_meta (owner_tag, ts)')
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5("
+                         "owner_tag, title, summary, url, tokenize='unicode61 remove_diacritics 2', prefix='2 3')")
+            conn.execute('CREATE TABLE IF NOT EXISTS history_sync (owner_tag TEXT PRIMARY KEY, seq INTEGER, cleared INTEGER)')
+            self._conn = conn
+        return self._conn
+
+    def add(self, docs: List[Dict[str, Any]], marks: Optional[Dict[str, int]] = None):
+        # marks: dono -> seq até a qual tudo já está indexado. Sem ele, a marca só avança
+        # pelos itens contíguos a ela (append local); o que vier depois de um buraco é
+        # indexado mas volta a ser buscado pela sincronização, sem duplicar (hist_id único)
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                seqs: Dict[str, List[int]] = {}
+                for d in docs:
+                    tag = _owner_tag(d['owner'])
+                    cur = conn.execute('INSERT OR IGNORE INTO history_meta (hist_id, owner_tag, ts) VALUES (?, ?, ?)',
+                                       (str(d['_id']), tag, int(d['timestamp'].timestamp())))
+                    if cur.rowcount:
+                        conn.execute('INSERT INTO history_fts (rowid, owner_tag, title, summary, url) VALUES (?, ?, ?, ?, ?)',
+                                     (cur.lastrowid, tag, d.get('title') or '', d.get('summary') or '', d.get('url') or ''))
+                    if 'seq' in d:
+                        seqs.setdefault(d['owner'], []).append(d['seq'])
+                for owner, owner_seqs in seqs.items():
+                    tag = _owner_tag(owner)
+                    row = conn.execute('SELECT seq, cleared FROM history_sync WHERE owner_tag = ?', (tag,)).fetchone()
+                    mark, cleared = row or (0, 0)
+                    if marks and owner in marks:
+                        mark = max(mark, marks[owner])
+                    else:
+                        for seq in sorted(owner_seqs):
+                            if seq == mark + 1:
+                                mark = seq
+                    conn.execute('INSERT OR REPLACE INTO history_sync (owner_tag, seq, cleared) VALUES (?, ?, ?)', (tag, mark, cleared))
+
+    def remove_owner(self, owner: str, cleared_seq: int = 0):
+        # Tudo até cleared_seq foi apagado no Mongo: a marca recomeça dali
+        tag = _owner_tag(owner)
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute('DELETE FROM history_fts WHERE rowid IN (SELECT rowid FROM history_meta WHERE owner_tag = ?)', (tag,))
+                conn.execute('DELETE FROM history_meta WHERE owner_tag = ?', (tag,))
+                conn.execute('INSERT OR REPLACE INTO history_sync (owner_tag, seq, cleared) VALUES (?, ?, ?)',
+                             (tag, cleared_seq, cleared_seq))
+
+    def sync_marks(self) -> Dict[str, tuple]:
+        with self._lock:
+            return {tag: (seq, cleared) for tag, seq, cleared in
+                    self._connect().execute('SELECT owner_tag, seq, cleared FROM history_sync').fetchall()}
+
+    def count(self) -> int:
+        with self._lock:
+            return self._connect().execute('SELECT COUNT(*) FROM history_meta').fetchone()[0]
+
+    def search(self, owner: str, q: str, since: Optional[datetime], sort: str, limit: int, offset: int) -> List[tuple]:
+        match = _fts_query(q)
+        if not match:
+            return []
+        tag = _owner_tag(owner)
+        order = {'newest': 'm.ts DESC', 'oldest': 'm.ts ASC'}.get(sort, 'rank')
+        sql = ("SELECT m.hist_id, snippet(history_fts, 2, '[', ']', '…', 16), bm25(history_fts, 0, 5.0, 1.0, 0.5) AS rank "
+               'FROM history_fts JOIN history_meta m ON m.rowid = history_fts.rowid '
+               'WHERE history_fts MATCH ? AND m.ts >= ? '
+               f'ORDER BY {order} LIMIT ? OFFSET ?')
+        since_ts = int(since.timestamp()) if since else 0
+        with self._lock:
+            return self._connect().execute(sql, (f'owner_tag:{tag} AND ({match})', since_ts, limit, offset)).fetchall()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+history_search_index = HistorySearchIndex(HISTORY_FTS_PATH)
+
+
+def _time_filter_cutoff(time_filter: str, tz_offset_minutes: int) -> Optional[datetime]:
+    # Mesmos períodos de filterTime em history.js, no fuso do navegador
+    now_local = datetime.utcnow() - timedelta(minutes=tz_offset_minutes)
+    if time_filter == 'today':
+        cutoff_local = now_local.replace(hour=0, minute=0, second=0, microsecond=0)
+    elif time_filter == 'week':
+        cutoff_local = now_local - timedelta(days=7)
+    elif time_filter == 'month':
+        cutoff_local = now_local - timedelta(days=30)
+    else:
+        return None
+    return cutoff_local + timedelta(minutes=tz_offset_minutes)
+
+
+async def sync_history_search_index():
+    # Por dono, compara o contador do Mongo com a marca local e indexa só as seqs novas
+    # (sidecar novo ou apagado: marca 0, reindexa tudo). Um clear feito em outro host
+    # aparece como cleared_seq acima da marca e limpa o dono aqui também.
+    marks = await asyncio.to_thread(history_search_index.sync_marks)
+    async for counter in db.history_counters.find({}, {'seq': 1, 'cleared_seq': 1}):
+        owner = counter['_id']
+        mark, cleared = marks.get(_owner_tag(owner), (0, 0))
+        if counter.get('cleared_seq', 0) > cleared:
+            mark = cleared = counter['cleared_seq']
+            await asyncio.to_thread(history_search_index.remove_owner, owner, cleared)
+        if counter.get('seq', 0) <= mark:
+            continue
+        while True:
+            docs = await db.summary_history.find(
+                {'owner': owner, 'seq': {'$gt': mark}},
+                {'owner': 1, 'seq': 1, 'title': 1, 'summary': 1, 'url': 1, 'timestamp': 1}).sort('seq', 1).limit(1000).to_list(1000)
+            if not docs:
+                break
+            await text_codec.prepare(docs)
+            for doc in docs:
+                doc['summary'] = text_codec.unpack(doc.get('summary'))
+            # A marca não passa de um buraco recente (append concorrente ainda gravando)
+            reached, _ = _contiguous_prefix(mark, docs)
+            await asyncio.to_thread(history_search_index.add, docs, {owner: reached})
+            if reached == mark or len(docs) < 1000:
+                break
+            mark = reached
+
+
+async def run_history_search_sync():
+    while True:
+        try:
+            await sync_history_search_index()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception('Falha ao sincronizar o índice de busca do histórico')
+        await asyncio.sleep(HISTORY_FTS_SYNC_SECONDS)
+
+
+@api_router.get('/history/search', response_model=HistorySearchPage)
+async def history_search(request: Request, q: str, device_id: Optional[str] = None, time: str = 'all',
+                         tz_offset_minutes: int = 0, sort: str = 'rank', page: int = 1, limit: int = 20):
+    owner = _history_owner(device_id, request.headers.get('x-premium-key'))
+    limit = max(1, min(limit, 100))
+    page = max(1, page)
+    since = _time_filter_cutoff(time, tz_offset_minutes)
+    rows = await asyncio.to_thread(history_search_index.search, owner, q, since, sort, limit + 1, (page - 1) * limit)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    docs = await db.summary_history.find({'_id': {'$in': [ObjectId(r[0]) for r in rows]}, 'owner': owner}).to_list(len(rows))
+    await text_codec.prepare(docs)
+    by_id = {str(d['_id']): d for d in docs}
+    results = [HistorySearchHit(item=_history_item(by_id[r[0]]), snippet=r[1], rank=r[2]) for r in rows if r[0] in by_id]
+    return HistorySearchPage(results=results, page=page, limit=limit, has_more=has_more)
@@ -0,0 +1,315 @@
+from fastapi import Request, HTTPException
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field, EmailStr, ValidationError
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from typing import List, Optional, Dict, Any
+from datetime import datetime
+import os
+import uuid
+import json
+import codecs
+import csv
+import io
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
+
+from core import api_router, db, require_admin, note_write, read_collection, observe_read, parse_object_id
+from audit import audit_log, admin_actor
+from plan_stats import plan_stats
+from validation import invalidate_key_caches
+
+
+# ============ Exportação de premium_keys ============
+# Dump em streaming para conciliação com o meio de pagamento. Cursor projetado,
+# ordenado por _id e lido em lotes; cada lote só é buscado depois que o anterior foi
+# enviado (back-pressure do StreamingResponse). Retoma a partir do último _id (after=).
+
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', '1000'))
+EXPORT_FIELDS = ['key', 'email', 'status', 'product_code', 'order_id', 'created_at', 'updated_at', 'expires_at']
+
+
+def _export_value(v):
+    if isinstance(v, datetime):
+        return v.isoformat()
+    return v
+
+
+@api_router.get('/admin/keys/export')
+async def admin_export_keys(request: Request, format: str = 'ndjson', status: Optional[str] = None,
+                            since: Optional[datetime] = None, after: Optional[str] = None):
+    require_admin(request)
+    if format not in ('ndjson', 'csv'):
+        raise HTTPException(status_code=400, detail='format deve ser ndjson ou csv')
+    filt: Dict[str, Any] = {}
+    if status:
+        filt['status'] = status
+    if since:
+        filt['updated_at'] = {'$gte': since}
+    if after:
+        filt['_id'] = {'$gt': parse_object_id(after)}
+    coll, route = read_collection('premium_keys')
+    cursor = coll.find(filt, {f: 1 for f in EXPORT_FIELDS}).sort('_id', 1).batch_size(EXPORT_BATCH_SIZE)
+
+    def render(rows: List[Dict[str, Any]]) -> str:
+        if format == 'ndjson':
+            return ''.join(json.dumps({'_id': str(r['_id']), **{f: _export_value(r.get(f)) for f in EXPORT_FIELDS}}) + '\n' for r in rows)
+        buf = io.StringIO()
+        w = csv.writer(buf)
+        for r in rows:
+            w.writerow([str(r['_id'])] + [_export_value(r.get(f)) if r.get(f) is not None else '' for f in EXPORT_FIELDS])
+        return buf.getvalue()
+
+    async def stream():
+        if format == 'csv':
+            yield ','.join(['_id'] + EXPORT_FIELDS) + '\r\n'
+        rows: List[Dict[str, Any]] = []
+        try:
+            with observe_read(route):
+                async for doc in cursor:
+                    rows.append(doc)
+                    if len(rows) >= EXPORT_BATCH_SIZE:
+                        yield render(rows)
+                        rows = []
+            if rows:
+                yield render(rows)
+        finally:
+            await cursor.close()
+
+    media_type = 'application/x-ndjson' if format == 'ndjson' else 'text/csv'
+    filename = f"premium_keys_{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}.{'ndjson' if format == 'ndjson' else 'csv'}"
+    return StreamingResponse(stream(), media_type=media_type, headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+
+# ============ Importação de premium_keys ============
+# Migração do sistema de licenças antigo: upload CSV/NDJSON (multipart ou corpo cru)
+# lido incrementalmente do stream da requisição, upsert por `key` em lotes
+# bulk_write(ordered=False). Progresso e erros por linha saem em NDJSON.
+
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', '1000'))
+IMPORT_MAX_LINE_BYTES = int(os.environ.get('IMPORT_MAX_LINE_BYTES', str(64 * 1024)))
+
+
+class ImportKeyRow(BaseModel):
+    key: str = Field(min_length=1)
+    email: EmailStr
+    status: str = Field(default='active', pattern='^(active|revoked)$')
+    product_code: Optional[str] = None
+    order_id: Optional[str] = None
+    expires_at: Optional[datetime] = None
+    created_at: Optional[datetime] = None
+
+
+class _DuplexStreamingResponse(StreamingResponse):
+    # O StreamingResponse padrão escuta o receive() em paralelo para detectar desconexão,
+    # o que consumiria o corpo do upload. Aqui o próprio gerador lê o corpo e a
+    # desconexão chega como ClientDisconnect.
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+
+
+async def _iter_upload_bytes(request: Request, info: Dict[str, Any]):
+    ctype = request.headers.get('content-type', '')
+    if not ctype.startswith('multipart/form-data'):
+        async for chunk in request.stream():
+            if chunk:
+                yield chunk
+        return
+    _, params = parse_options_header(ctype)
+    boundary = params.get(b'boundary')
+    if not boundary:
+        raise HTTPException(status_code=400, detail='multipart sem boundary')
+    # Só o primeiro part com filename é o arquivo; campos de formulário são ignorados
+    state = {'field': b'', 'value': b'', 'is_file': False, 'done': False, 'seen_file': False, 'filename': b'', 'ctype': b''}
+    out: List[bytes] = []
+
+    def on_part_begin():
+        state['is_file'] = False
+
+    def on_header_field(data, start, end):
+        state['field'] += data[start:end]
+
+    def on_header_value(data, start, end):
+        state['value'] += data[start:end]
+
+    def on_header_end():
+        if state['field'].lower() == b'content-disposition':
+            _, disp = parse_options_header(state['value'])
+            state['is_file'] = b'filename' in disp and not state['seen_file']
+            state['filename'] = disp.get(b'filename', b'')
+        elif state['field'].lower() == b'content-type':
+            state['ctype'] = state['value']
+        state['field'] = b''
+        state['value'] = b''
+
+    def on_headers_finished():
+        if state['is_file']:
+            state['seen_file'] = True
+            info['filename'] = state['filename'].decode('utf-8', 'replace')
+            info['content_type'] = state['ctype'].decode('latin-1')
+        state['ctype'] = b''
+
+    def on_part_data(data, start, end):
+        if state['is_file']:
+            out.append(bytes(data[start:end]))
+
+    def on_part_end():
+        if state['is_file']:
+            state['done'] = True
+        state['is_file'] = False
+
+    parser = MultipartParser(boundary, {
+        'on_part_begin': on_part_begin, 'on_header_field': on_header_field, 'on_header_value': on_header_value,
+        'on_header_end': on_header_end, 'on_headers_finished': on_headers_finished,
+        'on_part_data': on_part_data, 'on_part_end': on_part_end,
+    })
+    async for chunk in request.stream():
+        if not chunk:
+            continue
+        parser.write(chunk)
+        if out:
+            yield b''.join(out)
+            out.clear()
+        if state['done']:
+            break
+    if not state['seen_file']:
+        raise HTTPException(status_code=400, detail='multipart sem arquivo')
+
+
+async def _iter_upload_records(chunks, info: Dict[str, Any]):
+    # Linhas completas, decodificadas incrementalmente. No CSV, um campo entre aspas
+    # pode atravessar quebras de linha: junta até as aspas fecharem. A paridade das
+    # aspas é mantida linha a linha (recontar o registro todo seria quadrático) e o
+    # registro inteiro, não só cada linha, fica limitado a IMPORT_MAX_LINE_BYTES.
+    decoder = codecs.getincrementaldecoder('utf-8-sig')(errors='replace')
+    pending = ''
+    record = ''
+    quoted = False
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split('\n')
+        if len(pending) + len(record) > IMPORT_MAX_LINE_BYTES:
+            raise ValueError('linha excede IMPORT_MAX_LINE_BYTES')
+        for line in lines:
+            record += line + '\n'
+            if len(record) > IMPORT_MAX_LINE_BYTES:
+                raise ValueError('registro excede IMPORT_MAX_LINE_BYTES (aspas sem fechar?)')
+            if info['format'] == 'csv' and line.count('"') % 2:
+                quoted = not quoted
+            if quoted:
+                continue
+            yield record.rstrip('\r\n')
+            record = ''
+    pending += decoder.decode(b'', final=True)
+    record += pending
+    if record.strip():
+        yield record.rstrip('\r\n')
+
+
+def _import_row(fmt: str, record: str, header: Optional[List[str]]) -> Dict[str, Any]:
+    if fmt == 'ndjson':
+        data = json.loads(record)
+        if not isinstance(data, dict):
+            raise ValueError('linha não é um objeto JSON')
+        return data
+    values = next(csv.reader([record]))
+    if len(values) != len(header):
+        raise ValueError(f'esperadas {len(header)} colunas, recebidas {len(values)}')
+    return {h: v for h, v in zip(header, values) if v != ''}
+
+
+@api_router.post('/admin/keys/import')
+async def admin_import_keys(request: Request, format: Optional[str] = None, batch_size: Optional[int] = None):
+    require_admin(request)
+    if format and format not in ('ndjson', 'csv'):
+        raise HTTPException(status_code=400, detail='format deve ser ndjson ou csv')
+    # Sem format=, decide pelo Content-Type do corpo ou, em multipart, pelo arquivo
+    info: Dict[str, Any] = {'format': format, 'filename': '', 'content_type': request.headers.get('content-type', '')}
+
+    async def chunks():
+        async for chunk in _iter_upload_bytes(request, info):
+            if not info['format']:
+                hint = (info['filename'] + ' ' + info['content_type']).lower()
+                info['format'] = 'csv' if 'csv' in hint else 'ndjson'
+            yield chunk
+    size = max(1, min(batch_size or IMPORT_BATCH_SIZE, 10000))
+    actor = admin_actor(request)
+
+    async def flush(ops: List[UpdateOne], rows: List[int], keys: List[str], totals: Dict[str, int]):
+        errors = []
+        try:
+            res = await db.premium_keys.bulk_write(ops, ordered=False)
+            upserted, modified = res.upserted_count, res.modified_count
+        except BulkWriteError as e:
+            details = e.details or {}
+            upserted, modified = details.get('nUpserted', 0), details.get('nModified', 0)
+            errors = [{'type': 'error', 'row': rows[w['index']], 'error': w.get('errmsg', 'erro de escrita')}
+                      for w in details.get('writeErrors', [])]
+        totals['upserted'] += upserted
+        totals['modified'] += modified
+        totals['errors'] += len(errors)
+        # Sem isso, resolve_plan e o snapshot seguiriam com o estado anterior à importação
+        invalidate_key_caches(keys, revoked=False)
+        note_write('*')
+        if upserted or modified:
+            plan_stats.request_reconcile()  # o estado anterior das linhas importadas não é conhecido
+        return errors
+
+    async def stream():
+        totals = {'rows': 0, 'upserted': 0, 'modified': 0, 'errors': 0}
+        ops: List[UpdateOne] = []
+        rows: List[int] = []
+        keys: List[str] = []
+        header: Optional[List[str]] = None
+        row_no = 0
+        try:
+            async for record in _iter_upload_records(chunks(), info):
+                if not record.strip():
+                    continue
+                fmt = info['format']
+                if fmt == 'csv' and header is None:
+                    header = [h.strip().lower() for h in next(csv.reader([record]))]
+                    if 'key' not in header or 'email' not in header:
+                        yield json.dumps({'type': 'error', 'row': 0, 'error': 'cabeçalho precisa de key e email'}) + '\n'
+                        return
+                    continue
+                row_no += 1
+                totals['rows'] += 1
+                try:
+                    row = ImportKeyRow.model_validate(_import_row(fmt, record, header))
+                except (ValueError, ValidationError) as e:
+                    totals['errors'] += 1
+                    msg = '; '.join(f"{'.'.join(map(str, x['loc']))}: {x['msg']}" for x in e.errors()) if isinstance(e, ValidationError) else str(e)
+                    yield json.dumps({'type': 'error', 'row': row_no, 'error': msg}) + '\n'
+                    continue
+                now = datetime.utcnow()
+                fields = {'email': row.email.lower().strip(), 'status': row.status, 'updated_at': now}
+                for name in ('product_code', 'order_id', 'expires_at'):
+                    value = getattr(row, name)
+                    if value is not None:
+                        fields[name] = value
+                keys.append(row.key.strip())
+                ops.append(UpdateOne({'key': row.key.strip()}, {
+                    '$set': fields,
+                    '$setOnInsert': {'id': str(uuid.uuid4()), 'created_at': row.created_at or now},
+                }, upsert=True))
+                rows.append(row_no)
+                if len(ops) >= size:
+                    for err in await flush(ops, rows, keys, totals):
+                        yield json.dumps(err) + '\n'
+                    ops, rows, keys = [], [], []
+                    yield json.dumps({'type': 'progress', **totals}) + '\n'
+            if ops:
+                for err in await flush(ops, rows, keys, totals):
+                    yield json.dumps(err) + '\n'
+        except ValueError as e:
+            yield json.dumps({'type': 'error', 'row': row_no + 1, 'error': str(e)}) + '\n'
+        except HTTPException as e:
+            yield json.dumps({'type': 'error', 'row': 0, 'error': e.detail}) + '\n'
+        audit_log.record('keys.import', actor, count=totals['upserted'] + totals['modified'], **totals)
+        yield json.dumps({'type': 'done', **totals}) + '\n'
+
+    return _DuplexStreamingResponse(stream(), media_type='application/x-ndjson')
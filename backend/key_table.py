@@ -0,0 +1,332 @@
+from fastapi import Request, HTTPException
+from pymongo.errors import PyMongoError, OperationFailure
+from typing import List, Optional, Dict, Any
+from datetime import datetime, timedelta
+import os
+import logging
+import json
+import asyncio
+
+import numpy as np
+
+from core import ROOT_DIR, api_router, db, require_admin
+
+logger = logging.getLogger(__name__)
+
+
+# ============ Tabela residente de KEYs ============
+# Modo opcional (KEY_RESIDENCY=1): todas as KEYs em memória num formato compacto, sem
+# I/O por validação. Array ordenado de KEYs de largura fixa (S20) + arrays paralelos de
+# status (uint8) e expiração (uint32, segundos; 0 = sem). Carregado por mmap de
+# arquivos .npy em KEY_TABLE_DIR; mudanças chegam por change stream (ou, sem replica
+# set, por polling de updated_at) num overlay que é incorporado no rebuild periódico.
+# ~25 bytes por KEY, contra centenas num dict de PremiumKey.
+
+KEY_RESIDENCY = os.environ.get('KEY_RESIDENCY', '0') == '1'
+KEY_TABLE_DIR = os.environ.get('KEY_TABLE_DIR', str(ROOT_DIR / 'key_table'))
+KEY_TABLE_WIDTH = 20  # formato XXXX-XXXX-XXXX-XXXX; KEYs mais longas (legado) ficam em `extra`
+KEY_TABLE_REBUILD_SECONDS = float(os.environ.get('KEY_TABLE_REBUILD_SECONDS', '3600'))
+KEY_TABLE_OVERLAY_MAX = int(os.environ.get('KEY_TABLE_OVERLAY_MAX', '50000'))
+KEY_TABLE_POLL_SECONDS = float(os.environ.get('KEY_TABLE_POLL_SECONDS', '5'))
+_KEY_STATUS_CODES = ['active', 'revoked', 'expired']  # índice = código; 255 = outro
+
+
+def _encode_key_state(doc: Dict[str, Any]) -> tuple:
+    status = doc.get('status')
+    code = _KEY_STATUS_CODES.index(status) if status in _KEY_STATUS_CODES else 255
+    exp = doc.get('expires_at')
+    if isinstance(exp, str):
+        try:
+            exp = datetime.fromisoformat(exp)
+        except ValueError:
+            exp = None
+    seconds = int((exp - datetime(1970, 1, 1)).total_seconds()) if isinstance(exp, datetime) else 0
+    return code, max(0, min(seconds, 2 ** 32 - 1))
+
+
+def _decode_key_state(code: int, seconds: int) -> Dict[str, Any]:
+    return {'status': _KEY_STATUS_CODES[code] if code < len(_KEY_STATUS_CODES) else 'unknown',
+            'expires_at': datetime.utcfromtimestamp(seconds) if seconds else None}
+
+
+class KeyTable:
+    def __init__(self, directory: str):
+        self.dir = directory
+        self.keys = None
+        self.status = None
+        self.expires = None
+        self.extra: Dict[str, tuple] = {}
+        self.overlay: Dict[str, tuple] = {}  # key -> (código, expiração, seq da mudança)
+        self.seq = 0
+        self.ready = False
+        self.mode: Optional[str] = None
+        self.resume_token = None
+        self._start_at = None  # operationTime do rebuild: change stream começa dali
+        self.synced_at: Optional[datetime] = None
+        self.built_at: Optional[datetime] = None
+        self.needs_rebuild = False
+        self.hits = 0
+        self.misses = 0
+        self._task: Optional[asyncio.Task] = None
+
+    # --- consulta ---
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        state = self.overlay.get(key)
+        if state is None:
+            state = self._lookup(key)
+        if state is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return _decode_key_state(state[0], state[1])
+
+    def _lookup(self, key: str) -> Optional[tuple]:
+        try:
+            kb = key.encode('ascii')
+        except UnicodeEncodeError:
+            return None
+        if len(kb) > KEY_TABLE_WIDTH:
+            return self.extra.get(key)
+        i = int(np.searchsorted(self.keys, kb))
+        if i < len(self.keys) and self.keys[i] == kb:
+            return int(self.status[i]), int(self.expires[i])
+        return None
+
+    # --- construção e snapshot ---
+    @staticmethod
+    def _arrays(rows_keys: List[bytes], rows_status: List[int], rows_exp: List[int]):
+        keys = np.array(rows_keys, dtype=f'S{KEY_TABLE_WIDTH}')
+        status = np.array(rows_status, dtype=np.uint8)
+        expires = np.array(rows_exp, dtype=np.uint32)
+        return keys, status, expires
+
+    def _install(self, keys, status, expires, extra: Dict[str, tuple]):
+        order = np.argsort(keys, kind='stable')
+        self.keys, self.status, self.expires = keys[order], status[order], expires[order]
+        self.extra = extra
+
+    async def _scan(self):
+        parts = []
+        extra: Dict[str, tuple] = {}
+        buf_k: List[bytes] = []
+        buf_s: List[int] = []
+        buf_e: List[int] = []
+        async for doc in db.premium_keys.find({}, {'_id': 0, 'key': 1, 'status': 1, 'expires_at': 1}).batch_size(10000):
+            key = doc.get('key') or ''
+            code, seconds = _encode_key_state(doc)
+            kb = key.encode('ascii', 'replace')
+            if len(kb) > KEY_TABLE_WIDTH or not key.isascii():
+                extra[key] = (code, seconds)
+                continue
+            buf_k.append(kb)
+            buf_s.append(code)
+            buf_e.append(seconds)
+            if len(buf_k) >= 100000:
+                parts.append(self._arrays(buf_k, buf_s, buf_e))
+                buf_k, buf_s, buf_e = [], [], []
+        parts.append(self._arrays(buf_k, buf_s, buf_e))
+        keys = np.concatenate([p[0] for p in parts])
+        status = np.concatenate([p[1] for p in parts])
+        expires = np.concatenate([p[2] for p in parts])
+        return keys, status, expires, extra
+
+    def _paths(self) -> Dict[str, str]:
+        return {name: os.path.join(self.dir, f'{name}.npy') for name in ('keys', 'status', 'expires')}
+
+    def _save(self, meta: Dict[str, Any]):
+        os.makedirs(self.dir, exist_ok=True)
+        for name, path in self._paths().items():
+            tmp = f'{path}.tmp'
+            with open(tmp, 'wb') as f:
+                np.save(f, getattr(self, name))
+            os.replace(tmp, path)
+        meta_path = os.path.join(self.dir, 'meta.json')
+        with open(f'{meta_path}.tmp', 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(f'{meta_path}.tmp', meta_path)
+
+    def _load(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(os.path.join(self.dir, 'meta.json'), encoding='utf-8') as f:
+                meta = json.load(f)
+            arrays = {name: np.load(path, mmap_mode='r') for name, path in self._paths().items()}
+        except (OSError, ValueError):
+            return None
+        if not (len(arrays['keys']) == len(arrays['status']) == len(arrays['expires']) == meta.get('count')):
+            return None
+        self.keys, self.status, self.expires = arrays['keys'], arrays['status'], arrays['expires']
+        self.extra = {k: tuple(v) for k, v in meta.get('extra', {}).items()}
+        return meta
+
+    def _meta(self) -> Dict[str, Any]:
+        return {
+            'count': len(self.keys),
+            'extra': {k: list(v) for k, v in self.extra.items()},
+            'built_at': self.built_at.isoformat() if self.built_at else None,
+            'synced_at': self.synced_at.isoformat() if self.synced_at else None,
+            'resume_token': self.resume_token,
+        }
+
+    async def rebuild(self):
+        # Mudanças com seq posterior ao início da varredura continuam no overlay
+        seq_at_start = self.seq
+        started = datetime.utcnow()
+        op_time = None
+        if self.mode == 'change_stream':
+            op_time = (await db.command('ping')).get('operationTime')
+        keys, status, expires, extra = await self._scan()
+        await asyncio.to_thread(self._install, keys, status, expires, extra)
+        self.overlay = {k: v for k, v in self.overlay.items() if v[2] > seq_at_start}
+        self.built_at = started
+        self.needs_rebuild = False
+        if self.mode == 'poll':
+            self.synced_at = min(self.synced_at or started, started - timedelta(seconds=1))
+        elif op_time is not None and self.resume_token is None:
+            self._start_at = op_time
+        await asyncio.to_thread(self._save, self._meta())
+        self.ready = True
+
+    # --- mudanças ---
+    def apply(self, doc: Dict[str, Any]):
+        key = doc.get('key')
+        if not key:
+            return
+        self.seq += 1
+        code, seconds = _encode_key_state(doc)
+        self.overlay[key] = (code, seconds, self.seq)
+
+    async def _poll(self):
+        since = self.synced_at or datetime.utcnow()
+        newest = since
+        async for doc in db.premium_keys.find({'updated_at': {'$gte': since}},
+                                              {'_id': 0, 'key': 1, 'status': 1, 'expires_at': 1, 'updated_at': 1}):
+            self.apply(doc)
+            newest = max(newest, doc['updated_at'])
+        self.synced_at = newest
+
+    async def _follow_changes(self):
+        kwargs: Dict[str, Any] = {'full_document': 'updateLookup'}
+        if self.resume_token:
+            kwargs['resume_after'] = self.resume_token
+        elif self._start_at is not None:
+            kwargs['start_at_operation_time'] = self._start_at
+        try:
+            async with db.premium_keys.watch(**kwargs) as stream:
+                async for change in stream:
+                    if change['operationType'] in ('insert', 'update', 'replace') and change.get('fullDocument'):
+                        self.apply(change['fullDocument'])
+                    elif change['operationType'] in ('delete', 'drop', 'invalidate'):
+                        self.needs_rebuild = True  # evento sem a KEY: resolve no rebuild
+                    self.resume_token = stream.resume_token
+                    self.synced_at = datetime.utcnow()
+        except OperationFailure as e:
+            # Token velho demais para o oplog: reconstrói e recomeça do ponto atual
+            logger.warning('Change stream de premium_keys interrompido (%s); reconstruindo a tabela', e)
+            self.resume_token = None
+            self._start_at = None
+            await self.rebuild()
+
+    async def _detect_mode(self) -> str:
+        try:
+            hello = await db.command('hello')
+        except PyMongoError:
+            return 'poll'
+        return 'change_stream' if hello.get('setName') or hello.get('msg') == 'isdbgrid' else 'poll'
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_rebuild = loop.time() + KEY_TABLE_REBUILD_SECONDS
+        while True:
+            try:
+                if not self.ready:
+                    await self.rebuild()
+                if self.mode == 'change_stream':
+                    follower = asyncio.create_task(self._follow_changes())
+                    while not follower.done() and loop.time() < next_rebuild and not self.needs_rebuild \
+                            and len(self.overlay) < KEY_TABLE_OVERLAY_MAX:
+                        await asyncio.sleep(1)
+                    if not follower.done():
+                        follower.cancel()
+                else:
+                    await self._poll()
+                    await asyncio.sleep(KEY_TABLE_POLL_SECONDS)
+                if loop.time() >= next_rebuild or self.needs_rebuild or len(self.overlay) >= KEY_TABLE_OVERLAY_MAX:
+                    self.resume_token = None
+                    await self.rebuild()
+                    next_rebuild = loop.time() + KEY_TABLE_REBUILD_SECONDS
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Falha ao sincronizar a tabela residente de KEYs')
+                await asyncio.sleep(KEY_TABLE_POLL_SECONDS)
+
+    async def start(self):
+        self.mode = await self._detect_mode()
+        meta = await asyncio.to_thread(self._load)
+        if meta is not None:
+            self.built_at = datetime.fromisoformat(meta['built_at']) if meta.get('built_at') else None
+            self.synced_at = datetime.fromisoformat(meta['synced_at']) if meta.get('synced_at') else self.built_at
+            self.resume_token = meta.get('resume_token')
+            if self.mode == 'poll' and self.synced_at is None:
+                self.needs_rebuild = True
+            self.ready = True
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self.ready and self.keys is not None:
+            # Só o ponto de retomada; os arrays já estão no disco desde o último rebuild
+            meta = self._meta()
+            meta_path = os.path.join(self.dir, 'meta.json')
+            if self.overlay:
+                meta['synced_at'] = self.built_at.isoformat() if self.built_at else None
+                meta['resume_token'] = None
+            await asyncio.to_thread(self._write_meta, meta_path, meta)
+
+    @staticmethod
+    def _write_meta(path: str, meta: Dict[str, Any]):
+        with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(f'{path}.tmp', path)
+
+    def stats(self) -> Dict[str, Any]:
+        n = len(self.keys) if self.keys is not None else 0
+        nbytes = sum(a.nbytes for a in (self.keys, self.status, self.expires) if a is not None)
+        per_key = nbytes / n if n else KEY_TABLE_WIDTH + 1 + 4
+        return {
+            'enabled': KEY_RESIDENCY,
+            'ready': self.ready,
+            'mode': self.mode,
+            'keys': n,
+            'extra_keys': len(self.extra),
+            'overlay': len(self.overlay),
+            'array_bytes': nbytes,
+            'bytes_per_key': round(per_key, 1),
+            'mb_per_million_keys': round(per_key * 1e6 / 2 ** 20, 1),
+            'hits': self.hits,
+            'misses': self.misses,
+            'built_at': self.built_at,
+            'synced_at': self.synced_at,
+        }
+
+
+key_table = KeyTable(KEY_TABLE_DIR)
+
+
+@api_router.get('/admin/keys/table')
+async def admin_key_table_stats(request: Request):
+    require_admin(request)
+    return key_table.stats()
+
+
+@api_router.post('/admin/keys/table/rebuild')
+async def admin_key_table_rebuild(request: Request):
+    require_admin(request)
+    if not KEY_RESIDENCY:
+        raise HTTPException(status_code=400, detail='KEY_RESIDENCY desativado')
+    key_table.resume_token = None
+    await key_table.rebuild()
+    return key_table.stats()
@@ -0,0 +1,451 @@
+from fastapi import Request, HTTPException
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field, EmailStr
+from pymongo import UpdateMany, ReturnDocument
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+from typing import List, Optional, Dict, Any
+from collections import deque
+from datetime import datetime, timedelta, timezone
+import os
+import logging
+import uuid
+import json
+import asyncio
+import secrets
+
+from core import api_router, db, require_admin, note_write
+from audit import audit_log, admin_actor
+from plan_stats import plan_stats
+from validation import invalidate_key_caches
+
+logger = logging.getLogger(__name__)
+
+
+# Premium Key Models
+class PremiumKey(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    key: str
+    email: EmailStr
+    product_code: Optional[str] = None
+    order_id: Optional[str] = None
+    status: str = Field(default="active")  # active | revoked
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+    expires_at: Optional[datetime] = None
+    renewals: List[Dict[str, Any]] = Field(default_factory=list)  # [{'order', 'days'}] que já contaram na validade
+
+class ClaimRequest(BaseModel):
+    email: EmailStr
+
+class ClaimResponse(BaseModel):
+    key: str
+    status: str
+
+
+# Admin create key
+class AdminCreateKeyRequest(BaseModel):
+    email: EmailStr
+    days: Optional[int] = Field(default=30, ge=1, le=365)
+
+class AdminCreateKeyResponse(BaseModel):
+    key: str
+    email: EmailStr
+    expires_at: Optional[datetime] = None  # None: a KEY ativa reutilizada não tem validade
+
+
+# Admin revoke key
+class AdminRevokeKeyRequest(BaseModel):
+    email: Optional[EmailStr] = None
+    key: Optional[str] = None
+    order_id: Optional[str] = None
+
+class AdminRevokeKeyResponse(BaseModel):
+    revoked_count: int
+
+class AdminRevokeBulkRequest(BaseModel):
+    emails: List[str] = []
+    keys: List[str] = []
+    order_ids: List[str] = []
+
+
+KEY_ALPHABET = 'ABCDEFGHJKLMNPQRSTUVWXYZ23456789'  # sem caracteres confusos
+
+
+def generate_human_keys(n: int) -> List[str]:
+    # Um único buffer do CSPRNG; alfabeto de 32 símbolos, então b & 31 não tem viés
+    chars = [KEY_ALPHABET[b & 31] for b in secrets.token_bytes(16 * n)]
+    keys = []
+    for i in range(0, 16 * n, 16):
+        c = chars[i:i + 16]
+        keys.append(f"{''.join(c[0:4])}-{''.join(c[4:8])}-{''.join(c[8:12])}-{''.join(c[12:16])}")
+    return keys
+
+
+def _stored_expiry(value: Any) -> Optional[datetime]:
+    # Como em _key_status_response: string ISO é data legada; o que não for data é sem validade
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    if not isinstance(value, datetime):
+        return None
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _issue_key_pipeline(pk: PremiumKey, now: datetime) -> List[Dict[str, Any]]:
+    # Grava a nova chave no upsert ou quando a ativa do e-mail venceu (data no passado);
+    # sem validade (nula, ausente, string inválida) ela é reutilizada, como no validate.
+    # Valores do cliente vão em $literal.
+    expiry = {'$switch': {'branches': [
+        {'case': {'$eq': [{'$type': '$expires_at'}, 'date']}, 'then': '$expires_at'},
+        {'case': {'$eq': [{'$type': '$expires_at'}, 'string']},
+         'then': {'$dateFromString': {'dateString': '$expires_at', 'onError': None, 'onNull': None}}},
+    ], 'default': None}}
+    # null ordena antes de qualquer data: sem o $ne, "sem validade" contaria como vencida
+    expired = {'$let': {'vars': {'exp': expiry}, 'in': {'$and': [{'$ne': ['$$exp', None]}, {'$lte': ['$$exp', now]}]}}}
+    replace = {'$or': [{'$eq': [{'$type': '$key'}, 'missing']}, expired]}
+    fields = {name: {'$cond': [replace, {'$literal': value}, f'${name}']}
+              for name, value in pk.model_dump().items() if name not in ('email', 'status')}
+    return [{'$set': fields}]
+
+
+def _is_email_race(error: DuplicateKeyError) -> bool:
+    # Só o índice email_active_unique indica outro pedido do mesmo e-mail; no índice
+    # de key a candidata é que já existe
+    details = error.details or {}
+    return 'email' in (details.get('keyPattern') or {}) or 'email_active_unique' in details.get('errmsg', str(error))
+
+
+async def issue_premium_key(email: str, days: int, product_code: Optional[str] = None, order_id: Optional[str] = None,
+                            renewal: Optional[str] = None):
+    # Um único findOneAndUpdate por e-mail; os índices únicos (key, e e-mail ativo)
+    # resolvem as corridas. A KEY candidata vem do reservatório, já reservada em key_pool.
+    for _ in range(5):
+        # Precisão do BSON (ms), para a decisão abaixo bater com a do $cond no servidor
+        now = datetime.utcnow()
+        now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+        candidate = await key_reservoir.take()
+        pk = PremiumKey(key=candidate, email=email, product_code=product_code, order_id=order_id,
+                        created_at=now, updated_at=now, expires_at=now + timedelta(days=days),
+                        renewals=[{'order': renewal, 'days': days}] if renewal else [])
+        try:
+            before = await db.premium_keys.find_one_and_update(
+                {'email': email, 'status': 'active'}, _issue_key_pipeline(pk, now),
+                projection={'_id': 0, 'key': 1, 'expires_at': 1, 'product_code': 1}, upsert=True,
+                return_document=ReturnDocument.BEFORE)
+        except DuplicateKeyError as e:
+            if _is_email_race(e):
+                key_reservoir.give_back(candidate)  # corrida no e-mail: a próxima volta reutiliza a do vencedor
+            else:
+                key_reservoir.discard(candidate)  # a KEY já existe em premium_keys: nunca mais serve
+            continue
+        exp = _stored_expiry(before.get('expires_at')) if before else None
+        if before and before.get('key') and (exp is None or exp > now):
+            key_reservoir.give_back(candidate)  # reutilizou a ativa do e-mail
+            return before['key'], exp
+        key_reservoir.consumed(candidate)
+        if before:
+            plan_stats.track(before, 'active', -1)  # ativa vencida, rotacionada
+        plan_stats.track(pk.model_dump(), 'active', 1)
+        note_write(f'key:{candidate}')
+        return candidate, pk.expires_at
+    raise HTTPException(status_code=503, detail='Não foi possível gerar uma KEY única')
+
+
+async def renew_premium_key(email: str, days: int, renewal: str, product_code: Optional[str] = None,
+                            order_id: Optional[str] = None):
+    # Compra de quem já tem KEY ativa estende a validade em vez de só devolvê-la. O
+    # pedido fica em renewals: evento reprocessado (ou dois eventos de compra do mesmo
+    # pedido) não estende duas vezes.
+    for _ in range(5):
+        key, exp = await issue_premium_key(email, days, product_code, order_id, renewal=renewal)
+        doc = await db.premium_keys.find_one({'key': key}, {'_id': 0, 'expires_at': 1, 'product_code': 1, 'renewals': 1})
+        if doc is None or any(r.get('order') == renewal for r in doc.get('renewals') or []):
+            return key, exp  # emitida agora para este pedido, ou já estendida por ele
+        current = _stored_expiry(doc.get('expires_at'))
+        if current is None:
+            return key, exp  # sem validade: não há o que estender
+        now = datetime.utcnow()
+        new_exp = max(current, now) + timedelta(days=days)
+        result = await db.premium_keys.update_one(
+            {'key': key, 'status': 'active', 'expires_at': doc.get('expires_at'), 'renewals.order': {'$ne': renewal}},
+            {'$set': {'expires_at': new_exp, 'updated_at': now}, '$push': {'renewals': {'order': renewal, 'days': days}}})
+        if result.modified_count:
+            plan_stats.track(doc, 'active', -1)
+            plan_stats.track({**doc, 'expires_at': new_exp}, 'active', 1)
+            invalidate_key_caches([key], revoked=False)
+            note_write(f'key:{key}')
+            return key, new_exp
+        # Outra renovação ou uma revogação mudou a KEY no meio: a próxima volta relê
+    raise HTTPException(status_code=503, detail='Não foi possível renovar a KEY')
+
+
+async def ensure_premium_key_indexes():
+    # Ativas já vencidas viram 'expired' (validate já as tratava assim) para que o
+    # índice parcial de e-mail ativo possa ser criado em bases antigas
+    await db.premium_keys.update_many({'status': 'active', 'expires_at': {'$lte': datetime.utcnow()}},
+                                      {'$set': {'status': 'expired', 'updated_at': datetime.utcnow()}})
+    for keys, opts in (('key', {'unique': True}),
+                       ('email', {'unique': True, 'partialFilterExpression': {'status': 'active'}, 'name': 'email_active_unique'}),
+                       # Reembolsos revogam por order_id e desfazem renovações por renewals.order
+                       ('order_id', {'sparse': True}),
+                       ('renewals.order', {'sparse': True}),
+                       # Polling da tabela residente (KeyTable._poll) filtra por updated_at >= since
+                       ('updated_at', {}),
+                       # Varredura de expiração (plan_stats.expire_due): ativas com expires_at <= agora
+                       ([('status', 1), ('expires_at', 1)], {})):
+        try:
+            await db.premium_keys.create_index(keys, **opts)
+        except Exception:
+            logger.exception('Índice em premium_keys.%s não criado; corrija as duplicatas', keys)
+
+
+# Reservatório de KEYs: geradas em lote, reservadas em key_pool (o _id único garante
+# que dois workers nunca seguram a mesma) e checadas contra premium_keys numa consulta
+# só. A criação tira uma pronta da deque em O(1); uma task repõe abaixo do low-water.
+# Reservas órfãs (worker reiniciado) expiram pelo TTL de key_pool.
+
+KEY_POOL_SIZE = int(os.environ.get('KEY_POOL_SIZE', '1000'))
+KEY_POOL_LOW_WATER = int(os.environ.get('KEY_POOL_LOW_WATER', '200'))
+KEY_POOL_TTL_SECONDS = int(os.environ.get('KEY_POOL_TTL_SECONDS', str(7 * 24 * 3600)))
+
+
+class KeyReservoir:
+    def __init__(self, size: int, low_water: int):
+        self.size = size
+        self.low_water = low_water
+        self.ready = deque()
+        self.used: List[str] = []
+        self.generated = 0
+        self.collisions = 0
+        self.refills = 0
+        self.empty_takes = 0
+        self._wake = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    async def refill(self):
+        async with self._lock:
+            if self.used:
+                used, self.used = self.used, []
+                await db.key_pool.delete_many({'_id': {'$in': used}})
+            missing = self.size - len(self.ready)
+            if missing <= 0:
+                return
+            candidates = list(dict.fromkeys(generate_human_keys(missing)))
+            self.generated += len(candidates)
+            taken = {d['key'] async for d in db.premium_keys.find({'key': {'$in': candidates}}, {'key': 1})}
+            fresh = [k for k in candidates if k not in taken]
+            now = datetime.utcnow()
+            try:
+                await db.key_pool.insert_many([{'_id': k, 'reserved_at': now} for k in fresh], ordered=False)
+                reserved = fresh
+            except BulkWriteError as e:
+                lost = {fresh[w['index']] for w in e.details.get('writeErrors', [])}
+                reserved = [k for k in fresh if k not in lost]
+            self.collisions += len(candidates) - len(reserved)
+            self.ready.extend(reserved)
+            self.refills += 1
+
+    async def take(self) -> str:
+        if not self.ready:
+            self.empty_takes += 1
+            await self.refill()
+        if not self.ready:
+            # Reposição não rendeu nenhuma KEY (todas colidiram ou KEY_POOL_SIZE=0)
+            raise HTTPException(status_code=503, detail='Não foi possível gerar uma KEY única')
+        key = self.ready.popleft()
+        if len(self.ready) < self.low_water:
+            self._wake.set()
+        return key
+
+    def give_back(self, key: str):
+        self.ready.appendleft(key)
+
+    def consumed(self, key: str):
+        self.used.append(key)
+
+    def discard(self, key: str):
+        self.collisions += 1
+        self.used.append(key)  # libera a reserva em key_pool na próxima reposição
+
+    async def _run(self):
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            try:
+                await self.refill()
+            except Exception:
+                logger.exception('Falha ao repor o reservatório de KEYs')
+                await asyncio.sleep(5)
+
+    def start(self):
+        if self._task is None:
+            self._wake.set()
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {'ready': len(self.ready), 'size': self.size, 'low_water': self.low_water, 'generated': self.generated,
+                'collisions': self.collisions, 'refills': self.refills, 'empty_takes': self.empty_takes}
+
+
+key_reservoir = KeyReservoir(KEY_POOL_SIZE, KEY_POOL_LOW_WATER)
+
+
+async def revoke_matching(filt: Dict[str, Any]) -> int:
+    # Lê as ativas alcançadas antes de revogar, para mover os contadores de plan_stats
+    filt = {**filt, 'status': 'active'}
+    docs = await db.premium_keys.find(filt, {'_id': 0, 'product_code': 1, 'expires_at': 1}).to_list(None)
+    result = await db.premium_keys.update_many(filt, { '$set': { 'status': 'revoked', 'updated_at': datetime.utcnow() } })
+    plan_stats.moved(docs, 'active', 'revoked', result.modified_count)
+    return result.modified_count
+
+
+async def rollback_renewal(order_id: str) -> int:
+    # Reembolso de um pedido que só estendeu uma KEY já ativa: devolve os dias daquele
+    # pedido em vez de revogar o tempo pago pelos outros. $pull torna a volta idempotente.
+    rolled = 0
+    async for doc in db.premium_keys.find({'status': 'active', 'renewals.order': order_id, 'order_id': {'$ne': order_id}},
+                                          {'_id': 0, 'key': 1, 'expires_at': 1, 'product_code': 1, 'renewals': 1}):
+        current = _stored_expiry(doc.get('expires_at'))
+        entry = next(r for r in doc['renewals'] if r.get('order') == order_id)
+        if current is None:
+            continue
+        new_exp = current - timedelta(days=entry.get('days', 0))
+        result = await db.premium_keys.update_one(
+            {'key': doc['key'], 'expires_at': doc.get('expires_at'), 'renewals.order': order_id},
+            {'$set': {'expires_at': new_exp, 'updated_at': datetime.utcnow()}, '$pull': {'renewals': {'order': order_id}}})
+        if not result.modified_count:
+            # Outra renovação mudou a validade no meio: o webhook tenta de novo (o $pull
+            # das KEYs já devolvidas impede que voltem duas vezes)
+            raise RuntimeError(f"validade de {doc['key']} mudou durante o estorno")
+        plan_stats.track(doc, 'active', -1)
+        plan_stats.track({**doc, 'expires_at': new_exp}, 'active', 1)
+        invalidate_key_caches([doc['key']], revoked=False)
+        note_write(f"key:{doc['key']}")
+        rolled += 1
+    return rolled
+
+
+async def revoke_keys(email: Optional[str] = None, order_id: Optional[str] = None):
+    filt: Dict[str, Any] = {}
+    if email:
+        filt['email'] = email
+    if order_id:
+        filt['order_id'] = order_id
+    await revoke_matching(filt)
+    if order_id and not email:
+        await rollback_renewal(order_id)
+    invalidate_key_caches()
+    note_write('*')
+
+
+@api_router.post('/admin/keys/create', response_model=AdminCreateKeyResponse)
+async def admin_create_key(request: Request, body: AdminCreateKeyRequest):
+    require_admin(request)
+    email = body.email.lower().strip()
+    key_val, expires_at = await issue_premium_key(email, body.days or 30)
+    audit_log.record('keys.create', admin_actor(request), key=key_val, email=email, expires_at=expires_at)
+    return AdminCreateKeyResponse(key=key_val, email=email, expires_at=expires_at)
+
+
+@api_router.post('/admin/keys/revoke', response_model=AdminRevokeKeyResponse)
+async def admin_revoke_keys(request: Request, body: AdminRevokeKeyRequest):
+    require_admin(request)
+    # Precisamos de ao menos um critério
+    if not body.email and not body.key and not body.order_id:
+        raise HTTPException(status_code=400, detail='Informe email, key ou order_id')
+    filt: Dict[str, Any] = {}
+    if body.email:
+        filt['email'] = body.email.lower().strip()
+    if body.key:
+        filt['key'] = body.key.strip()
+    if body.order_id:
+        filt['order_id'] = body.order_id.strip()
+    revoked_count = await revoke_matching(filt)
+    invalidate_key_caches([body.key.strip()] if body.key and not body.email and not body.order_id else None)
+    note_write(f"key:{body.key.strip()}" if body.key and not body.email and not body.order_id else '*')
+    audit_log.record('keys.revoke', admin_actor(request), key=filt.get('key'), email=filt.get('email'),
+                     order_id=filt.get('order_id'), count=revoked_count)
+    return AdminRevokeKeyResponse(revoked_count=revoked_count)
+
+
+@api_router.post('/admin/keys/revoke_all', response_model=AdminRevokeKeyResponse)
+async def admin_revoke_all(request: Request):
+    require_admin(request)
+    result = await db.premium_keys.update_many({'status': 'active'}, { '$set': { 'status': 'revoked', 'updated_at': datetime.utcnow() } })
+    invalidate_key_caches()
+    note_write('*')
+    plan_stats.request_reconcile()
+    audit_log.record('keys.revoke_all', admin_actor(request), count=result.modified_count)
+    return AdminRevokeKeyResponse(revoked_count=result.modified_count)
+
+
+REVOKE_BULK_MAX = int(os.environ.get('REVOKE_BULK_MAX', '50000'))
+REVOKE_BULK_BATCH = int(os.environ.get('REVOKE_BULK_BATCH', '1000'))
+
+
+@api_router.post('/admin/keys/revoke_bulk')
+async def admin_revoke_bulk(request: Request, body: AdminRevokeBulkRequest):
+    require_admin(request)
+    idents = list(dict.fromkeys(
+        [('email', e.lower().strip()) for e in body.emails] +
+        [('key', k.strip()) for k in body.keys] +
+        [('order_id', o.strip()) for o in body.order_ids]))
+    idents = [(f, v) for f, v in idents if v]
+    if not idents:
+        raise HTTPException(status_code=400, detail='Informe emails, keys ou order_ids')
+    if len(idents) > REVOKE_BULK_MAX:
+        raise HTTPException(status_code=413, detail=f'Máximo de {REVOKE_BULK_MAX} identificadores por chamada')
+    actor = admin_actor(request)
+
+    async def stream():
+        totals = {'identifiers': 0, 'modified': 0}
+        for start in range(0, len(idents), REVOKE_BULK_BATCH):
+            batch = idents[start:start + REVOKE_BULK_BATCH]
+            position = {ident: i for i, ident in enumerate(batch)}
+            values: Dict[str, List[str]] = {}
+            for field, value in batch:
+                values.setdefault(field, []).append(value)
+            # Leitura prévia: contagem por identificador (cada KEY conta para o primeiro
+            # identificador da lista que a alcança) e KEYs para invalidar os caches
+            counts = [0] * len(batch)
+            keys: List[str] = []
+            docs: List[Dict[str, Any]] = []
+            async for doc in db.premium_keys.find(
+                    {'status': 'active', '$or': [{f: {'$in': v}} for f, v in values.items()]},
+                    {'_id': 0, 'key': 1, 'email': 1, 'order_id': 1, 'product_code': 1, 'expires_at': 1}):
+                hits = [position[(f, doc.get(f))] for f in ('email', 'key', 'order_id') if (f, doc.get(f)) in position]
+                counts[min(hits)] += 1
+                keys.append(doc['key'])
+                docs.append(doc)
+            now = datetime.utcnow()
+            result = await db.premium_keys.bulk_write(
+                [UpdateMany({'status': 'active', f: v}, {'$set': {'status': 'revoked', 'updated_at': now}}) for f, v in batch],
+                ordered=False)
+            invalidate_key_caches(keys)
+            note_write(*[f'key:{k}' for k in keys])
+            plan_stats.moved(docs, 'active', 'revoked', result.modified_count)
+            audit_log.record('keys.revoke_bulk', actor, keys=keys, count=result.modified_count, identifiers=len(batch))
+            yield ''.join(json.dumps({'type': f, 'id': v, 'modified_count': counts[i]}) + '\n' for i, (f, v) in enumerate(batch))
+            totals['identifiers'] += len(batch)
+            totals['modified'] += result.modified_count
+            # drift != 0: alguma KEY mudou entre a leitura e a escrita (outra revogação concorrente)
+            yield json.dumps({'type': 'progress', **totals, 'drift': result.modified_count - sum(counts)}) + '\n'
+        yield json.dumps({'type': 'done', **totals}) + '\n'
+
+    return StreamingResponse(stream(), media_type='application/x-ndjson')
+
+
+@api_router.get('/admin/keys/pool')
+async def admin_key_pool_stats(request: Request):
+    require_admin(request)
+    return key_reservoir.stats()
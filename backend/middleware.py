@@ -0,0 +1,378 @@
+from fastapi import HTTPException, Request
+from starlette.datastructures import MutableHeaders
+from pymongo.errors import DuplicateKeyError
+from typing import List, Optional, Dict, Any
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import os
+import hashlib
+import json
+import asyncio
+import time
+import zlib
+
+try:
+    import brotli  # opcional: sem ele só há gzip
+except ImportError:
+    brotli = None
+
+from core import api_router, db, require_admin
+
+
+# ============ Compressão das respostas HTTP ============
+# gzip/brotli acima de um tamanho mínimo. Respostas em streaming (NDJSON) são
+# comprimidas pedaço a pedaço com flush, sem bufferizar o corpo inteiro. Rotas
+# pequenas e quentes (validate) ficam de fora.
+
+HTTP_COMPRESSION_MIN_BYTES = int(os.environ.get('HTTP_COMPRESSION_MIN_BYTES', '1024'))
+HTTP_COMPRESSION_LEVEL = int(os.environ.get('HTTP_COMPRESSION_LEVEL', '6'))
+HTTP_COMPRESSION_SKIP_PATHS = set(filter(None, os.environ.get(
+    'HTTP_COMPRESSION_SKIP_PATHS', '/api/premium/keys/validate,/api/quota/consume').split(',')))
+_COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'text/')
+
+http_compression_stats: Dict[str, Dict[str, float]] = {}
+
+
+def _accepted_encoding(scope) -> Optional[str]:
+    # Respeita os q-values: 'br;q=0, gzip' é recusa explícita de br. Entre as aceitas,
+    # vence o maior q; no empate, br
+    accept = ''
+    for name, value in scope.get('headers', []):
+        if name == b'accept-encoding':
+            accept = value.decode('latin-1').lower()
+            break
+    weights: Dict[str, float] = {}
+    for part in accept.split(','):
+        coding, _, params = part.partition(';')
+        q = 1.0
+        for param in params.split(';'):
+            key, _, val = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    q = float(val)
+                except ValueError:
+                    q = 0.0
+        if coding.strip():
+            weights[coding.strip()] = q
+    offered = ['br', 'gzip'] if brotli is not None else ['gzip']
+    ranked = [(weights.get(c, weights.get('*', 0.0)), -i, c) for i, c in enumerate(offered)]
+    q, _, best = max(ranked)
+    return best if q > 0 else None
+
+
+class _StreamCompressor:
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == 'br':
+            import brotli
+            self._c = brotli.Compressor(quality=4)
+        else:
+            self._c = zlib.compressobj(HTTP_COMPRESSION_LEVEL, zlib.DEFLATED, 31)
+
+    def chunk(self, data: bytes, final: bool) -> bytes:
+        if self.encoding == 'br':
+            out = self._c.process(data)
+            return out + (self._c.finish() if final else self._c.flush())
+        out = self._c.compress(data)
+        return out + self._c.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+class ResponseCompressionMiddleware:
+    def __init__(self, app, minimum_size: int = HTTP_COMPRESSION_MIN_BYTES, skip_paths: Optional[set] = None):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.skip_paths = skip_paths if skip_paths is not None else HTTP_COMPRESSION_SKIP_PATHS
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'] in self.skip_paths:
+            await self.app(scope, receive, send)
+            return
+        encoding = _accepted_encoding(scope)
+        if not encoding:
+            await self.app(scope, receive, send)
+            return
+        state: Dict[str, Any] = {'start': None, 'compressor': None, 'passthrough': False, 'bytes_in': 0, 'bytes_out': 0, 'cpu': 0.0}
+
+        def compress(data: bytes, final: bool) -> bytes:
+            started = time.thread_time()
+            out = state['compressor'].chunk(data, final)
+            state['cpu'] += time.thread_time() - started
+            state['bytes_in'] += len(data)
+            state['bytes_out'] += len(out)
+            return out
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                state['start'] = message
+                return
+            if message['type'] != 'http.response.body':
+                await send(message)
+                return
+            body = message.get('body', b'')
+            more = message.get('more_body', False)
+            if state['start'] is not None:
+                start, state['start'] = state['start'], None
+                headers = MutableHeaders(raw=list(start['headers']))
+                ctype = headers.get('content-type', '')
+                eligible = 'content-encoding' not in headers and ctype.startswith(_COMPRESSIBLE_TYPES)
+                # Corpo único pequeno não compensa; streaming é comprimido sempre
+                if not eligible or (not more and len(body) < self.minimum_size):
+                    state['passthrough'] = True
+                    await send(start)
+                    await send(message)
+                    return
+                state['compressor'] = _StreamCompressor(encoding)
+                out = compress(body, not more)
+                headers['content-encoding'] = encoding
+                headers.add_vary_header('Accept-Encoding')
+                if more:
+                    del headers['content-length']
+                else:
+                    headers['content-length'] = str(len(out))
+                await send({**start, 'headers': headers.raw})
+                await send({'type': 'http.response.body', 'body': out, 'more_body': more})
+                return
+            if state['passthrough']:
+                await send(message)
+                return
+            await send({'type': 'http.response.body', 'body': compress(body, not more), 'more_body': more})
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            if state['compressor'] is not None:
+                route = scope.get('route')
+                label = f"{scope['method']} {getattr(route, 'path', scope['path'])}"
+                st = http_compression_stats.setdefault(label, {'responses': 0, 'bytes_in': 0, 'bytes_out': 0, 'cpu_seconds': 0.0})
+                st['responses'] += 1
+                st['bytes_in'] += state['bytes_in']
+                st['bytes_out'] += state['bytes_out']
+                st['cpu_seconds'] += state['cpu']
+
+
+@api_router.get('/admin/http/compression')
+async def admin_http_compression_stats(request: Request):
+    require_admin(request)
+    return {
+        label: {
+            **st,
+            'bytes_saved': st['bytes_in'] - st['bytes_out'],
+            'ratio': round(st['bytes_out'] / st['bytes_in'], 3) if st['bytes_in'] else None,
+            'cpu_us_per_response': round(st['cpu_seconds'] / st['responses'] * 1e6, 1),
+        }
+        for label, st in http_compression_stats.items()
+    }
+
+
+# ============ Idempotency-Key nas rotas admin ============
+# Retry do cliente admin após timeout não pode refazer a mutação. POST em /api/admin/*
+# com o header Idempotency-Key: a resposta fica em idempotency_keys (TTL) e num cache
+# em memória; duplicatas recebem a resposta gravada. Duplicatas concorrentes esperam a
+# primeira execução (future local; entre workers, o placeholder 'in_progress').
+# O placeholder tem um lease (locked_until): se o worker dono morrer, um retry depois
+# do vencimento assume a chave em vez de esperar o TTL. Só corpos JSON de credencial
+# admin válida e até IDEMPOTENCY_MAX_BODY_BYTES: o resto (uploads/streams como
+# /admin/keys/import, 401) passa direto.
+
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', str(24 * 3600)))
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', '1000'))
+IDEMPOTENCY_MAX_BODY_BYTES = int(os.environ.get('IDEMPOTENCY_MAX_BODY_BYTES', str(1024 * 1024)))
+IDEMPOTENCY_WAIT_SECONDS = float(os.environ.get('IDEMPOTENCY_WAIT_SECONDS', '30'))
+IDEMPOTENCY_LEASE_SECONDS = int(os.environ.get('IDEMPOTENCY_LEASE_SECONDS', '300'))
+
+idempotency_stats: Dict[str, int] = {'executed': 0, 'replayed': 0, 'waited': 0, 'conflicts': 0, 'cached': 0, 'inflight': 0,
+                                     'taken_over': 0}
+
+
+class IdempotencyMiddleware:
+    def __init__(self, app, prefix: str = '/api/admin/'):
+        self.app = app
+        self.prefix = prefix
+        self.cache: 'OrderedDict[str, Dict[str, Any]]' = OrderedDict()
+        self.inflight: Dict[str, asyncio.Future] = {}
+        self.stats = idempotency_stats
+
+    def _remember(self, scope_id: str, record: Dict[str, Any]):
+        self.cache[scope_id] = record
+        self.cache.move_to_end(scope_id)
+        while len(self.cache) > IDEMPOTENCY_CACHE_SIZE:
+            self.cache.popitem(last=False)
+        self.stats['cached'] = len(self.cache)
+
+    def _cached(self, scope_id: str) -> Optional[Dict[str, Any]]:
+        record = self.cache.get(scope_id)
+        if record and record['expires_at'] < datetime.utcnow():
+            self.cache.pop(scope_id, None)
+            return None
+        return record
+
+    async def _respond(self, send, status: int, headers: List[List[bytes]], body: bytes):
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _replay(self, send, record: Dict[str, Any], fingerprint: str):
+        if record['fingerprint'] != fingerprint:
+            self.stats['conflicts'] += 1
+            body = json.dumps({'detail': 'Idempotency-Key já usada com outra requisição'}).encode()
+            await self._respond(send, 422, [[b'content-type', b'application/json'], [b'content-length', str(len(body)).encode()]], body)
+            return
+        self.stats['replayed'] += 1
+        headers = [[k.encode('latin-1'), v.encode('latin-1')] for k, v in record['headers']]
+        headers.append([b'idempotent-replayed', b'true'])
+        await self._respond(send, record['status'], headers, record['body'])
+
+    async def _wait_stored(self, scope_id: str) -> Optional[Dict[str, Any]]:
+        # Outro worker está executando: espera o placeholder virar resposta
+        deadline = asyncio.get_running_loop().time() + IDEMPOTENCY_WAIT_SECONDS
+        delay = 0.05
+        while asyncio.get_running_loop().time() < deadline:
+            doc = await db.idempotency_keys.find_one({'_id': scope_id})
+            if doc is None:
+                return None  # a execução falhou e liberou a chave
+            if doc.get('status') == 'completed':
+                return doc
+            if doc.get('locked_until') and doc['locked_until'] < datetime.utcnow():
+                return None  # dono morreu com o lease vencido: o retry assume
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 1.0)
+        return {'status': 'in_progress'}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] != 'POST' or not scope['path'].startswith(self.prefix):
+            await self.app(scope, receive, send)
+            return
+        headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope['headers']}
+        idem_key = headers.get('idempotency-key', '').strip()
+        ctype = headers.get('content-type', '')
+        length = int(headers.get('content-length') or 0)
+        if not idem_key or (ctype and not ctype.startswith('application/json')) or length > IDEMPOTENCY_MAX_BODY_BYTES:
+            await self.app(scope, receive, send)
+            return
+        # Sem credencial válida nada é reservado: a rota responde o 401 normalmente
+        try:
+            require_admin(Request(scope))
+        except HTTPException:
+            await self.app(scope, receive, send)
+            return
+
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            chunks.append(message.get('body', b''))
+            size += len(chunks[-1])
+            if size > IDEMPOTENCY_MAX_BODY_BYTES:
+                # content-length ausente ou falso: o corpo grande segue sem idempotência
+                await self.app(scope, self._body_receive(b''.join(chunks), receive, more=bool(message.get('more_body'))), send)
+                return
+            if not message.get('more_body'):
+                break
+        body = b''.join(chunks)
+        # Escopo por credencial: a mesma Idempotency-Key de outro admin não colide
+        owner = hashlib.sha256(headers.get('authorization', '').encode()).hexdigest()[:16]
+        scope_id = f"{owner}:{idem_key}"
+        fingerprint = hashlib.sha256(b'\n'.join([scope['path'].encode(), scope.get('query_string', b''), body])).hexdigest()
+
+        record = self._cached(scope_id)
+        if record is None and scope_id in self.inflight:
+            self.stats['waited'] += 1
+            record = await asyncio.shield(self.inflight[scope_id])
+        if record is not None:
+            await self._replay(send, record, fingerprint)
+            return
+
+        now = datetime.utcnow()
+        lease = {'_id': scope_id, 'lease': os.urandom(8).hex()}
+        fut = asyncio.get_running_loop().create_future()
+        self.inflight[scope_id] = fut
+        self.stats['inflight'] = len(self.inflight)
+        try:
+            placeholder = {**lease, 'fingerprint': fingerprint, 'status': 'in_progress', 'created_at': now,
+                           'locked_until': now + timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS)}
+            try:
+                await db.idempotency_keys.insert_one(placeholder)
+            except DuplicateKeyError:
+                # Lease vencido: o dono morreu no meio da execução, este retry assume
+                taken = await db.idempotency_keys.find_one_and_update(
+                    {'_id': scope_id, 'status': 'in_progress', 'locked_until': {'$lt': now}},
+                    {'$set': {k: v for k, v in placeholder.items() if k != '_id'}})
+                if taken is not None:
+                    self.stats['taken_over'] += 1
+            else:
+                taken = True
+            if taken is None:
+                self.stats['waited'] += 1
+                doc = await self._wait_stored(scope_id)
+                if doc is None:
+                    fut.set_result(None)
+                    await self.__call__(scope, self._body_receive(body, receive), send)
+                    return
+                if doc['status'] != 'completed':
+                    fut.set_result(None)
+                    detail = json.dumps({'detail': 'Requisição com esta Idempotency-Key ainda em andamento'}).encode()
+                    await self._respond(send, 409, [[b'content-type', b'application/json'], [b'retry-after', b'1']], detail)
+                    return
+                record = {'fingerprint': doc['fingerprint'], 'status': doc['code'], 'headers': doc['headers'], 'body': bytes(doc['body']),
+                          'expires_at': doc['created_at'] + timedelta(seconds=IDEMPOTENCY_TTL_SECONDS)}
+                self._remember(scope_id, record)
+                fut.set_result(record)
+                await self._replay(send, record, fingerprint)
+                return
+
+            response: Dict[str, Any] = {'status': 500, 'headers': [], 'body': []}
+
+            async def send_wrapper(message):
+                if message['type'] == 'http.response.start':
+                    response['status'] = message['status']
+                    response['headers'] = [[k.decode('latin-1'), v.decode('latin-1')] for k, v in message.get('headers', [])]
+                elif message['type'] == 'http.response.body':
+                    response['body'].append(message.get('body', b''))
+                await send(message)
+
+            self.stats['executed'] += 1
+            try:
+                await self.app(scope, self._body_receive(body, receive), send_wrapper)
+            except BaseException:
+                await db.idempotency_keys.delete_one({**lease, 'status': 'in_progress'})
+                fut.set_result(None)
+                raise
+            if response['status'] >= 500:
+                # Erro do servidor não é resposta definitiva: libera para o retry
+                await db.idempotency_keys.delete_one({**lease, 'status': 'in_progress'})
+                fut.set_result(None)
+                return
+            stored_body = b''.join(response['body'])
+            stored_headers = [h for h in response['headers'] if h[0].lower() not in ('date', 'server')]
+            await db.idempotency_keys.update_one(lease, {'$set': {
+                'status': 'completed', 'code': response['status'], 'headers': stored_headers, 'body': stored_body},
+                '$unset': {'locked_until': ''}})
+            record = {'fingerprint': fingerprint, 'status': response['status'], 'headers': stored_headers, 'body': stored_body,
+                      'expires_at': now + timedelta(seconds=IDEMPOTENCY_TTL_SECONDS)}
+            self._remember(scope_id, record)
+            fut.set_result(record)
+        finally:
+            if not fut.done():
+                fut.set_result(None)
+            self.inflight.pop(scope_id, None)
+            self.stats['inflight'] = len(self.inflight)
+
+    @staticmethod
+    def _body_receive(body: bytes, receive, more: bool = False):
+        # Corpo já consumido: entrega de uma vez e depois repassa (resto do corpo ou desconexão)
+        sent = False
+
+        async def replay():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {'type': 'http.request', 'body': body, 'more_body': more}
+            return await receive()
+        return replay
+
+
+@api_router.get('/admin/idempotency/stats')
+async def admin_idempotency_stats(request: Request):
+    require_admin(request)
+    return idempotency_stats
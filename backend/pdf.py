@@ -0,0 +1,212 @@
+from fastapi import Request, HTTPException
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from pydantic import BaseModel
+from pymongo import UpdateOne
+from typing import List, Dict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import os
+import logging
+import hashlib
+import json
+import asyncio
+import contextlib
+import ipaddress
+import socket
+import multiprocessing
+import tempfile
+
+import httpx
+from pypdf import PdfReader
+
+from core import api_router, db
+from codec import text_codec
+from upstream import get_http_client
+
+logger = logging.getLogger(__name__)
+
+
+# ============ Extração de texto de PDF ============
+# Substitui o caminho fetchPdfBinary -> base64 -> Uint8Array da extensão: o PDF chega
+# em streaming (upload ou URL), vai para um arquivo temporário e as páginas são
+# extraídas em paralelo num pool de processos, com cache por página. URLs só para
+# hosts públicos: cada salto de redirecionamento é resolvido e conferido de novo.
+
+PDF_MAX_BYTES = int(os.environ.get('PDF_MAX_BYTES', str(100 * 1024 * 1024)))
+PDF_PAGES_PER_TASK = int(os.environ.get('PDF_PAGES_PER_TASK', '8'))
+PDF_WORKERS = int(os.environ.get('PDF_WORKERS', str(min(4, os.cpu_count() or 1))))
+PDF_CACHE_TTL_SECONDS = int(os.environ.get('PDF_CACHE_TTL_SECONDS', str(7 * 24 * 3600)))
+PDF_URL_MAX_REDIRECTS = int(os.environ.get('PDF_URL_MAX_REDIRECTS', '5'))
+
+_pdf_pool = None
+
+
+class PdfExtractUrlRequest(BaseModel):
+    url: str
+
+
+def _get_pdf_pool():
+    global _pdf_pool
+    if _pdf_pool is None:
+        _pdf_pool = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return _pdf_pool
+
+
+def shutdown_pdf_pool():
+    global _pdf_pool
+    if _pdf_pool is not None:
+        _pdf_pool.shutdown(wait=False, cancel_futures=True)
+        _pdf_pool = None
+
+
+def _pdf_page_count(path: str) -> int:
+    return len(PdfReader(path).pages)
+
+
+def _extract_pdf_range(path: str, start: int, end: int) -> List[str]:
+    # Executa em outro processo: cada tarefa abre o arquivo e extrai [start, end)
+    reader = PdfReader(path)
+    out = []
+    for i in range(start, end):
+        try:
+            out.append(reader.pages[i].extract_text() or '')
+        except Exception:
+            out.append('')
+    return out
+
+
+async def _spool_pdf(chunks, dest) -> str:
+    sha = hashlib.sha256()
+    size = 0
+    async for chunk in chunks:
+        size += len(chunk)
+        if size > PDF_MAX_BYTES:
+            raise HTTPException(status_code=413, detail='PDF excede o tamanho máximo permitido')
+        sha.update(chunk)
+        dest.write(chunk)
+    dest.flush()
+    if size == 0:
+        raise HTTPException(status_code=400, detail='PDF vazio')
+    return sha.hexdigest()
+
+
+def _is_public_address(ip) -> bool:
+    if getattr(ip, 'ipv4_mapped', None) is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+async def _check_public_url(url: str) -> httpx.URL:
+    # Bloqueia loopback, redes privadas, link-local (metadados de nuvem) e afins
+    try:
+        target = httpx.URL(url)
+    except httpx.InvalidURL:
+        raise HTTPException(status_code=400, detail='URL inválida')
+    if target.scheme not in ('http', 'https') or not target.host:
+        raise HTTPException(status_code=400, detail='URL inválida')
+    port = target.port or (443 if target.scheme == 'https' else 80)
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(target.host, port, type=socket.SOCK_STREAM)
+    except socket.gaierror:
+        raise HTTPException(status_code=400, detail='Host do PDF não encontrado')
+    for info in infos:
+        if not _is_public_address(ipaddress.ip_address(info[4][0].split('%', 1)[0])):
+            raise HTTPException(status_code=400, detail='URL do PDF aponta para um endereço não permitido')
+    return target
+
+
+async def _download_pdf(url: str, dest) -> str:
+    # Redirecionamentos seguidos à mão para validar o destino de cada salto
+    for _ in range(PDF_URL_MAX_REDIRECTS + 1):
+        target = await _check_public_url(url)
+        try:
+            async with get_http_client().stream('GET', target, follow_redirects=False) as resp:
+                if resp.is_redirect and resp.headers.get('location'):
+                    url = str(target.join(resp.headers['location']))
+                    continue
+                if resp.status_code >= 400:
+                    logger.info('pdf: HTTP %s ao baixar %s', resp.status_code, target.host)
+                    raise HTTPException(status_code=502, detail='Não foi possível baixar o PDF')
+                return await _spool_pdf(resp.aiter_bytes(), dest)
+        except httpx.HTTPError as e:
+            logger.info('pdf: falha ao baixar %s (%s)', target.host, type(e).__name__)
+            raise HTTPException(status_code=502, detail='Não foi possível baixar o PDF')
+    raise HTTPException(status_code=502, detail='Redirecionamentos demais ao baixar o PDF')
+
+
+def _remove_file(path: str):
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(path)
+
+
+async def _iter_pdf_pages(path: str, file_hash: str, num_pages: int):
+    loop = asyncio.get_running_loop()
+    cached: Dict[int, str] = {}
+    async for doc in db.pdf_pages.find({'file_hash': file_hash}, {'page': 1, 'text': 1}):
+        cached[doc['page']] = await text_codec.inflate(doc['text'])
+    # Faixas contíguas de páginas ainda não extraídas, uma tarefa por faixa
+    futures: Dict[int, asyncio.Future] = {}
+    start = None
+    for i in range(num_pages + 1):
+        missing = i < num_pages and i not in cached
+        if missing and start is None:
+            start = i
+        if start is not None and (not missing or i - start >= PDF_PAGES_PER_TASK):
+            futures[start] = loop.run_in_executor(_get_pdf_pool(), _extract_pdf_range, path, start, i)
+            start = i if missing else None
+    try:
+        i = 0
+        while i < num_pages:
+            if i in cached:
+                yield i, cached[i], True
+                i += 1
+                continue
+            texts = await futures.pop(i)
+            now = datetime.utcnow()
+            await db.pdf_pages.bulk_write([
+                UpdateOne({'_id': f'{file_hash}:{i + j}'},
+                          {'$set': {'file_hash': file_hash, 'page': i + j, 'text': text_codec.pack(t), 'created_at': now}}, upsert=True)
+                for j, t in enumerate(texts)
+            ], ordered=False)
+            for t in texts:
+                yield i, t, False
+                i += 1
+    finally:
+        for f in futures.values():
+            f.cancel()
+
+
+@api_router.post('/pdf/extract')
+async def extract_pdf_text(request: Request):
+    tmp = tempfile.NamedTemporaryFile(suffix='.pdf', delete=False)
+    try:
+        if (request.headers.get('content-type') or '').startswith('application/json'):
+            body = PdfExtractUrlRequest(**(await request.json()))
+            file_hash = await _download_pdf(body.url, tmp)
+        else:
+            file_hash = await _spool_pdf(request.stream(), tmp)
+        tmp.close()
+        try:
+            num_pages = await asyncio.get_running_loop().run_in_executor(_get_pdf_pool(), _pdf_page_count, tmp.name)
+        except Exception:
+            raise HTTPException(status_code=422, detail='PDF inválido ou corrompido')
+    except BaseException:
+        tmp.close()
+        _remove_file(tmp.name)
+        raise
+
+    async def stream():
+        cached_pages = 0
+        try:
+            yield json.dumps({'type': 'meta', 'file_hash': file_hash, 'pages': num_pages}) + '\n'
+            async for page, text, was_cached in _iter_pdf_pages(tmp.name, file_hash, num_pages):
+                cached_pages += int(was_cached)
+                yield json.dumps({'type': 'page', 'page': page + 1, 'text': text}, ensure_ascii=False) + '\n'
+            yield json.dumps({'type': 'done', 'pages': num_pages, 'cached_pages': cached_pages}) + '\n'
+        finally:
+            _remove_file(tmp.name)
+
+    # O gerador pode nem começar (cliente desconectou antes): a background task apaga
+    # o arquivo de qualquer forma; o finally acima cobre erro no meio do streaming
+    return StreamingResponse(stream(), media_type='application/x-ndjson', background=BackgroundTask(_remove_file, tmp.name))
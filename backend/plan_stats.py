@@ -0,0 +1,197 @@
+from fastapi import Request
+from typing import List, Optional, Dict, Any
+from collections import Counter
+from datetime import datetime
+import os
+import logging
+import asyncio
+
+from core import api_router, db, require_admin
+
+logger = logging.getLogger(__name__)
+
+
+# ============ Estatísticas de planos ============
+# Contadores de premium_keys num documento só (plan_stats/_id=premium_keys), para o
+# painel não rodar count_documents: por status, por product_code × status e, para as
+# ativas, por dia de expiração. Criação, revogação e a varredura de expiração acumulam
+# deltas em memória, gravados com um $inc por ciclo; uma agregação periódica (ou pedida
+# quando o delta não é conhecido: revoke_all, import, corrida) reconcilia o documento.
+
+PLAN_STATS_FLUSH_SECONDS = float(os.environ.get('PLAN_STATS_FLUSH_SECONDS', '2'))
+PLAN_STATS_EXPIRY_SECONDS = float(os.environ.get('PLAN_STATS_EXPIRY_SECONDS', '300'))
+PLAN_STATS_RECONCILE_SECONDS = float(os.environ.get('PLAN_STATS_RECONCILE_SECONDS', '3600'))
+PLAN_STATS_EXPIRING_DAYS = int(os.environ.get('PLAN_STATS_EXPIRING_DAYS', '7'))
+PLAN_STATS_DOC_ID = 'premium_keys'
+
+
+def _stats_label(value: Optional[str]) -> str:
+    # Nomes de campo do Mongo não podem ter '.' nem começar com '$'
+    return (value or '(none)').replace('.', '_').lstrip('$') or '(none)'
+
+
+def _stats_fields(doc: Dict[str, Any], status: str) -> List[str]:
+    fields = [f'status.{_stats_label(status)}', f'products.{_stats_label(doc.get("product_code"))}.{_stats_label(status)}']
+    if status == 'active':
+        exp = doc.get('expires_at')
+        fields.append(f"expiry_days.{exp.strftime('%Y-%m-%d') if isinstance(exp, datetime) else 'none'}")
+    return fields
+
+
+class PlanStats:
+    def __init__(self):
+        self.pending: Counter = Counter()
+        self.flushed = 0
+        self.reconciles = 0
+        self.expired = 0
+        self.last_drift: Dict[str, int] = {}
+        self.reconciled_at: Optional[datetime] = None
+        self._reconcile = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def track(self, doc: Dict[str, Any], status: str, delta: int):
+        for field in _stats_fields(doc, status):
+            self.pending[field] += delta
+
+    def moved(self, docs: List[Dict[str, Any]], old: str, new: str, modified: int):
+        # Só aplica o delta por documento quando a escrita alcançou exatamente o que foi lido
+        if modified != len(docs):
+            self.request_reconcile()
+            return
+        for doc in docs:
+            self.track(doc, old, -1)
+            self.track(doc, new, 1)
+
+    def request_reconcile(self):
+        self._reconcile.set()
+
+    async def flush(self):
+        pending = {k: v for k, v in self.pending.items() if v}
+        self.pending.clear()
+        if not pending:
+            return
+        try:
+            await db.plan_stats.update_one({'_id': PLAN_STATS_DOC_ID}, {'$inc': pending}, upsert=True)
+            self.flushed += 1
+        except Exception:
+            self.pending.update(pending)
+            raise
+
+    async def expire_due(self):
+        # Ativas vencidas viram 'expired'; o filtro por _id + status evita contar duas vezes
+        # com outro worker varrendo ao mesmo tempo
+        now = datetime.utcnow()
+        docs = await db.premium_keys.find({'status': 'active', 'expires_at': {'$lte': now}},
+                                          {'_id': 1, 'product_code': 1, 'expires_at': 1}).to_list(None)
+        if not docs:
+            return
+        result = await db.premium_keys.update_many({'_id': {'$in': [d['_id'] for d in docs]}, 'status': 'active'},
+                                                   {'$set': {'status': 'expired', 'updated_at': now}})
+        self.moved(docs, 'active', 'expired', result.modified_count)
+        self.expired += result.modified_count
+
+    async def reconcile(self):
+        # Retrato completo por agregação; o que estava pendente ao começar já está contido
+        # nele e é descontado no fim. Deltas registrados durante a agregação continuam
+        # pendentes para o próximo flush
+        day = {'$cond': [{'$and': [{'$eq': ['$status', 'active']}, {'$eq': [{'$type': '$expires_at'}, 'date']}]},
+                         {'$dateToString': {'format': '%Y-%m-%d', 'date': '$expires_at'}}, None]}
+        doc: Dict[str, Any] = {'status': {}, 'products': {}, 'expiry_days': {}}
+        before = Counter(self.pending)
+        async for row in db.premium_keys.aggregate([
+                {'$group': {'_id': {'status': '$status', 'product': '$product_code', 'day': day}, 'n': {'$sum': 1}}}]):
+            status = _stats_label(row['_id'].get('status'))
+            product = _stats_label(row['_id'].get('product'))
+            doc['status'][status] = doc['status'].get(status, 0) + row['n']
+            doc['products'].setdefault(product, {})
+            doc['products'][product][status] = doc['products'][product].get(status, 0) + row['n']
+            if status == 'active':
+                bucket = row['_id'].get('day') or 'none'
+                doc['expiry_days'][bucket] = doc['expiry_days'].get(bucket, 0) + row['n']
+        now = datetime.utcnow()
+        old = await db.plan_stats.find_one({'_id': PLAN_STATS_DOC_ID}) or {}
+        self.last_drift = {s: n - old.get('status', {}).get(s, 0) for s, n in doc['status'].items()
+                           if n != old.get('status', {}).get(s, 0)}
+        await db.plan_stats.replace_one({'_id': PLAN_STATS_DOC_ID}, {**doc, 'reconciled_at': now}, upsert=True)
+        self.pending.subtract(before)
+        self.pending = Counter({k: v for k, v in self.pending.items() if v})
+        self.reconciled_at = now
+        self.reconciles += 1
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_expiry = loop.time()
+        next_reconcile = loop.time()
+        while True:
+            try:
+                await asyncio.wait_for(self._reconcile.wait(), timeout=PLAN_STATS_FLUSH_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                if loop.time() >= next_expiry:
+                    await self.expire_due()
+                    next_expiry = loop.time() + PLAN_STATS_EXPIRY_SECONDS
+                if self._reconcile.is_set() or loop.time() >= next_reconcile:
+                    self._reconcile.clear()
+                    await self.reconcile()
+                    next_reconcile = loop.time() + PLAN_STATS_RECONCILE_SECONDS
+                await self.flush()
+            except Exception:
+                logger.exception('Falha ao atualizar as estatísticas de planos')
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception('Falha ao gravar os contadores pendentes de plan_stats')
+
+    async def snapshot(self) -> Dict[str, Any]:
+        doc = await db.plan_stats.find_one({'_id': PLAN_STATS_DOC_ID}) or {}
+        out = {name: dict(doc.get(name, {})) for name in ('status', 'expiry_days')}
+        out['products'] = {p: dict(v) for p, v in doc.get('products', {}).items()}
+        # Deltas deste worker ainda não gravados
+        for field, delta in self.pending.items():
+            section, _, rest = field.partition('.')
+            if section == 'products':
+                product, _, status = rest.partition('.')
+                target = out['products'].setdefault(product, {})
+                target[status] = target.get(status, 0) + delta
+            else:
+                out[section][rest] = out[section].get(rest, 0) + delta
+        today = datetime.utcnow().date()
+        expiring = {'overdue': 0, 'today': 0, f'next_{PLAN_STATS_EXPIRING_DAYS}_days': 0, 'no_expiry': 0}
+        for bucket, n in out['expiry_days'].items():
+            if bucket == 'none':
+                expiring['no_expiry'] += n
+                continue
+            days = (datetime.strptime(bucket, '%Y-%m-%d').date() - today).days
+            if days < 0:
+                expiring['overdue'] += n
+            elif days == 0:
+                expiring['today'] += n
+            if 0 <= days < PLAN_STATS_EXPIRING_DAYS:
+                expiring[f'next_{PLAN_STATS_EXPIRING_DAYS}_days'] += n
+        out['expiry_days'] = {b: n for b, n in sorted(out['expiry_days'].items()) if n}
+        out['expiring'] = expiring
+        out['reconciled_at'] = doc.get('reconciled_at')
+        return out
+
+    def stats(self) -> Dict[str, Any]:
+        return {'pending_fields': len(self.pending), 'flushes': self.flushed, 'reconciles': self.reconciles,
+                'expired_by_sweep': self.expired, 'last_drift': self.last_drift, 'reconciled_at': self.reconciled_at}
+
+
+plan_stats = PlanStats()
+
+
+@api_router.get('/admin/stats')
+async def admin_plan_stats(request: Request):
+    require_admin(request)
+    return {**await plan_stats.snapshot(), 'maintenance': plan_stats.stats()}
@@ -0,0 +1,161 @@
+from pydantic import BaseModel, Field
+from pymongo import UpdateOne
+from typing import Optional, Dict
+from datetime import datetime, timedelta
+import os
+import logging
+import asyncio
+
+from core import api_router, db
+from validation import resolve_plan
+
+logger = logging.getLogger(__name__)
+
+
+# ============ Cota diária do plano free ============
+# Fonte de verdade da cota no servidor (antes em chrome.storage.sync + favoritos).
+# Verificar-e-incrementar acontece em memória; os incrementos são agregados e
+# gravados em lote com $inc, então o caminho quente não espera o Mongo.
+
+FREE_DAILY_LIMIT = int(os.environ.get('FREE_DAILY_LIMIT', '30'))
+QUOTA_FLUSH_SECONDS = float(os.environ.get('QUOTA_FLUSH_SECONDS', '2'))
+QUOTA_TTL_SECONDS = int(os.environ.get('QUOTA_TTL_SECONDS', str(3 * 24 * 3600)))
+
+
+class QuotaRequest(BaseModel):
+    device_id: str = Field(min_length=8, max_length=128)
+    key: Optional[str] = None
+    tz_offset_minutes: int = Field(default=0, ge=-14 * 60, le=14 * 60)
+
+class QuotaResponse(BaseModel):
+    allowed: bool
+    plan: str
+    day: str
+    count: int
+    limit: Optional[int] = None
+    remaining: Optional[int] = None
+    error: Optional[str] = None
+
+
+def _device_day(tz_offset_minutes: int) -> str:
+    # Mesmo dia local que todayStr() na extensão
+    return (datetime.utcnow() - timedelta(minutes=tz_offset_minutes)).strftime('%Y-%m-%d')
+
+
+class QuotaLedger:
+    def __init__(self, limit: int, flush_seconds: float):
+        self.limit = limit
+        self.flush_seconds = flush_seconds
+        self.counts: Dict[str, int] = {}  # 'dia:device' -> uso conhecido
+        self.pending: Dict[str, int] = {}  # incrementos ainda não gravados
+        self.loading: Dict[str, asyncio.Future] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def _ensure_loaded(self, doc_id: str):
+        if doc_id in self.counts:
+            return
+        fut = self.loading.get(doc_id)
+        if fut is None:
+            fut = asyncio.get_running_loop().create_future()
+            self.loading[doc_id] = fut
+            try:
+                doc = await db.quota_daily.find_one({'_id': doc_id}, {'count': 1})
+                self.counts.setdefault(doc_id, (doc or {}).get('count', 0))
+                fut.set_result(None)
+            except BaseException as e:
+                fut.set_exception(e)
+                raise
+            finally:
+                self.loading.pop(doc_id, None)
+        else:
+            await fut
+
+    async def consume(self, device_id: str, tz_offset_minutes: int = 0) -> QuotaResponse:
+        day = _device_day(tz_offset_minutes)
+        doc_id = f'{day}:{device_id}'
+        await self._ensure_loaded(doc_id)
+        # Sem await entre ler e incrementar: atômico para todas as abas do dispositivo
+        count = self.counts[doc_id]
+        if count >= self.limit:
+            return QuotaResponse(allowed=False, plan='free', day=day, count=count, limit=self.limit, remaining=0,
+                                 error=f'Limite diário atingido ({self.limit}/{self.limit}). Insira sua KEY de ASSINATURA válida para liberar o Premium.')
+        self.counts[doc_id] = count + 1
+        self.pending[doc_id] = self.pending.get(doc_id, 0) + 1
+        return QuotaResponse(allowed=True, plan='free', day=day, count=count + 1, limit=self.limit, remaining=self.limit - count - 1)
+
+    def refund(self, device_id: str, day: str):
+        doc_id = f'{day}:{device_id}'
+        if self.counts.get(doc_id, 0) > 0:
+            self.counts[doc_id] -= 1
+            self.pending[doc_id] = self.pending.get(doc_id, 0) - 1
+
+    async def peek(self, device_id: str, tz_offset_minutes: int = 0) -> QuotaResponse:
+        day = _device_day(tz_offset_minutes)
+        doc_id = f'{day}:{device_id}'
+        await self._ensure_loaded(doc_id)
+        count = self.counts[doc_id]
+        return QuotaResponse(allowed=count < self.limit, plan='free', day=day, count=count, limit=self.limit, remaining=max(0, self.limit - count))
+
+    async def flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, {}
+        now = datetime.utcnow()
+        ops = []
+        for doc_id, inc in batch.items():
+            if not inc:
+                continue
+            day, device_id = doc_id.split(':', 1)
+            ops.append(UpdateOne({'_id': doc_id},
+                                 {'$inc': {'count': inc}, '$setOnInsert': {'day': day, 'device_id': device_id, 'created_at': now}},
+                                 upsert=True))
+        if not ops:
+            return
+        try:
+            await db.quota_daily.bulk_write(ops, ordered=False)
+        except Exception:
+            # Devolve os incrementos para a próxima rodada
+            for doc_id, inc in batch.items():
+                self.pending[doc_id] = self.pending.get(doc_id, 0) + inc
+            raise
+        # Ressincroniza com o que outros workers gravaram no mesmo período
+        async for doc in db.quota_daily.find({'_id': {'$in': list(batch)}}, {'count': 1}):
+            self.counts[doc['_id']] = doc['count'] + self.pending.get(doc['_id'], 0)
+        cutoff = (datetime.utcnow() - timedelta(days=2)).strftime('%Y-%m-%d')
+        for doc_id in [k for k in self.counts if k[:10] < cutoff]:
+            self.counts.pop(doc_id, None)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception('Falha ao gravar cota diária')
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+
+quota_ledger = QuotaLedger(FREE_DAILY_LIMIT, QUOTA_FLUSH_SECONDS)
+
+
+@api_router.post('/quota/consume', response_model=QuotaResponse)
+async def quota_consume(req: QuotaRequest):
+    if await resolve_plan(req.key) == 'premium':
+        return QuotaResponse(allowed=True, plan='premium', day=_device_day(req.tz_offset_minutes), count=0)
+    return await quota_ledger.consume(req.device_id, req.tz_offset_minutes)
+
+
+@api_router.post('/quota/status', response_model=QuotaResponse)
+async def quota_status(req: QuotaRequest):
+    if await resolve_plan(req.key) == 'premium':
+        return QuotaResponse(allowed=True, plan='premium', day=_device_day(req.tz_offset_minutes), count=0)
+    return await quota_ledger.peek(req.device_id, req.tz_offset_minutes)
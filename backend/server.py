@@ -1,31 +1,34 @@
-from fastapi import FastAPI, APIRouter, Request, HTTPException
-from dotenv import load_dotenv
+from fastapi import FastAPI
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
-import os
-import logging
-from pathlib import Path
-from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional, Dict, Any
+from pydantic import BaseModel, Field
+from typing import List, Optional
 import uuid
-from datetime import datetime, timedelta
-import hashlib
-import json
-
-
-ROOT_DIR = Path(__file__).parent
-load_dotenv(ROOT_DIR / '.env')
-
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
-
-# Create the main app without a prefix
-app = FastAPI()
+from datetime import datetime
+import logging
+import asyncio
+import contextlib
+import inspect
+
+import core
+from core import AppSettings, api_router, db
+# Os módulos abaixo registram suas rotas em api_router ao serem importados
+from audit import AUDIT_TTL_DAYS, audit_log
+from codec import text_codec
+from history import history_search_index, run_history_search_sync
+from key_table import KEY_RESIDENCY, key_table
+from keys import KEY_POOL_TTL_SECONDS, ensure_premium_key_indexes, key_reservoir
+from middleware import IDEMPOTENCY_TTL_SECONDS, IdempotencyMiddleware, ResponseCompressionMiddleware
+from pdf import PDF_CACHE_TTL_SECONDS, shutdown_pdf_pool
+from plan_stats import plan_stats
+from quota import QUOTA_TTL_SECONDS, quota_ledger
+from summarize import CHUNK_CACHE_TTL_SECONDS, DEEP_CACHE_TTL_SECONDS, SUMMARY_CACHE_TTL_SECONDS, near_dup_index
+from upstream import close_http_client, upstream_cooldowns
+from validation import key_snapshot
+from webhooks import webhook_processor
+import compaction  # noqa: F401 - só registra rotas
+import key_io  # noqa: F401 - só registra rotas
 
-# Create a router with the /api prefix
-api_router = APIRouter(prefix="/api")
+logger = logging.getLogger(__name__)
 
 
 # Define Models
@@ -37,90 +40,6 @@ class StatusCheck(BaseModel):
 class StatusCheckCreate(BaseModel):
     client_name: str
 
-# Premium Key Models
-class PremiumKey(BaseModel):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    key: str
-    email: EmailStr
-    product_code: Optional[str] = None
-    order_id: Optional[str] = None
-    status: str = Field(default="active")  # active | revoked
-    created_at: datetime = Field(default_factory=datetime.utcnow)
-    updated_at: datetime = Field(default_factory=datetime.utcnow)
-    expires_at: Optional[datetime] = None
-
-class ClaimRequest(BaseModel):
-    email: EmailStr
-
-class ClaimResponse(BaseModel):
-    key: str
-    status: str
-
-class ValidateKeyRequest(BaseModel):
-    key: str
-
-class ValidateKeyResponse(BaseModel):
-    valid: bool
-    plan: str  # 'premium' | 'free'
-    status: Optional[str] = None
-    expires_at: Optional[datetime] = None
-    expires_at_ms: Optional[int] = None
-
-# Admin create key
-class AdminCreateKeyRequest(BaseModel):
-    email: EmailStr
-    days: Optional[int] = Field(default=30, ge=1, le=365)
-
-class AdminCreateKeyResponse(BaseModel):
-    key: str
-    email: EmailStr
-    expires_at: datetime
-
-
-# Admin revoke key
-class AdminRevokeKeyRequest(BaseModel):
-    email: Optional[EmailStr] = None
-    key: Optional[str] = None
-    order_id: Optional[str] = None
-
-class AdminRevokeKeyResponse(BaseModel):
-    revoked_count: int
-
-# Utility functions
-SAFE_SECRET_ENV = 'LASTLINK_WEBHOOK_SECRET'
-
-
-def _constant_time_equals(a: str, b: str) -> bool:
-    return hashlib.sha256(a.encode()).digest() == hashlib.sha256(b.encode()).digest()
-
-
-def generate_human_key() -> str:
-    import secrets
-    alphabet = 'ABCDEFGHJKLMNPQRSTUVWXYZ23456789'  # sem caracteres confusos
-    def block(n: int) -> str:
-        return ''.join(secrets.choice(alphabet) for _ in range(n))
-    return f"{block(4)}-{block(4)}-{block(4)}-{block(4)}"
-
-
-async def ensure_unique_key() -> str:
-    # Gera uma chave que não colida na base
-    for _ in range(10):
-        k = generate_human_key()
-        existing = await db.premium_keys.find_one({'key': k})
-        if not existing:
-            return k
-    # fallback improvável
-    return f"{uuid.uuid4()}".upper()
-
-
-async def revoke_keys(email: Optional[str] = None, order_id: Optional[str] = None):
-    filt: Dict[str, Any] = { 'status': 'active' }
-    if email:
-        filt['email'] = email
-    if order_id:
-        filt['order_id'] = order_id
-    await db.premium_keys.update_many(filt, { '$set': { 'status': 'revoked', 'updated_at': datetime.utcnow() } })
-
 
 # Add your routes to the router instead of directly to app
 @api_router.get("/")
@@ -141,120 +60,96 @@ async def get_status_checks():
     return [StatusCheck(**status_check) for status_check in status_checks]
 
 
-# ============ REMOVIDO: Lastlink Webhook e Claim por e-mail ============
-# Rota antiga /api/webhooks/lastlink e /api/premium/claim foram removidas conforme solicitação
-
-
-# ============ Premium APIs ============
-@api_router.post('/premium/keys/validate', response_model=ValidateKeyResponse)
-async def validate_key(req: ValidateKeyRequest):
-    key_raw = (req.key or '').strip()
-    if not key_raw:
-        return ValidateKeyResponse(valid=False, plan='free', status='invalid')
-    key_doc = await db.premium_keys.find_one({'key': key_raw})
-    if not key_doc:
-        return ValidateKeyResponse(valid=False, plan='free', status='not_found')
-    status = key_doc.get('status')
-    if status != 'active':
-        return ValidateKeyResponse(valid=False, plan='free', status=status)
-    # Checa expiração
-    exp = key_doc.get('expires_at')
-    try:
-        if exp and isinstance(exp, str):
-            # caso legado salvo como string
-            exp = datetime.fromisoformat(exp)
-    except Exception:
-        exp = None
-    if exp and datetime.utcnow() >= exp:
-        return ValidateKeyResponse(valid=False, plan='free', status='expired', expires_at=exp, expires_at_ms=int(exp.timestamp()*1000) if exp else None)
-    return ValidateKeyResponse(valid=True, plan='premium', status='active', expires_at=exp, expires_at_ms=int(exp.timestamp()*1000) if exp else None)
-
-
-# ============ Admin APIs ============
-
-def _get_admin_key() -> Optional[str]:
-    return os.environ.get('ADMIN_KEY')
-
-
-def _require_admin(request: Request):
-    auth = request.headers.get('authorization') or request.headers.get('Authorization')
-    if not auth or not auth.lower().startswith('bearer '):
-        raise HTTPException(status_code=401, detail='Unauthorized')
-    provided = auth.split(' ', 1)[1].strip()
-    configured = _get_admin_key()
-    if not configured:
-        raise HTTPException(status_code=500, detail='ADMIN_KEY not configured')
-    if not _constant_time_equals(provided, configured):
-        raise HTTPException(status_code=401, detail='Unauthorized')
+# ============ REMOVIDO: Claim por e-mail ============
+# Rota antiga /api/premium/claim foi removida conforme solicitação
+
+# ============ App ============
+
+_warmup_tasks: List[asyncio.Task] = []
+
+
+async def startup_db_client():
+    # Índices em paralelo: uma espera de round trip em vez de ~20 em série
+    await asyncio.gather(
+        text_codec.load(),
+        ensure_premium_key_indexes(),
+        db.key_pool.create_index('reserved_at', expireAfterSeconds=KEY_POOL_TTL_SECONDS),
+        db.admin_audit.create_index('at', expireAfterSeconds=AUDIT_TTL_DAYS * 24 * 3600),
+        *[db.admin_audit.create_index([(field, 1), ('_id', -1)]) for field in ('actor', 'keys', 'email', 'action')],
+        db.summary_chunks.create_index('created_at', expireAfterSeconds=CHUNK_CACHE_TTL_SECONDS),
+        db.deep_expansions.create_index('created_at', expireAfterSeconds=DEEP_CACHE_TTL_SECONDS),
+        db.pdf_pages.create_index('file_hash'),
+        db.pdf_pages.create_index('created_at', expireAfterSeconds=PDF_CACHE_TTL_SECONDS),
+        db.summary_cache.create_index('created_at', expireAfterSeconds=SUMMARY_CACHE_TTL_SECONDS),
+        db.quota_daily.create_index('created_at', expireAfterSeconds=QUOTA_TTL_SECONDS),
+        db.upstream_cooldowns.create_index('until', expireAfterSeconds=0),
+        db.summary_history.create_index([('owner', 1), ('seq', 1)], unique=True),
+        db.webhook_inbox.create_index([('status', 1), ('next_attempt_at', 1)]),
+        db.idempotency_keys.create_index('created_at', expireAfterSeconds=IDEMPOTENCY_TTL_SECONDS),
+    )
+    await key_snapshot.start()
+    plan_stats.start()
+    if KEY_RESIDENCY:
+        await key_table.start()
+    key_reservoir.start()
+    audit_log.start()
+    quota_ledger.start()
+    upstream_cooldowns.start()
+    webhook_processor.start()
+    # Aquecimento de caches fora do caminho do primeiro request: até a primeira passada
+    # terminar, só não há acertos por quase-duplicata nem busca no histórico antigo
+    near_dup_index.start()
+    _warmup_tasks.append(asyncio.create_task(run_history_search_sync()))
 
 
-@api_router.post('/admin/keys/create', response_model=AdminCreateKeyResponse)
-async def admin_create_key(request: Request, body: AdminCreateKeyRequest):
-    _require_admin(request)
-    email = body.email.lower().strip()
-    days = body.days or 30
-    now = datetime.utcnow()
-    # Se já existir uma chave ativa não expirada para este e-mail, reutiliza
-    existing = await db.premium_keys.find_one({'email': email, 'status': 'active'})
-    if existing:
-        exp = existing.get('expires_at')
+async def shutdown_db_client():
+    for task in _warmup_tasks:
+        task.cancel()
+    _warmup_tasks.clear()
+    # Cada etapa roda mesmo que a anterior falhe: uma exceção no flush da cota não pode
+    # deixar o pool de PDF vivo nem o cliente Mongo aberto
+    for step in (quota_ledger.stop, upstream_cooldowns.stop, near_dup_index.stop, webhook_processor.stop,
+                 key_reservoir.stop, audit_log.stop, key_snapshot.stop, key_table.stop, plan_stats.stop,
+                 history_search_index.close, close_http_client, shutdown_pdf_pool, core.close_client):
         try:
-            if exp and isinstance(exp, str):
-                exp = datetime.fromisoformat(exp)
+            result = step()
+            if inspect.isawaitable(result):
+                await result
         except Exception:
-            exp = None
-        if exp and now < exp:
-            return AdminCreateKeyResponse(key=existing['key'], email=email, expires_at=exp)
-    # Cria nova
-    key_val = await ensure_unique_key()
-    expires_at = now + timedelta(days=days)
-    pk = PremiumKey(key=key_val, email=email, product_code=None, order_id=None, expires_at=expires_at)
-    await db.premium_keys.insert_one(pk.model_dump())
-    return AdminCreateKeyResponse(key=key_val, email=email, expires_at=expires_at)
-
-
-@api_router.post('/admin/keys/revoke', response_model=AdminRevokeKeyResponse)
-async def admin_revoke_keys(request: Request, body: AdminRevokeKeyRequest):
-    _require_admin(request)
-    # Precisamos de ao menos um critério
-    if not body.email and not body.key and not body.order_id:
-        raise HTTPException(status_code=400, detail='Informe email, key ou order_id')
-    filt: Dict[str, Any] = { 'status': 'active' }
-    if body.email:
-        filt['email'] = body.email.lower().strip()
-    if body.key:
-        filt['key'] = body.key.strip()
-    if body.order_id:
-        filt['order_id'] = body.order_id.strip()
-    result = await db.premium_keys.update_many(filt, { '$set': { 'status': 'revoked', 'updated_at': datetime.utcnow() } })
-    return AdminRevokeKeyResponse(revoked_count=result.modified_count)
-
-
-
-@api_router.post('/admin/keys/revoke_all', response_model=AdminRevokeKeyResponse)
-async def admin_revoke_all(request: Request):
-    _require_admin(request)
-    result = await db.premium_keys.update_many({'status': 'active'}, { '$set': { 'status': 'revoked', 'updated_at': datetime.utcnow() } })
-    return AdminRevokeKeyResponse(revoked_count=result.modified_count)
+            logger.exception('Falha no desligamento em %s', getattr(step, '__qualname__', step))
 
-# Include the router in the main app
-app.include_router(api_router)
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_credentials=True,
-    allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
-
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+@contextlib.asynccontextmanager
+async def lifespan(_app: FastAPI):
+    await startup_db_client()
+    try:
+        yield
+    finally:
+        await shutdown_db_client()
+
+
+def create_app(app_settings: Optional[AppSettings] = None) -> FastAPI:
+    if app_settings is not None:
+        core.use_settings(app_settings)
+    settings = core.settings
+    # Configure logging
+    logging.basicConfig(
+        level=settings.log_level,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    application = FastAPI(lifespan=lifespan)
+    # Include the router in the main app
+    application.include_router(api_router)
+    application.add_middleware(IdempotencyMiddleware)
+    application.add_middleware(ResponseCompressionMiddleware)
+    application.add_middleware(
+        CORSMiddleware,
+        allow_credentials=True,
+        allow_origins=settings.cors_origins,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    return application
+
+
+app = create_app()
@@ -0,0 +1,597 @@
+from fastapi import Request, HTTPException
+from pydantic import BaseModel, Field
+from typing import List, Optional, Dict, Any
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import os
+import hashlib
+import json
+import re
+import asyncio
+import logging
+
+import numpy as np
+
+from core import api_router, db, require_admin, sha256_hex
+from codec import text_codec
+from compaction import compact_input
+from quota import quota_ledger
+from text_utils import WORD_RE, estimate_tokens, split_into_chunks
+from upstream import UpstreamError, get_openrouter_key, or_with_fallback, upstream_plan
+from validation import resolve_plan
+
+logger = logging.getLogger(__name__)
+
+
+# ============ Resumo no servidor (map-reduce) ============
+# Espelha os prompts de background.js, mas sem o corte em 50000 caracteres:
+# textos longos são divididos em trechos, resumidos em paralelo e reduzidos.
+
+DETAIL_MAX_TOKENS = {'short': 600, 'medium': 900, 'long': 1400, 'profundo': 2200}
+
+# Orçamentos em tokens estimados (~4 caracteres por token)
+MAPREDUCE_SINGLE_PASS_TOKENS = int(os.environ.get('MAPREDUCE_SINGLE_PASS_TOKENS', '12000'))
+MAPREDUCE_CHUNK_TOKENS = int(os.environ.get('MAPREDUCE_CHUNK_TOKENS', '6000'))
+MAPREDUCE_CONCURRENCY = int(os.environ.get('MAPREDUCE_CONCURRENCY', '4'))
+MAPREDUCE_PARTIAL_MAX_TOKENS = int(os.environ.get('MAPREDUCE_PARTIAL_MAX_TOKENS', '700'))
+CHUNK_CACHE_TTL_SECONDS = int(os.environ.get('CHUNK_CACHE_TTL_SECONDS', str(7 * 24 * 3600)))
+
+
+class SummarySettings(BaseModel):
+    language: str = 'pt'
+    detail_level: str = 'medium'  # short | medium | long | profundo
+    persona: str = ''
+
+class SummarizeRequest(BaseModel):
+    text: str
+    source: str = 'web'  # web | pdf
+    file_name: Optional[str] = None
+    url: Optional[str] = Field(default=None, max_length=2048)  # página de origem; o boilerplate é aprendido por site
+    settings: SummarySettings = Field(default_factory=SummarySettings)
+    mode: str = 'auto'  # auto | mapreduce
+    openrouter_key: Optional[str] = None
+    key: Optional[str] = None  # KEY de assinatura, define a fila (premium/free)
+    device_id: Optional[str] = Field(default=None, min_length=8, max_length=128)  # obrigatório fora do Premium (cota diária)
+    compact: bool = True
+    tz_offset_minutes: int = Field(default=0, ge=-14 * 60, le=14 * 60)  # Date.getTimezoneOffset() do navegador
+
+class SummarizeResponse(BaseModel):
+    summary: str
+    title: Optional[str] = None
+    model: Optional[str] = None
+    mode: str
+    chunks: int = 1
+    cached_chunks: int = 0
+    cache: Optional[str] = None  # exact | near
+    similarity: Optional[float] = None
+    compaction: Optional[Dict[str, int]] = None
+
+
+def _language_name(settings: SummarySettings) -> str:
+    return 'português' if settings.language == 'pt' else 'inglês'
+
+
+def _system_prompt(settings: SummarySettings) -> str:
+    persona = settings.persona.strip()
+    if persona:
+        return f'Você é um assistente de resumo. Mantenha o TOM/ESTILO indicado, mas NÃO aumente a complexidade/tamanho além do nível de detalhe selecionado: {persona}. Siga as regras de formatação.'
+    return 'Você é um assistente de resumo que retorna lista numerada com tópicos curtos e subitens quando necessário.'
+
+
+def build_summary_instructions(text: str, settings: SummarySettings, inline_expansions: bool = True) -> str:
+    level = settings.detail_level.lower()
+    detail_prompt = {
+        'short': 'Crie um resumo muito breve (máximo 3 pontos principais).',
+        'medium': 'Crie um resumo conciso com os pontos principais (5-7 pontos).',
+        'long': 'Crie um resumo detalhado e abrangente, incluindo seções e subtópicos relevantes.',
+        'profundo': 'Crie um resumo EXTREMAMENTE PROFUNDO, LONGO e PRECISO. Estruture em seções claras: (1) Contexto e objetivo; (2) Metodologia (amostra, desenho, instrumentos, análises); (3) Resultados (com números‑chave); (4) Discussão (interpretações e limitações); (5) Implicações práticas e teóricas; (6) Conclusões; (7) Palavras‑chave.',
+    }.get(level, '')
+    persona = settings.persona.strip()
+    style_line = f'\nAdote apenas o TOM/ESTILO a seguir, sem aumentar profundidade além do nível escolhido: {persona}.' if persona else ''
+    default_rules = ('\n\nRegras de formatação (siga exatamente):\n1) Produza de 3 a 8 pontos principais como lista numerada (1., 2., 3., ...)\n'
+                     '2) Em cada item, comece com um tópico curto (3–8 palavras), seguido de dois pontos e, em seguida, uma explicação breve em uma única frase\n'
+                     '3) Quando for útil, adicione 1–3 subitens iniciados com "- " (hífen e espaço), cada um curto\n'
+                     '4) Não use markdown com **asteriscos**, títulos ou blocos de código\n'
+                     '5) Não envolva a resposta em blocos de código; retorne apenas texto simples estruturado')
+    deep_rules = ('\n\nRegras do modo PROFUNDO (siga exatamente):\nA) Primeiro, liste os pontos principais como em uma lista numerada (1., 2., 3., ...), podendo incluir subitens com "- ".\n'
+                  'B) EM SEGUIDA, crie uma seção chamada EXPANSÕES e EXPANDA CADA SUBITEM listado anteriormente com 1–2 parágrafos explicativos, baseados no texto, com números, exemplos e nuances quando existirem.\n'
+                  'C) NÃO invente dados; se não houver números disponíveis, explique qualitativamente.\n'
+                  'D) Mantenha o tom/persona definidos sem aumentar a profundidade além do nível PROFUNDO.\n'
+                  'E) Retorne apenas texto simples (sem markdown de títulos), usando a etiqueta literal "EXPANSÕES:" para iniciar a parte de aprofundamento.')
+    if not inline_expansions:
+        # Pipeline profundo: a primeira passada só produz o esboço; as expansões vêm depois, em paralelo
+        deep_rules = ('\n\nRegras do modo PROFUNDO (siga exatamente):\nA) Liste os pontos principais como uma lista numerada (1., 2., 3., ...), com 2–4 subitens iniciados com "- " em cada item.\n'
+                      'B) NÃO escreva a seção EXPANSÕES; ela será gerada separadamente.\n'
+                      'C) NÃO invente dados; se não houver números disponíveis, explique qualitativamente.\n'
+                      'D) Mantenha o tom/persona definidos sem aumentar a profundidade além do nível PROFUNDO.\n'
+                      'E) Retorne apenas texto simples (sem markdown de títulos).')
+    rules = deep_rules if level == 'profundo' else default_rules
+    return f'{detail_prompt} do seguinte texto em {_language_name(settings)}.{style_line}{rules}\n\nTexto a resumir:\n{text}'
+
+
+def build_pdf_instructions(text: str, settings: SummarySettings, inline_expansions: bool = True) -> str:
+    deep = settings.detail_level.lower() == 'profundo'
+    persona = settings.persona.strip()
+    style_line = f'\nInstrua-se a escrever exatamente no seguinte estilo/persona (sem quebrar as regras de formatação): {persona}.' if persona else ''
+    base = f'Você receberá o conteúdo textual de um arquivo PDF. Gere:\n- TITLE: um título curto (no máximo 10 palavras), sem aspas/markdown\n- SUMMARY: um resumo estruturado conforme regras abaixo{style_line}'
+    if deep and not inline_expansions:
+        rules = '\n\nRegras do SUMMARY no modo PROFUNDO:\n1) Itens numerados (1., 2., ...), cada um com 2–4 subitens iniciados com "- "\n2) NÃO escreva a seção EXPANSÕES; ela será gerada separadamente'
+    elif deep:
+        rules = '\n\nRegras do SUMMARY no modo PROFUNDO:\n1) Faça como acima (itens numerados, subitens com "- ")\n2) Depois, crie a seção EXPANSÕES e expanda cada subitem com 1–2 parágrafos detalhados, sem inventar dados'
+    else:
+        rules = '\n\nRegras do SUMMARY (siga exatamente):\n1) 3 a 8 itens numerados (1., 2., ...)\n2) Cada item: um tópico curto (3–8 palavras) seguido de dois pontos e uma frase breve\n3) Subitens opcionais iniciados com "- " (1–3)'
+    fmt = '\n\nResponda estritamente neste formato:\nTITLE: <título curto>\nSUMMARY:\n1. <tópico curto>: <frase>\n- <subitem opcional>\n2. ...'
+    if deep and inline_expansions:
+        fmt += '\n\nEXPANSÕES:\n<expansões de cada subitem>'
+    return f'{base}{rules}{fmt}\n\nConteúdo:\n{text}'
+
+
+def parse_pdf_title_summary(out: str) -> Dict[str, Optional[str]]:
+    title = None
+    summary = None
+    lines = out.splitlines()
+    for i, raw in enumerate(lines):
+        line = raw.strip()
+        if line.upper().startswith('TITLE:'):
+            title = line[6:].strip()
+        if line.upper().startswith('SUMMARY:'):
+            summary = '\n'.join(lines[i + 1:]).strip()
+            break
+    return {'title': title, 'summary': summary or out}
+
+
+def _settings_key(settings: SummarySettings) -> str:
+    return json.dumps({'persona': settings.persona.strip(), 'language': settings.language, 'detail': settings.detail_level.lower()}, sort_keys=True)
+
+
+async def _cached_partial(kind: str, text: str, prompt: str, settings: SummarySettings, api_key: str, stats: Dict[str, int]) -> str:
+    # Cache por hash do trecho: reexecuções e documentos sobrepostos reaproveitam o trabalho
+    cache_id = sha256_hex(f'{kind}|{_settings_key(settings)}|{text}')
+    hit = await db.summary_chunks.find_one({'_id': cache_id}, {'summary': 1})
+    if hit:
+        stats['cached_chunks'] += 1
+        return await text_codec.inflate(hit['summary'])
+    messages = [{'role': 'system', 'content': _system_prompt(settings)}, {'role': 'user', 'content': prompt}]
+    r = await or_with_fallback(messages, MAPREDUCE_PARTIAL_MAX_TOKENS, api_key)
+    await db.summary_chunks.update_one(
+        {'_id': cache_id},
+        {'$set': {'summary': text_codec.pack(r['text']), 'model': r['model'], 'created_at': datetime.utcnow()}},
+        upsert=True,
+    )
+    return r['text']
+
+
+async def _map_chunks(kind: str, texts: List[str], make_prompt, settings: SummarySettings, api_key: str, stats: Dict[str, int]) -> List[str]:
+    sem = asyncio.Semaphore(MAPREDUCE_CONCURRENCY)
+    inflight: Dict[str, asyncio.Task] = {}
+
+    async def run(t: str) -> str:
+        async with sem:
+            return await _cached_partial(kind, t, make_prompt(t), settings, api_key, stats)
+
+    # Trechos idênticos dentro do mesmo documento compartilham a mesma chamada
+    tasks = []
+    for t in texts:
+        if t not in inflight:
+            inflight[t] = asyncio.ensure_future(run(t))
+        tasks.append(inflight[t])
+    try:
+        return list(await asyncio.gather(*tasks))
+    except BaseException:
+        for task in inflight.values():
+            task.cancel()
+        raise
+
+
+def _map_prompt(settings: SummarySettings):
+    def make(chunk: str) -> str:
+        return (f'O trecho abaixo faz parte de um documento longo. Extraia, em {_language_name(settings)}, os fatos, números, argumentos e conclusões '
+                f'importantes deste trecho em tópicos curtos, sem introduções e sem inventar dados.\n\nTrecho:\n{chunk}')
+    return make
+
+
+def _combine_prompt(settings: SummarySettings):
+    def make(partials: str) -> str:
+        return (f'Os textos abaixo são resumos parciais, em ordem, de partes consecutivas de um documento longo. Combine-os em {_language_name(settings)} '
+                f'em um único conjunto de tópicos, eliminando repetições e preservando números e conclusões.\n\nResumos parciais:\n{partials}')
+    return make
+
+
+def _group_by_budget(parts: List[str], max_tokens: int) -> List[str]:
+    groups: List[str] = []
+    cur: List[str] = []
+    cur_tokens = 0
+    for p in parts:
+        t = estimate_tokens(p)
+        if cur and cur_tokens + t > max_tokens:
+            groups.append('\n\n'.join(cur))
+            cur, cur_tokens = [], 0
+        cur.append(p)
+        cur_tokens += t
+    if cur:
+        groups.append('\n\n'.join(cur))
+    return groups
+
+
+async def summarize_document(req: SummarizeRequest, api_key: str) -> SummarizeResponse:
+    settings = req.settings
+    from_pdf = req.source == 'pdf'
+    stats = {'cached_chunks': 0}
+    text = req.text
+    mode = 'single'
+    n_chunks = 1
+    if req.mode == 'mapreduce' or estimate_tokens(text) > MAPREDUCE_SINGLE_PASS_TOKENS:
+        mode = 'mapreduce'
+        chunks = split_into_chunks(text, MAPREDUCE_CHUNK_TOKENS)
+        n_chunks = len(chunks)
+        partials = await _map_chunks('map', chunks, _map_prompt(settings), settings, api_key, stats)
+        # Redução hierárquica até caber numa única chamada final
+        while True:
+            groups = _group_by_budget(partials, MAPREDUCE_CHUNK_TOKENS)
+            if len(groups) == 1:
+                break
+            partials = await _map_chunks('reduce', groups, _combine_prompt(settings), settings, api_key, stats)
+        text = 'Resumos parciais, em ordem, de um documento longo:\n\n' + groups[0]
+    deep = settings.detail_level.lower() == 'profundo'
+    if from_pdf:
+        prompt = build_pdf_instructions(text, settings, inline_expansions=not deep)
+    else:
+        prompt = build_summary_instructions(text, settings, inline_expansions=not deep)
+    messages = [{'role': 'system', 'content': _system_prompt(settings)}, {'role': 'user', 'content': prompt}]
+    max_tokens = DETAIL_MAX_TOKENS.get(settings.detail_level.lower(), 1000)
+    r = await or_with_fallback(messages, max_tokens, api_key)
+    title = None
+    summary = r['text']
+    if from_pdf:
+        parsed = parse_pdf_title_summary(r['text'])
+        title = parsed['title'] or req.file_name or 'Documento PDF'
+        summary = parsed['summary']
+    if deep:
+        # As expansões consultam a fonte, não os resumos parciais do map-reduce
+        summary = await expand_deep_summary(summary, req.text, settings, api_key)
+    return SummarizeResponse(summary=summary, title=title, model=r['model'], mode=mode, chunks=n_chunks, cached_chunks=stats['cached_chunks'])
+
+
+# ============ Modo profundo: expansões em paralelo ============
+# Em vez de uma segunda chamada serial gigante, cada subitem do esboço é expandido
+# numa chamada própria, com teto de concorrência e cache por (subitem, fonte).
+
+DEEP_EXPAND_CONCURRENCY = int(os.environ.get('DEEP_EXPAND_CONCURRENCY', '6'))
+DEEP_EXPANSION_MAX_TOKENS = int(os.environ.get('DEEP_EXPANSION_MAX_TOKENS', '600'))
+DEEP_CONTEXT_TOKENS = int(os.environ.get('DEEP_CONTEXT_TOKENS', '3000'))
+DEEP_CACHE_TTL_SECONDS = int(os.environ.get('DEEP_CACHE_TTL_SECONDS', str(7 * 24 * 3600)))
+
+_ITEM_RE = re.compile(r'^\s*(\d+)[.)]\s+(.+)$')
+_SUBITEM_RE = re.compile(r'^\s*[-•]\s+(.+)$')
+_EXPANSIONS_RE = re.compile(r'\bEXPANSÕES\s*:', re.IGNORECASE)
+
+
+def parse_outline(text: str) -> List[tuple]:
+    # [(item, [subitens])] na ordem em que aparecem
+    outline: List[tuple] = []
+    for line in text.splitlines():
+        if _EXPANSIONS_RE.search(line):
+            break
+        m = _ITEM_RE.match(line)
+        if m:
+            outline.append((m.group(2).strip(), []))
+            continue
+        m = _SUBITEM_RE.match(line)
+        if m and outline:
+            outline[-1][1].append(m.group(1).strip())
+    return outline
+
+
+def _relevant_context(source: str, query: str, max_tokens: int) -> str:
+    # Trechos da fonte com maior sobreposição de palavras com o subitem, na ordem original
+    if estimate_tokens(source) <= max_tokens:
+        return source
+    pieces = split_into_chunks(source, 300)
+    q = set(WORD_RE.findall(query.lower()))
+    scored = sorted(range(len(pieces)), key=lambda i: -len(q & set(WORD_RE.findall(pieces[i].lower()))))
+    chosen, used = [], 0
+    for i in scored:
+        t = estimate_tokens(pieces[i])
+        if used + t > max_tokens:
+            continue
+        chosen.append(i)
+        used += t
+    return '\n\n'.join(pieces[i] for i in sorted(chosen))
+
+
+async def _expand_subitem(item: str, subitem: str, source: str, source_hash: str, settings: SummarySettings, api_key: str) -> str:
+    cache_id = sha256_hex(f'{_settings_key(settings)}|{source_hash}|{item}|{subitem}')
+    hit = await db.deep_expansions.find_one({'_id': cache_id}, {'text': 1})
+    if hit:
+        return await text_codec.inflate(hit['text'])
+    prompt = (f'Com base no texto-fonte, expanda o subitem abaixo com 1–2 parágrafos explicativos em {_language_name(settings)}, '
+              f'com números, exemplos e nuances quando existirem. NÃO invente dados; se não houver números, explique qualitativamente. '
+              f'Não repita o subitem e não use markdown.\n\nItem: {item}\nSubitem: {subitem}\n\nTexto-fonte:\n{_relevant_context(source, item + " " + subitem, DEEP_CONTEXT_TOKENS)}')
+    messages = [{'role': 'system', 'content': _system_prompt(settings)}, {'role': 'user', 'content': prompt}]
+    r = await or_with_fallback(messages, DEEP_EXPANSION_MAX_TOKENS, api_key)
+    text = r['text'].strip()
+    await db.deep_expansions.update_one({'_id': cache_id}, {'$set': {'text': text_codec.pack(text), 'model': r['model'], 'created_at': datetime.utcnow()}}, upsert=True)
+    return text
+
+
+async def expand_deep_summary(summary: str, source: str, settings: SummarySettings, api_key: str) -> str:
+    if _EXPANSIONS_RE.search(summary):
+        return summary
+    outline = parse_outline(summary)
+    # Sem subitens, expande os próprios itens
+    targets = [(item, sub) for item, subs in outline for sub in subs] or [(item, item) for item, _ in outline]
+    if not targets:
+        return summary
+    source_hash = sha256_hex(source)
+    sem = asyncio.Semaphore(DEEP_EXPAND_CONCURRENCY)
+
+    async def run(item: str, sub: str) -> Optional[str]:
+        async with sem:
+            try:
+                return await _expand_subitem(item, sub, source, source_hash, settings, api_key)
+            except UpstreamError:
+                return None
+
+    expansions = await asyncio.gather(*(run(item, sub) for item, sub in targets))
+    blocks = [f'- {sub}\n{exp}' for (_, sub), exp in zip(targets, expansions) if exp]
+    if not blocks:
+        return summary
+    return summary.rstrip() + '\n\nEXPANSÕES:\n' + '\n\n'.join(blocks)
+
+
+@api_router.post('/summarize', response_model=SummarizeResponse)
+async def summarize(req: SummarizeRequest):
+    if not req.text or len(req.text) < 50:
+        raise HTTPException(status_code=400, detail='Conteúdo insuficiente para gerar resumo')
+    plan = await resolve_plan(req.key)
+    if plan != 'premium' and req.settings.detail_level.lower() == 'profundo':
+        # Modo profundo é exclusivo do Premium, como em background.js
+        req = req.model_copy(update={'settings': req.settings.model_copy(update={'detail_level': 'long'})})
+    quota_day = None
+    if plan != 'premium':
+        # Sem device_id não há como contar a cota: omitir não pode virar uso ilimitado
+        if not req.device_id:
+            raise HTTPException(status_code=400, detail='device_id é obrigatório fora do plano Premium')
+        quota = await quota_ledger.consume(req.device_id, req.tz_offset_minutes)
+        if not quota.allowed:
+            raise HTTPException(status_code=429, detail=quota.error)
+        quota_day = quota.day
+    try:
+        # O cache é indexado pelo texto original: a compactação depende do que o modelo
+        # de boilerplate já aprendeu e mudaria a chave entre duas visitas iguais
+        cached = await summary_cache_lookup(req)
+        if cached:
+            return cached
+        compaction = None
+        work = req
+        if req.compact:
+            compacted, compaction = await asyncio.to_thread(compact_input, req.text, req.settings.detail_level, req.url)
+            work = req.model_copy(update={'text': compacted})
+        api_key = get_openrouter_key(req.openrouter_key)
+        upstream_plan.set(plan)
+        try:
+            result = await summarize_document(work, api_key)
+        except UpstreamError as e:
+            headers = {'Retry-After': str(e.retry_after)} if e.retry_after else None
+            raise HTTPException(status_code=e.status if e.status in (401, 403, 429) else 503, detail=str(e), headers=headers)
+    except BaseException:
+        # Só resumos bem-sucedidos contam na cota, como em registerSuccessUsage
+        if quota_day:
+            quota_ledger.refund(req.device_id, quota_day)
+        raise
+    await summary_cache_store(req, result)
+    result.compaction = compaction
+    return result
+
+
+# ============ Cache de resumos com detecção de quase-duplicatas ============
+# O cache exato (hash do texto) falha quando a página muda só um horário, um anúncio
+# ou uma contagem de comentários. Cada entrada guarda também uma assinatura SimHash
+# de 64 bits; um índice LSH por faixas de bits encontra candidatos parecidos. Cada
+# processo mantém o próprio índice e puxa periodicamente o que os outros gravaram.
+
+SUMMARY_CACHE_TTL_SECONDS = int(os.environ.get('SUMMARY_CACHE_TTL_SECONDS', str(24 * 3600)))
+NEAR_DUP_THRESHOLD = float(os.environ.get('NEAR_DUP_THRESHOLD', '0.92'))
+NEAR_DUP_MAX_ENTRIES = int(os.environ.get('NEAR_DUP_MAX_ENTRIES', '200000'))
+NEAR_DUP_SYNC_SECONDS = float(os.environ.get('NEAR_DUP_SYNC_SECONDS', '10'))
+NEAR_DUP_SYNC_OVERLAP = timedelta(seconds=5)  # created_at de outro processo pode chegar um pouco atrasado
+NEAR_DUP_SHINGLE = 3
+SIMHASH_BITS = 64
+
+
+def simhash_signature(text: str) -> int:
+    tokens = WORD_RE.findall(text.lower())
+    if not tokens:
+        return 0
+    # Hash só dos tokens distintos; o resto é vetorizado
+    uniq, inv = np.unique(np.array(tokens), return_inverse=True)
+    uniq_hashes = np.fromiter(
+        (int.from_bytes(hashlib.blake2b(t.encode('utf-8'), digest_size=8).digest(), 'little') for t in uniq),
+        dtype=np.uint64, count=len(uniq),
+    )
+    h = uniq_hashes[inv.reshape(-1)]
+    k = min(NEAR_DUP_SHINGLE, len(h))
+    n = len(h) - k + 1
+    with np.errstate(over='ignore'):
+        sh = np.zeros(n, dtype=np.uint64)
+        for j in range(k):
+            sh = (sh * np.uint64(0x100000001B3)) ^ h[j:j + n]
+        # Finalizador splitmix64 para espalhar os bits
+        sh ^= sh >> np.uint64(30)
+        sh *= np.uint64(0xBF58476D1CE4E5B9)
+        sh ^= sh >> np.uint64(27)
+        sh *= np.uint64(0x94D049BB133111EB)
+        sh ^= sh >> np.uint64(31)
+    sh = np.unique(sh)
+    counts = np.zeros(SIMHASH_BITS, dtype=np.int64)
+    for start in range(0, len(sh), 65536):
+        block = sh[start:start + 65536]
+        bits = np.unpackbits(block.view(np.uint8).reshape(-1, 8), axis=1, bitorder='little')
+        counts += bits.sum(axis=0, dtype=np.int64)
+    mask = (counts * 2 > len(sh)).astype(np.uint8)
+    return int.from_bytes(np.packbits(mask, bitorder='little').tobytes(), 'little')
+
+
+def _to_int64(v: int) -> int:
+    # Mongo só guarda inteiros com sinal
+    return v - (1 << 64) if v >= (1 << 63) else v
+
+
+class NearDuplicateIndex:
+    def __init__(self, threshold: float, max_entries: int):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        max_diff = int((1 - threshold) * SIMHASH_BITS)
+        # Com max_diff+1 faixas, duas assinaturas a até max_diff bits compartilham ao menos uma faixa
+        self.bands = max_diff + 1
+        self.band_bits = SIMHASH_BITS // self.bands
+        self.entries: 'OrderedDict[str, tuple]' = OrderedDict()  # id -> (scope, signature)
+        self.buckets: Dict[tuple, set] = {}
+        self.lookups = 0
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.similarity_hist = [0] * 20  # faixas de 0.05 da melhor similaridade encontrada
+        self.last_seen: Optional[datetime] = None  # maior created_at já puxado de summary_cache
+        self.synced_at: Optional[datetime] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _band_keys(self, scope: str, sig: int):
+        mask = (1 << self.band_bits) - 1
+        return [(scope, b, (sig >> (b * self.band_bits)) & mask) for b in range(self.bands)]
+
+    def add(self, entry_id: str, scope: str, sig: int):
+        if entry_id in self.entries:
+            self.entries.move_to_end(entry_id)
+            return
+        self.entries[entry_id] = (scope, sig)
+        for bk in self._band_keys(scope, sig):
+            self.buckets.setdefault(bk, set()).add(entry_id)
+        while len(self.entries) > self.max_entries:
+            self.remove(next(iter(self.entries)))
+
+    def remove(self, entry_id: str):
+        entry = self.entries.pop(entry_id, None)
+        if not entry:
+            return
+        for bk in self._band_keys(*entry):
+            bucket = self.buckets.get(bk)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self.buckets[bk]
+
+    def best_match(self, scope: str, sig: int):
+        candidates = set()
+        for bk in self._band_keys(scope, sig):
+            candidates |= self.buckets.get(bk, set())
+        best_id, best_sim = None, 0.0
+        for cid in candidates:
+            sim = 1 - bin(self.entries[cid][1] ^ sig).count('1') / SIMHASH_BITS
+            if sim > best_sim:
+                best_id, best_sim = cid, sim
+        if best_id is not None:
+            self.similarity_hist[min(int(best_sim * 20), 19)] += 1
+        return best_id, best_sim
+
+    async def sync(self):
+        # Primeira passada carrega as entradas mais novas; depois só created_at > last_seen
+        filt = {'created_at': {'$gt': self.last_seen - NEAR_DUP_SYNC_OVERLAP}} if self.last_seen else {}
+        cursor = db.summary_cache.find(filt, {'scope': 1, 'simhash': 1, 'created_at': 1}).sort('created_at', -1).limit(self.max_entries)
+        docs = await cursor.to_list(self.max_entries)
+        # Mais antigos primeiro, para que a ordem de despejo siga a idade
+        for doc in reversed(docs):
+            if 'simhash' in doc and doc['_id'] not in self.entries:
+                self.add(doc['_id'], doc['scope'], doc['simhash'] & ((1 << 64) - 1))
+        if docs and (self.last_seen is None or docs[0]['created_at'] > self.last_seen):
+            self.last_seen = docs[0]['created_at']
+        self.synced_at = datetime.utcnow()
+
+    async def _run(self):
+        while True:
+            try:
+                await self.sync()
+            except Exception:
+                logger.exception('Falha ao sincronizar o índice de quase-duplicatas')
+            await asyncio.sleep(NEAR_DUP_SYNC_SECONDS)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'entries': len(self.entries),
+            'synced_at': self.synced_at,
+            'threshold': self.threshold,
+            'lookups': self.lookups,
+            'exact_hits': self.exact_hits,
+            'near_hits': self.near_hits,
+            'misses': self.misses,
+            'near_hit_rate': self.near_hits / self.lookups if self.lookups else 0.0,
+            'similarity_histogram': {f'{i / 20:.2f}-{(i + 1) / 20:.2f}': c for i, c in enumerate(self.similarity_hist) if c},
+        }
+
+
+near_dup_index = NearDuplicateIndex(NEAR_DUP_THRESHOLD, NEAR_DUP_MAX_ENTRIES)
+
+
+def _cache_scope(req: SummarizeRequest) -> str:
+    # Só reaproveita entre pedidos com as mesmas configurações e mesma origem
+    return sha256_hex(f'{req.source}|{_settings_key(req.settings)}')[:16]
+
+
+def _cached_response(doc: Dict[str, Any], cache: str, similarity: float) -> SummarizeResponse:
+    return SummarizeResponse(summary=text_codec.unpack(doc['summary']), title=doc.get('title'), model=doc.get('model'),
+                             mode=doc.get('mode', 'single'), chunks=doc.get('chunks', 1),
+                             cache=cache, similarity=similarity)
+
+
+async def summary_cache_lookup(req: SummarizeRequest) -> Optional[SummarizeResponse]:
+    scope = _cache_scope(req)
+    exact_id = sha256_hex(f'{scope}|{req.text}')
+    near_dup_index.lookups += 1
+    doc = await db.summary_cache.find_one({'_id': exact_id})
+    if doc:
+        near_dup_index.exact_hits += 1
+        await text_codec.prepare([doc])
+        return _cached_response(doc, 'exact', 1.0)
+    sig = await asyncio.to_thread(simhash_signature, req.text)
+    best_id, sim = near_dup_index.best_match(scope, sig)
+    if best_id and sim >= near_dup_index.threshold:
+        doc = await db.summary_cache.find_one({'_id': best_id})
+        if doc:
+            near_dup_index.near_hits += 1
+            await text_codec.prepare([doc])
+            return _cached_response(doc, 'near', round(sim, 4))
+        near_dup_index.remove(best_id)  # expirou pelo TTL
+    near_dup_index.misses += 1
+    return None
+
+
+async def summary_cache_store(req: SummarizeRequest, result: SummarizeResponse):
+    scope = _cache_scope(req)
+    entry_id = sha256_hex(f'{scope}|{req.text}')
+    sig = await asyncio.to_thread(simhash_signature, req.text)
+    await db.summary_cache.update_one({'_id': entry_id}, {'$set': {
+        'scope': scope,
+        'simhash': _to_int64(sig),
+        'summary': text_codec.pack(result.summary),
+        'title': result.title,
+        'model': result.model,
+        'mode': result.mode,
+        'chunks': result.chunks,
+        'created_at': datetime.utcnow(),
+    }}, upsert=True)
+    near_dup_index.add(entry_id, scope, sig)
+
+
+@api_router.get('/admin/cache/stats')
+async def admin_cache_stats(request: Request):
+    require_admin(request)
+    return near_dup_index.stats()
@@ -0,0 +1,51 @@
+from typing import List
+import re
+
+
+# ============ Texto ============
+# Estimativa de tokens (~4 caracteres por token) e cortes por parágrafo/frase,
+# compartilhados por resumo, compactação, cache e busca.
+
+def estimate_tokens(text: str) -> int:
+    return (len(text) + 3) // 4
+
+
+PARAGRAPH_RE = re.compile(r'\n\s*\n')
+SENTENCE_RE = re.compile(r'(?<=[.!?…])\s+')
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def split_into_chunks(text: str, max_tokens: int) -> List[str]:
+    # Quebra por parágrafos; parágrafos grandes demais por frases; frases gigantes em cortes fixos
+    pieces: List[tuple] = []  # (separador, trecho)
+    for para in PARAGRAPH_RE.split(text):
+        para = para.strip()
+        if not para:
+            continue
+        if estimate_tokens(para) <= max_tokens:
+            pieces.append(('\n\n', para))
+            continue
+        sep = '\n\n'
+        for sent in SENTENCE_RE.split(para):
+            sent = sent.strip()
+            if not sent:
+                continue
+            if estimate_tokens(sent) <= max_tokens:
+                pieces.append((sep, sent))
+            else:
+                step = max_tokens * 4
+                pieces.extend((sep, sent[i:i + step]) for i in range(0, len(sent), step))
+            sep = ' '
+    chunks: List[str] = []
+    cur = ''
+    for sep, piece in pieces:
+        # Mede o trecho já unido: somar as estimativas de cada pedaço deixava de fora
+        # os separadores e acumulava o arredondamento, estourando o orçamento
+        joined = f'{cur}{sep}{piece}' if cur else piece
+        if cur and estimate_tokens(joined) > max_tokens:
+            chunks.append(cur)
+            joined = piece
+        cur = joined
+    if cur:
+        chunks.append(cur)
+    return chunks
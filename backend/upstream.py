@@ -0,0 +1,475 @@
+from fastapi import Request, HTTPException
+from typing import List, Optional, Dict, Any
+from collections import deque
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+import os
+import logging
+import hashlib
+import asyncio
+import contextlib
+import contextvars
+import math
+import time
+
+import httpx
+
+from core import api_router, db, require_admin
+
+logger = logging.getLogger(__name__)
+
+
+# ============ Chamadas à OpenRouter ============
+# Cliente HTTP compartilhado, fallback entre modelos gratuitos e tudo que limita o
+# ritmo das chamadas (cooldowns compartilhados e agendador).
+
+OR_URL = 'https://openrouter.ai/api/v1/chat/completions'
+PRIMARY_MODEL = 'deepseek/deepseek-r1:free'
+FALLBACK_MODELS = [
+    'meta-llama/llama-3.3-70b-instruct:free',
+    'deepseek/deepseek-chat-v3-0324:free',
+    'qwen/qwen3-coder:free',
+    'tngtech/deepseek-r1t2-chimera:free',
+    'google/gemini-2.0-flash-exp:free',
+    'openai/gpt-oss-20b:free',
+    'deepseek/deepseek-r1-distill-llama-70b:free',
+]
+
+_http_client = None
+
+
+class UpstreamError(Exception):
+    def __init__(self, message: str, status: Optional[int] = None, retry_after: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class SchedulerRejected(UpstreamError):
+    # Fila cheia ou prazo de espera estourado: é o nosso próprio limite de carga, não
+    # falha do modelo; tentar o próximo modelo só empilharia mais espera
+    pass
+
+
+def get_http_client():
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(timeout=120)
+    return _http_client
+
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+def get_openrouter_key(user_key: Optional[str]) -> str:
+    key = (user_key or '').strip() or os.environ.get('OPENROUTER_API_KEY', '').strip()
+    if not key:
+        raise HTTPException(status_code=500, detail='OPENROUTER_API_KEY not configured')
+    return key
+
+
+def _should_fallback(err: UpstreamError) -> bool:
+    # Mesma política de orWithFallback em background.js
+    if isinstance(err, SchedulerRejected):
+        return False
+    s = err.status
+    if s in (401, 403):
+        return False
+    if s is None or s in (429, 503) or s >= 500:
+        return True
+    return False
+
+
+async def or_request(messages: List[Dict[str, str]], model: str, max_tokens: int, api_key: str) -> Dict[str, str]:
+    headers = {
+        'Authorization': f'Bearer {api_key}',
+        'Content-Type': 'application/json',
+        'X-Title': 'Auto-Summarizer OR',
+    }
+    body = {'model': model, 'messages': messages, 'temperature': 0.7, 'max_tokens': max_tokens}
+    async with upstream_scheduler.slot(model, upstream_plan.get()):
+        try:
+            resp = await get_http_client().post(OR_URL, headers=headers, json=body)
+        except httpx.HTTPError as e:
+            raise UpstreamError(f'OpenRouter request failed: {e}') from e
+    if resp.status_code >= 400:
+        retry_after = _parse_retry_after(resp.headers.get('retry-after'))
+        if resp.status_code in (429, 503):
+            upstream_cooldowns.record(model, api_key, resp.status_code, retry_after, resp.text)
+        raise UpstreamError(f'OpenRouter API error: {resp.status_code} - {resp.text[:500]}', status=resp.status_code, retry_after=retry_after)
+    try:
+        out = resp.json()['choices'][0]['message']['content']
+    except Exception:
+        out = None
+    if not out:
+        raise UpstreamError('Resposta inválida da OpenRouter')
+    return {'text': out, 'model': model}
+
+
+async def or_with_fallback(messages: List[Dict[str, str]], max_tokens: int, api_key: str) -> Dict[str, str]:
+    last_error: Optional[UpstreamError] = None
+    key_wait = upstream_cooldowns.key_remaining(api_key)
+    if key_wait:
+        raise UpstreamError(f'Serviço temporariamente indisponível. Aguarde {key_wait}s.', status=429, retry_after=key_wait)
+    tried = 0
+    for model in [PRIMARY_MODEL, *FALLBACK_MODELS]:
+        # Modelos em cooldown são pulados sem gastar uma chamada
+        if upstream_cooldowns.model_remaining(model, api_key):
+            continue
+        tried += 1
+        try:
+            return await or_request(messages, model, max_tokens, api_key)
+        except UpstreamError as e:
+            if not _should_fallback(e):
+                raise
+            last_error = e
+    if not tried:
+        wait = upstream_cooldowns.min_model_remaining([PRIMARY_MODEL, *FALLBACK_MODELS], api_key)
+        raise UpstreamError(f'Serviço temporariamente indisponível. Aguarde {wait}s.', status=503, retry_after=wait)
+    raise UpstreamError('Serviço temporariamente indisponível após múltiplas tentativas. Tente novamente em instantes.',
+                        status=last_error.status if last_error else None,
+                        retry_after=upstream_cooldowns.min_model_remaining([PRIMARY_MODEL, *FALLBACK_MODELS], api_key) or None)
+
+
+@api_router.get('/admin/upstream/stats')
+async def admin_upstream_stats(request: Request):
+    require_admin(request)
+    return upstream_scheduler.stats()
+
+
+# ============ Cooldown upstream compartilhado ============
+# Antes cada navegador guardava openrouterCooldownUntil no próprio storage e só
+# descobria um 429 gastando uma chamada. Aqui um 429/503 (e o Retry-After) de
+# qualquer cliente protege todos: por modelo e por API key, replicado via Mongo
+# entre os workers. Só limites do modelo (503, 429 do provedor) esfriam o modelo
+# para todo mundo; um 429 da cota da key esfria só o par (modelo, key).
+
+UPSTREAM_DEFAULT_COOLDOWN_SECONDS = int(os.environ.get('UPSTREAM_DEFAULT_COOLDOWN_SECONDS', '20'))
+UPSTREAM_MAX_COOLDOWN_SECONDS = int(os.environ.get('UPSTREAM_MAX_COOLDOWN_SECONDS', '3600'))
+UPSTREAM_KEY_429_MODELS = int(os.environ.get('UPSTREAM_KEY_429_MODELS', '3'))
+UPSTREAM_COOLDOWN_SYNC_SECONDS = float(os.environ.get('UPSTREAM_COOLDOWN_SYNC_SECONDS', '5'))
+_KEY_LIMIT_MARKERS = ('per-day', 'per day', 'per-min', 'per min', 'free-models-per', 'credits')
+_MODEL_LIMIT_MARKERS = ('upstream', 'provider')
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[int]:
+    if not value:
+        return None
+    try:
+        return max(0, int(float(value)))
+    except ValueError:
+        pass
+    try:
+        return max(0, int(parsedate_to_datetime(value).timestamp() - time.time()))
+    except Exception:
+        return None
+
+
+def _key_id(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode()).hexdigest()[:12]
+
+
+def _model_wide_limit(status: int, detail: str) -> bool:
+    # Na dúvida o 429 é da key: esfriar o modelo por causa da cota de um usuário
+    # bloquearia todos os outros clientes
+    if status != 429:
+        return True
+    text = detail.lower()
+    if any(m in text for m in _KEY_LIMIT_MARKERS):
+        return False
+    return any(m in text for m in _MODEL_LIMIT_MARKERS)
+
+
+class UpstreamCooldowns:
+    def __init__(self):
+        self._clock = time.time
+        self.models: Dict[str, float] = {}  # modelo -> epoch até quando evitar
+        self.keys: Dict[str, float] = {}  # hash da API key -> epoch
+        self.pairs: Dict[str, float] = {}  # 'modelo|hash da key' -> epoch
+        self.recent_429: Dict[str, Dict[str, float]] = {}  # hash da key -> {modelo: epoch}
+        self.avoided_calls = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def _remaining(self, table: Dict[str, float], name: str) -> int:
+        until = table.get(name)
+        if not until:
+            return 0
+        left = until - self._clock()
+        if left <= 0:
+            table.pop(name, None)
+            return 0
+        return math.ceil(left)
+
+    def _model_left(self, model: str, api_key: str) -> int:
+        return max(self._remaining(self.models, model), self._remaining(self.pairs, f'{model}|{_key_id(api_key)}'))
+
+    def model_remaining(self, model: str, api_key: str) -> int:
+        left = self._model_left(model, api_key)
+        if left:
+            self.avoided_calls += 1
+        return left
+
+    def min_model_remaining(self, models: List[str], api_key: str) -> int:
+        lefts = [self._model_left(m, api_key) for m in models]
+        return min(lefts) if lefts else 0
+
+    def key_remaining(self, api_key: str) -> int:
+        left = self._remaining(self.keys, _key_id(api_key))
+        if left:
+            self.avoided_calls += 1
+        return left
+
+    def record(self, model: str, api_key: str, status: int, retry_after: Optional[int], detail: str = ''):
+        now = self._clock()
+        seconds = min(retry_after or UPSTREAM_DEFAULT_COOLDOWN_SECONDS, UPSTREAM_MAX_COOLDOWN_SECONDS)
+        until = now + seconds
+        if _model_wide_limit(status, detail):
+            self.models[model] = max(self.models.get(model, 0), until)
+            self._publish(f'model:{model}', until)
+            return
+        kid = _key_id(api_key)
+        pair = f'{model}|{kid}'
+        self.pairs[pair] = max(self.pairs.get(pair, 0), until)
+        self._publish(f'pair:{pair}', until)
+        # 429 em vários modelos com a mesma key (ou limite diário explícito) = limite da key
+        recent = {m: t for m, t in self.recent_429.get(kid, {}).items() if now - t < 60}
+        recent[model] = now
+        self.recent_429[kid] = recent
+        if len(recent) >= UPSTREAM_KEY_429_MODELS or 'per-day' in detail or 'per day' in detail:
+            self.keys[kid] = max(self.keys.get(kid, 0), until)
+            self._publish(f'key:{kid}', until)
+
+    def _publish(self, entry_id: str, until: float):
+        async def write():
+            try:
+                await db.upstream_cooldowns.update_one(
+                    {'_id': entry_id}, {'$max': {'until': datetime.utcfromtimestamp(until)}}, upsert=True)
+            except Exception:
+                logger.exception('Falha ao publicar cooldown upstream')
+        try:
+            asyncio.get_running_loop().create_task(write())
+        except RuntimeError:
+            pass
+
+    async def sync(self):
+        now = datetime.utcnow()
+        async for doc in db.upstream_cooldowns.find({'until': {'$gt': now}}):
+            kind, name = doc['_id'].split(':', 1)
+            table = {'model': self.models, 'key': self.keys, 'pair': self.pairs}.get(kind)
+            if table is None:
+                continue
+            until = (doc['until'] - datetime(1970, 1, 1)).total_seconds()
+            table[name] = max(table.get(name, 0), until)
+
+    async def _run(self):
+        while True:
+            try:
+                await self.sync()
+            except Exception:
+                logger.exception('Falha ao sincronizar cooldowns upstream')
+            await asyncio.sleep(UPSTREAM_COOLDOWN_SYNC_SECONDS)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def status(self) -> Dict[str, Any]:
+        models = {m: self._remaining(self.models, m) for m in list(self.models)}
+        keys = {k: self._remaining(self.keys, k) for k in list(self.keys)}
+        return {
+            'models': {m: s for m, s in models.items() if s},
+            'api_keys': {k: s for k, s in keys.items() if s},
+            'model_key_pairs': sum(1 for p in list(self.pairs) if self._remaining(self.pairs, p)),
+            'avoided_calls': self.avoided_calls,
+        }
+
+
+upstream_cooldowns = UpstreamCooldowns()
+
+
+@api_router.get('/upstream/status')
+async def upstream_status():
+    sched = upstream_scheduler.stats()
+    return {
+        'cooldowns': upstream_cooldowns.status(),
+        'queued': sched['queued'],
+        'active': sched['active'],
+        'checked_at': datetime.utcnow(),
+    }
+
+
+# ============ Agendador de chamadas à OpenRouter ============
+# Toda chamada upstream passa por aqui: teto global e por modelo, filas separadas
+# para premium e free com desenfileiramento ponderado, prazo máximo de espera e
+# rejeição antecipada com estimativa quando a fila está funda demais.
+
+UPSTREAM_GLOBAL_CONCURRENCY = int(os.environ.get('UPSTREAM_GLOBAL_CONCURRENCY', '16'))
+UPSTREAM_MODEL_CONCURRENCY = int(os.environ.get('UPSTREAM_MODEL_CONCURRENCY', '6'))
+UPSTREAM_PREMIUM_WEIGHT = int(os.environ.get('UPSTREAM_PREMIUM_WEIGHT', '3'))
+UPSTREAM_FREE_WEIGHT = int(os.environ.get('UPSTREAM_FREE_WEIGHT', '1'))
+UPSTREAM_MAX_QUEUE = int(os.environ.get('UPSTREAM_MAX_QUEUE', '200'))
+UPSTREAM_QUEUE_DEADLINE_SECONDS = float(os.environ.get('UPSTREAM_QUEUE_DEADLINE_SECONDS', '30'))
+
+
+upstream_plan: contextvars.ContextVar = contextvars.ContextVar('upstream_plan', default='free')
+
+
+class _Waiter:
+    __slots__ = ('future', 'model', 'enqueued_at')
+
+    def __init__(self, future: asyncio.Future, model: str, enqueued_at: float):
+        self.future = future
+        self.model = model
+        self.enqueued_at = enqueued_at
+
+
+class UpstreamScheduler:
+    CLASSES = ('premium', 'free')
+
+    def __init__(self, global_cap: int, model_cap: int, weights: Dict[str, int], max_queue: int, deadline: float):
+        self.global_cap = global_cap
+        self.model_cap = model_cap
+        self.weights = weights
+        self.max_queue = max_queue
+        self.deadline = deadline
+        self.queues = {c: deque() for c in self.CLASSES}
+        self.current = {c: 0 for c in self.CLASSES}  # round-robin ponderado suave
+        self.active = 0
+        self.active_by_model: Dict[str, int] = {}
+        self.avg_service = 5.0  # EWMA em segundos
+        self.avg_wait = {c: 0.0 for c in self.CLASSES}
+        self.served = {c: 0 for c in self.CLASSES}
+        self.rejected = {c: 0 for c in self.CLASSES}
+        self.expired = {c: 0 for c in self.CLASSES}
+
+    def _has_capacity(self, model: str) -> bool:
+        return self.active < self.global_cap and self.active_by_model.get(model, 0) < self.model_cap
+
+    def _grant(self, model: str):
+        self.active += 1
+        self.active_by_model[model] = self.active_by_model.get(model, 0) + 1
+
+    def _release(self, model: str, service_time: Optional[float]):
+        self.active -= 1
+        left = self.active_by_model.get(model, 1) - 1
+        if left:
+            self.active_by_model[model] = left
+        else:
+            self.active_by_model.pop(model, None)
+        if service_time is not None:
+            self.avg_service = 0.9 * self.avg_service + 0.1 * service_time
+        self._dispatch()
+
+    def _first_eligible(self, q) -> Optional[int]:
+        # Um modelo saturado não bloqueia quem está atrás esperando outro modelo
+        for i, w in enumerate(q):
+            if i >= 64:
+                break
+            if self.active_by_model.get(w.model, 0) < self.model_cap:
+                return i
+        return None
+
+    def _dispatch(self):
+        loop_now = asyncio.get_running_loop().time()
+        while self.active < self.global_cap:
+            eligible = {}
+            for c in self.CLASSES:
+                idx = self._first_eligible(self.queues[c])
+                if idx is not None:
+                    eligible[c] = idx
+            if not eligible:
+                return
+            total = sum(self.weights[c] for c in eligible)
+            for c in eligible:
+                self.current[c] += self.weights[c]
+            cls = max(eligible, key=lambda c: self.current[c])
+            self.current[cls] -= total
+            q = self.queues[cls]
+            waiter = q[eligible[cls]]
+            del q[eligible[cls]]
+            self._grant(waiter.model)
+            self.served[cls] += 1
+            self.avg_wait[cls] = 0.9 * self.avg_wait[cls] + 0.1 * (loop_now - waiter.enqueued_at)
+            waiter.future.set_result(None)
+
+    def estimate_wait(self, cls: str) -> float:
+        # Parcela da vazão que esta classe recebe quando as filas competem
+        busy = [c for c in self.CLASSES if self.queues[c] or c == cls]
+        share = self.weights[cls] / sum(self.weights[c] for c in busy)
+        ahead = len(self.queues[cls]) + 1
+        return ahead / (self.global_cap * share) * self.avg_service
+
+    def _class_for(self, plan: str) -> str:
+        return 'premium' if plan == 'premium' else 'free'
+
+    async def acquire(self, model: str, plan: str):
+        cls = self._class_for(plan)
+        if not any(self.queues.values()) and self._has_capacity(model):
+            self._grant(model)
+            self.served[cls] += 1
+            return
+        q = self.queues[cls]
+        eta = self.estimate_wait(cls)
+        if len(q) >= self.max_queue or eta > self.deadline:
+            self.rejected[cls] += 1
+            raise SchedulerRejected(f'Serviço sobrecarregado. Tente novamente em ~{math.ceil(eta)}s.', status=429, retry_after=math.ceil(eta))
+        loop = asyncio.get_running_loop()
+        waiter = _Waiter(loop.create_future(), model, loop.time())
+        q.append(waiter)
+        self._dispatch()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout=self.deadline)
+        except asyncio.TimeoutError:
+            if waiter.future.done():
+                return
+            q.remove(waiter)
+            self.expired[cls] += 1
+            retry = math.ceil(self.estimate_wait(cls))
+            raise SchedulerRejected(f'Tempo de espera na fila excedido. Tente novamente em ~{retry}s.', status=503, retry_after=retry)
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                self._release(model, None)
+            elif waiter in q:
+                q.remove(waiter)
+            raise
+
+    @contextlib.asynccontextmanager
+    async def slot(self, model: str, plan: str):
+        await self.acquire(model, plan)
+        started = asyncio.get_running_loop().time()
+        try:
+            yield
+        finally:
+            self._release(model, asyncio.get_running_loop().time() - started)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'active': self.active,
+            'active_by_model': dict(self.active_by_model),
+            'global_cap': self.global_cap,
+            'model_cap': self.model_cap,
+            'queued': {c: len(q) for c, q in self.queues.items()},
+            'served': dict(self.served),
+            'rejected': dict(self.rejected),
+            'expired': dict(self.expired),
+            'avg_service_seconds': round(self.avg_service, 3),
+            'avg_wait_seconds': {c: round(v, 3) for c, v in self.avg_wait.items()},
+        }
+
+
+upstream_scheduler = UpstreamScheduler(
+    UPSTREAM_GLOBAL_CONCURRENCY,
+    UPSTREAM_MODEL_CONCURRENCY,
+    {'premium': UPSTREAM_PREMIUM_WEIGHT, 'free': UPSTREAM_FREE_WEIGHT},
+    UPSTREAM_MAX_QUEUE,
+    UPSTREAM_QUEUE_DEADLINE_SECONDS,
+)
@@ -0,0 +1,288 @@
+from fastapi import Request
+from pydantic import BaseModel
+from pymongo.errors import PyMongoError
+from typing import List, Optional, Dict, Any
+from collections import OrderedDict
+from datetime import datetime
+import os
+import logging
+import json
+import asyncio
+
+from core import ROOT_DIR, api_router, require_admin, recently_written, read_collection, observe_read
+from key_table import key_table
+
+logger = logging.getLogger(__name__)
+
+
+class ValidateKeyRequest(BaseModel):
+    key: str
+
+class ValidateKeyResponse(BaseModel):
+    valid: bool
+    plan: str  # 'premium' | 'free'
+    status: Optional[str] = None
+    expires_at: Optional[datetime] = None
+    expires_at_ms: Optional[int] = None
+    stale: bool = False  # resposta do último estado conhecido (Mongo lento/fora)
+
+
+# ============ Premium APIs ============
+@api_router.post('/premium/keys/validate', response_model=ValidateKeyResponse)
+async def validate_key(req: ValidateKeyRequest):
+    return await lookup_key_status(req.key)
+
+
+async def lookup_key_status(key: Optional[str]) -> ValidateKeyResponse:
+    key_raw = (key or '').strip()
+    if not key_raw:
+        return ValidateKeyResponse(valid=False, plan='free', status='invalid')
+    if key_table.ready and not recently_written(f'key:{key_raw}'):
+        state = key_table.get(key_raw)
+        if state is not None:
+            return _key_status_response(state)
+        # Ausente da tabela: pode ser KEY criada agora em outro worker; confirma no Mongo
+    if key_snapshot.breaker_open():
+        return key_snapshot.answer(key_raw)
+    coll, route = read_collection('premium_keys', f'key:{key_raw}')
+    try:
+        with observe_read(route):
+            key_doc = await asyncio.wait_for(
+                coll.find_one({'key': key_raw}, {'_id': 0, 'status': 1, 'expires_at': 1}, max_time_ms=VALIDATE_DEADLINE_MS),
+                VALIDATE_DEADLINE_MS / 1000 + VALIDATE_DEADLINE_GRACE_SECONDS)
+    except (asyncio.TimeoutError, PyMongoError) as e:
+        key_snapshot.failed(e)
+        return key_snapshot.answer(key_raw)
+    key_snapshot.succeeded()
+    if not key_doc:
+        return ValidateKeyResponse(valid=False, plan='free', status='not_found')
+    key_snapshot.remember(key_raw, key_doc)
+    return _key_status_response(key_doc)
+
+
+def _key_status_response(key_doc: Dict[str, Any], stale: bool = False) -> ValidateKeyResponse:
+    status = key_doc.get('status')
+    if status != 'active':
+        return ValidateKeyResponse(valid=False, plan='free', status=status, stale=stale)
+    # Checa expiração
+    exp = key_doc.get('expires_at')
+    try:
+        if exp and isinstance(exp, str):
+            # caso legado salvo como string
+            exp = datetime.fromisoformat(exp)
+    except Exception:
+        exp = None
+    if exp and datetime.utcnow() >= exp:
+        return ValidateKeyResponse(valid=False, plan='free', status='expired', expires_at=exp, expires_at_ms=int(exp.timestamp()*1000) if exp else None, stale=stale)
+    return ValidateKeyResponse(valid=True, plan='premium', status='active', expires_at=exp, expires_at_ms=int(exp.timestamp()*1000) if exp else None, stale=stale)
+
+
+# ============ Validação com stale-if-error ============
+# Se o Mongo trava, validate não pode ficar pendurado até o timeout do driver (cada
+# extensão cairia no catch de validateKeyServer e iria para os FALLBACK_BACKENDS).
+# Prazo por operação (maxTimeMS + wait_for); estourou, responde do último estado
+# conhecido de cada KEY, marcado stale=true. O snapshot vem das validações bem-sucedidas
+# e de uma varredura periódica das ativas, e é gravado em arquivo local para sobreviver
+# a restart durante o incidente. Após falhas seguidas, um disjuntor pula o Mongo por
+# alguns segundos.
+
+VALIDATE_DEADLINE_MS = int(os.environ.get('VALIDATE_DEADLINE_MS', '300'))
+VALIDATE_DEADLINE_GRACE_SECONDS = 0.2  # seleção de servidor/pool, além do maxTimeMS
+VALIDATE_BREAKER_FAILURES = int(os.environ.get('VALIDATE_BREAKER_FAILURES', '3'))
+VALIDATE_BREAKER_SECONDS = float(os.environ.get('VALIDATE_BREAKER_SECONDS', '5'))
+KEY_SNAPSHOT_PATH = os.environ.get('KEY_SNAPSHOT_PATH', str(ROOT_DIR / 'key_snapshot.json'))
+KEY_SNAPSHOT_PERSIST_SECONDS = float(os.environ.get('KEY_SNAPSHOT_PERSIST_SECONDS', '60'))
+KEY_SNAPSHOT_REFRESH_SECONDS = float(os.environ.get('KEY_SNAPSHOT_REFRESH_SECONDS', '600'))
+
+
+class KeySnapshot:
+    def __init__(self, path: str):
+        self.path = path
+        self.states: Dict[str, Dict[str, Any]] = {}  # key -> {'status', 'expires_at'}
+        self.dirty = False
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.stale_answers = 0
+        self.unknown_answers = 0
+        self.last_error: Optional[str] = None
+        self.persisted_at: Optional[datetime] = None
+        self.refreshed_at: Optional[datetime] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def remember(self, key: str, doc: Dict[str, Any]):
+        state = {'status': doc.get('status'), 'expires_at': doc.get('expires_at')}
+        if self.states.get(key) != state:
+            self.states[key] = state
+            self.dirty = True
+
+    def mark_revoked(self, keys: List[str]):
+        for key in keys:
+            if key in self.states:
+                self.states[key] = {**self.states[key], 'status': 'revoked'}
+                self.dirty = True
+
+    def forget(self, keys: List[str]):
+        for key in keys:
+            if self.states.pop(key, None) is not None:
+                self.dirty = True
+
+    def breaker_open(self) -> bool:
+        return self.open_until > asyncio.get_running_loop().time()
+
+    def failed(self, error: BaseException):
+        self.consecutive_failures += 1
+        self.last_error = f'{type(error).__name__}: {error}'
+        if self.consecutive_failures >= VALIDATE_BREAKER_FAILURES:
+            self.open_until = asyncio.get_running_loop().time() + VALIDATE_BREAKER_SECONDS
+            logger.warning('validate: Mongo indisponível (%s); respondendo do snapshot por %.0fs', self.last_error, VALIDATE_BREAKER_SECONDS)
+
+    def succeeded(self):
+        self.consecutive_failures = 0
+
+    def answer(self, key: str) -> ValidateKeyResponse:
+        state = (key_table.get(key) if key_table.ready else None) or self.states.get(key)
+        if state is None:
+            self.unknown_answers += 1
+            return ValidateKeyResponse(valid=False, plan='free', status='unavailable', stale=True)
+        self.stale_answers += 1
+        return _key_status_response(state, stale=True)
+
+    async def refresh(self):
+        # Varredura das ativas (projeção mínima, secundário) para cobrir KEYs que este
+        # worker ainda não validou
+        coll, route = read_collection('premium_keys')
+        seen: Dict[str, Dict[str, Any]] = {}
+        with observe_read(route):
+            async for doc in coll.find({'status': 'active'}, {'_id': 0, 'key': 1, 'status': 1, 'expires_at': 1}).batch_size(5000):
+                seen[doc['key']] = {'status': doc['status'], 'expires_at': doc.get('expires_at')}
+        # Quem estava ativo e sumiu da varredura foi revogado/expirado nesse meio tempo
+        for key, state in self.states.items():
+            if key not in seen and state.get('status') == 'active':
+                seen[key] = {**state, 'status': 'revoked'}
+        self.states = {**self.states, **seen}
+        self.dirty = True
+        self.refreshed_at = datetime.utcnow()
+
+    def _write_file(self, states: Dict[str, Dict[str, Any]]):
+        payload = {k: {'status': v.get('status'),
+                       'expires_at': v['expires_at'].isoformat() if isinstance(v.get('expires_at'), datetime) else v.get('expires_at')}
+                   for k, v in states.items()}
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(payload, f)
+        os.replace(tmp, self.path)
+
+    async def persist(self):
+        if not self.dirty:
+            return
+        self.dirty = False
+        try:
+            await asyncio.to_thread(self._write_file, dict(self.states))
+            self.persisted_at = datetime.utcnow()
+        except OSError:
+            self.dirty = True
+            logger.exception('Falha ao gravar snapshot de KEYs em %s', self.path)
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                payload = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            logger.exception('Snapshot de KEYs ilegível em %s', self.path)
+            return
+        for key, state in payload.items():
+            exp = state.get('expires_at')
+            try:
+                exp = datetime.fromisoformat(exp) if exp else None
+            except (TypeError, ValueError):
+                exp = None
+            self.states.setdefault(key, {'status': state.get('status'), 'expires_at': exp})
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_refresh = loop.time()
+        while True:
+            if loop.time() >= next_refresh and not self.breaker_open():
+                try:
+                    await self.refresh()
+                    next_refresh = loop.time() + KEY_SNAPSHOT_REFRESH_SECONDS
+                except Exception:
+                    logger.exception('Falha ao atualizar snapshot de KEYs')
+                    next_refresh = loop.time() + KEY_SNAPSHOT_PERSIST_SECONDS
+            await self.persist()
+            await asyncio.sleep(KEY_SNAPSHOT_PERSIST_SECONDS)
+
+    async def start(self):
+        await asyncio.to_thread(self.load)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.persist()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'keys': len(self.states),
+            'breaker_open': self.breaker_open(),
+            'consecutive_failures': self.consecutive_failures,
+            'stale_answers': self.stale_answers,
+            'unknown_answers': self.unknown_answers,
+            'last_error': self.last_error,
+            'persisted_at': self.persisted_at,
+            'refreshed_at': self.refreshed_at,
+        }
+
+
+key_snapshot = KeySnapshot(KEY_SNAPSHOT_PATH)
+
+
+@api_router.get('/admin/validate/stats')
+async def admin_validate_stats(request: Request):
+    require_admin(request)
+    return key_snapshot.stats()
+
+
+# ============ Cache de plano por KEY ============
+# resolve_plan é chamado a cada resumo; invalidate_key_caches é o ponto único de
+# invalidação depois de mutações em premium_keys.
+
+PLAN_CACHE_TTL_SECONDS = int(os.environ.get('PLAN_CACHE_TTL_SECONDS', '60'))
+PLAN_CACHE_MAX_ENTRIES = int(os.environ.get('PLAN_CACHE_MAX_ENTRIES', '10000'))
+# key -> (plano, válido até), em ordem LRU: KEYs aleatórias não fazem o cache crescer sem limite
+_plan_cache: 'OrderedDict[str, tuple]' = OrderedDict()
+
+
+async def resolve_plan(key: Optional[str]) -> str:
+    key_raw = (key or '').strip()
+    if not key_raw:
+        return 'free'
+    loop_now = asyncio.get_running_loop().time()
+    hit = _plan_cache.get(key_raw)
+    if hit and hit[1] > loop_now:
+        _plan_cache.move_to_end(key_raw)
+        return hit[0]
+    plan = (await lookup_key_status(key_raw)).plan
+    _plan_cache[key_raw] = (plan, loop_now + PLAN_CACHE_TTL_SECONDS)
+    _plan_cache.move_to_end(key_raw)
+    while len(_plan_cache) > PLAN_CACHE_MAX_ENTRIES:
+        _plan_cache.popitem(last=False)
+    return plan
+
+
+def invalidate_key_caches(keys: Optional[List[str]] = None, revoked: bool = True):
+    # Ponto único para caches derivados de premium_keys; None = tudo. revoked=False
+    # (import) esquece as KEYs no snapshot, já que o estado novo pode ser qualquer um
+    if keys is None:
+        _plan_cache.clear()
+        return
+    for k in keys:
+        _plan_cache.pop(k, None)
+    if revoked:
+        key_snapshot.mark_revoked(keys)
+    else:
+        key_snapshot.forget(keys)
@@ -0,0 +1,254 @@
+from fastapi import Request, HTTPException
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from typing import List, Optional, Dict, Any
+from datetime import datetime, timedelta
+import os
+import logging
+import json
+import asyncio
+
+from core import api_router, db, require_admin, constant_time_equals, sha256_hex
+from audit import audit_log
+from keys import renew_premium_key, revoke_keys
+
+logger = logging.getLogger(__name__)
+
+
+# ============ Webhook Lastlink ============
+# Ack rápido: o endpoint só autentica, grava o evento cru em webhook_inbox (índice
+# único em dedup_key garante idempotência) e responde 202. Um pool limitado de workers
+# transforma os eventos em criação/revogação de KEY, com backoff entre tentativas e
+# dead-letter em webhook_dead_letter. Um poller recoloca na fila o que ficou pendente
+# (restart, fila cheia, worker que morreu no meio).
+
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', '4'))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', '1000'))
+WEBHOOK_MAX_ATTEMPTS = int(os.environ.get('WEBHOOK_MAX_ATTEMPTS', '6'))
+WEBHOOK_POLL_SECONDS = float(os.environ.get('WEBHOOK_POLL_SECONDS', '5'))
+WEBHOOK_LOCK_SECONDS = int(os.environ.get('WEBHOOK_LOCK_SECONDS', '60'))
+WEBHOOK_KEY_DAYS = int(os.environ.get('WEBHOOK_KEY_DAYS', '30'))
+SAFE_SECRET_ENV = 'LASTLINK_WEBHOOK_SECRET'
+
+WEBHOOK_PURCHASE_EVENTS = {'compra completa', 'pagamento confirmado', 'pagamento aprovado', 'payment_success',
+                           'purchase_complete', 'purchase_completed', 'order_paid'}
+WEBHOOK_REVOKE_EVENTS = {'pagamento reembolsado', 'pagamento estornado', 'pedido de compra cancelado', 'reembolso',
+                         'estorno', 'refund', 'refunded', 'chargeback', 'order_canceled', 'order_cancelled'}
+
+
+def _webhook_secret_ok(request: Request, payload: Dict[str, Any]) -> bool:
+    configured = os.environ.get(SAFE_SECRET_ENV)
+    if not configured:
+        raise HTTPException(status_code=500, detail=f'{SAFE_SECRET_ENV} not configured')
+    auth = request.headers.get('authorization') or ''
+    candidates = [
+        auth.split(' ', 1)[1].strip() if auth.lower().startswith('bearer ') else None,
+        request.headers.get('x-webhook-token'),
+        payload.get('secret') if isinstance(payload.get('secret'), str) else None,
+        payload.get('token') if isinstance(payload.get('token'), str) else None,
+    ]
+    return any(c and constant_time_equals(c, configured) for c in candidates)
+
+
+def _dig(payload: Dict[str, Any], *paths: str) -> Optional[str]:
+    for path in paths:
+        node: Any = payload
+        for part in path.split('.'):
+            node = node.get(part) if isinstance(node, dict) else None
+        if node not in (None, ''):
+            return str(node).strip()
+    return None
+
+
+def parse_webhook_event(payload: Dict[str, Any]) -> Dict[str, Any]:
+    label = (_dig(payload, 'event', 'type', 'event_type', 'data.event') or '').lower()
+    if label in WEBHOOK_PURCHASE_EVENTS:
+        action = 'purchase'
+    elif label in WEBHOOK_REVOKE_EVENTS:
+        action = 'revoke'
+    else:
+        action = 'ignore'
+    # Só caminhos do comprador: um e-mail qualquer do payload (afiliado, produtor,
+    # suporte) receberia a KEY de outra pessoa
+    email = _dig(payload, 'customer.email', 'email', 'buyer.email', 'data.customer.email', 'data.buyer.email', 'data.email')
+    return {
+        'event': label,
+        'action': action,
+        'event_id': _dig(payload, 'id', 'event_id', 'data.id'),
+        'email': email.lower() if email else None,
+        'order_id': _dig(payload, 'order_id', 'order.id', 'data.order_id', 'data.order.id', 'purchase.id'),
+        'product_code': _dig(payload, 'product_code', 'product.code', 'data.product_code', 'data.product.code'),
+    }
+
+
+def _webhook_dedup_key(parsed: Dict[str, Any], raw: bytes) -> str:
+    # Id do evento quando o provedor manda; senão ação + pedido (compra e reembolso do
+    # mesmo pedido são eventos distintos); em último caso o hash do corpo
+    if parsed['event_id']:
+        return f"id:{parsed['event_id']}"
+    if parsed['order_id']:
+        return f"{parsed['event']}:{parsed['order_id']}"
+    return f'body:{sha256_hex(raw.decode("utf-8", "replace"))}'
+
+
+class WebhookProcessor:
+    def __init__(self, workers: int, queue_size: int):
+        self.workers = workers
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.queued: set = set()
+        self._tasks: List[asyncio.Task] = []
+        self.processed = 0
+        self.retried = 0
+        self.dead = 0
+
+    def enqueue(self, event_id: str) -> bool:
+        if event_id in self.queued:
+            return True
+        try:
+            self.queue.put_nowait(event_id)
+        except asyncio.QueueFull:
+            return False  # o poller pega depois
+        self.queued.add(event_id)
+        return True
+
+    async def _claim(self, event_id: str) -> Optional[Dict[str, Any]]:
+        now = datetime.utcnow()
+        return await db.webhook_inbox.find_one_and_update(
+            {'_id': event_id, '$or': [{'status': 'pending', 'next_attempt_at': {'$lte': now}},
+                                      {'status': 'processing', 'locked_until': {'$lte': now}}]},
+            {'$set': {'status': 'processing', 'locked_until': now + timedelta(seconds=WEBHOOK_LOCK_SECONDS)},
+             '$inc': {'attempts': 1}},
+            return_document=ReturnDocument.AFTER)
+
+    async def _apply(self, doc: Dict[str, Any]) -> str:
+        action = doc.get('action')
+        if action == 'purchase':
+            if not doc.get('email'):
+                raise ValueError('evento de compra sem e-mail')
+            # Renovação por pedido; sem pedido, o próprio evento é a chave de idempotência
+            await renew_premium_key(doc['email'], WEBHOOK_KEY_DAYS, doc.get('order_id') or doc['_id'],
+                                    doc.get('product_code'), doc.get('order_id'))
+            return 'done'
+        if action == 'revoke':
+            if doc.get('order_id'):
+                await revoke_keys(order_id=doc['order_id'])
+            elif doc.get('email'):
+                await revoke_keys(email=doc['email'])
+            else:
+                raise ValueError('evento de revogação sem pedido nem e-mail')
+            return 'done'
+        return 'ignored'
+
+    async def process(self, event_id: str):
+        doc = await self._claim(event_id)
+        if doc is None:
+            return  # já processado, ainda em backoff ou com outro worker
+        try:
+            status = await self._apply(doc)
+        except Exception as e:
+            attempts = doc.get('attempts', 1)
+            if attempts >= WEBHOOK_MAX_ATTEMPTS:
+                self.dead += 1
+                logger.error('Webhook %s movido para dead-letter: %s', event_id, e)
+                await db.webhook_dead_letter.replace_one(
+                    {'_id': event_id}, {**doc, 'status': 'dead', 'error': str(e), 'failed_at': datetime.utcnow()}, upsert=True)
+                await db.webhook_inbox.update_one({'_id': event_id}, {'$set': {'status': 'dead', 'error': str(e)}})
+            else:
+                self.retried += 1
+                delay = min(2 ** attempts, 300)
+                await db.webhook_inbox.update_one({'_id': event_id}, {'$set': {
+                    'status': 'pending', 'error': str(e), 'next_attempt_at': datetime.utcnow() + timedelta(seconds=delay)}})
+            return
+        self.processed += 1
+        if status == 'done':
+            audit_log.record(f"webhook.{doc['action']}", 'webhook:lastlink', email=doc.get('email'),
+                             order_id=doc.get('order_id'), event_id=event_id)
+        await db.webhook_inbox.update_one({'_id': event_id}, {'$set': {'status': status, 'processed_at': datetime.utcnow()},
+                                                              '$unset': {'error': ''}})
+
+    async def _worker(self):
+        while True:
+            event_id = await self.queue.get()
+            try:
+                await self.process(event_id)
+            except Exception:
+                logger.exception('Falha ao processar webhook %s', event_id)
+            finally:
+                self.queued.discard(event_id)
+                self.queue.task_done()
+
+    async def poll(self):
+        now = datetime.utcnow()
+        filt = {'$or': [{'status': 'pending', 'next_attempt_at': {'$lte': now}},
+                        {'status': 'processing', 'locked_until': {'$lte': now}}]}
+        room = self.queue.maxsize - self.queue.qsize()
+        if room <= 0:
+            return
+        async for doc in db.webhook_inbox.find(filt, {'_id': 1}).sort('received_at', 1).limit(room):
+            self.enqueue(doc['_id'])
+
+    async def _poller(self):
+        while True:
+            try:
+                await self.poll()
+            except Exception:
+                logger.exception('Falha ao varrer webhook_inbox')
+            await asyncio.sleep(WEBHOOK_POLL_SECONDS)
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+            self._tasks.append(asyncio.create_task(self._poller()))
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    async def stats(self) -> Dict[str, Any]:
+        counts = {d['_id']: d['n'] async for d in db.webhook_inbox.aggregate([{'$group': {'_id': '$status', 'n': {'$sum': 1}}}])}
+        return {
+            'queue_depth': self.queue.qsize(),
+            'workers': self.workers,
+            'processed': self.processed,
+            'retried': self.retried,
+            'dead_lettered': self.dead,
+            'inbox': counts,
+            'dead_letter_total': await db.webhook_dead_letter.count_documents({}),
+        }
+
+
+webhook_processor = WebhookProcessor(WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE)
+
+
+@api_router.post('/webhooks/lastlink', status_code=202)
+async def lastlink_webhook(request: Request):
+    raw = await request.body()
+    try:
+        payload = json.loads(raw or b'{}')
+    except ValueError:
+        raise HTTPException(status_code=400, detail='JSON inválido')
+    if not isinstance(payload, dict):
+        raise HTTPException(status_code=400, detail='JSON inválido')
+    if not _webhook_secret_ok(request, payload):
+        raise HTTPException(status_code=401, detail='Unauthorized')
+    parsed = parse_webhook_event(payload)
+    event_id = _webhook_dedup_key(parsed, raw)
+    now = datetime.utcnow()
+    payload.pop('secret', None)
+    payload.pop('token', None)
+    try:
+        await db.webhook_inbox.insert_one({
+            '_id': event_id, **parsed, 'payload': payload, 'status': 'pending', 'attempts': 0,
+            'received_at': now, 'next_attempt_at': now,
+        })
+    except DuplicateKeyError:
+        return {'received': True, 'queued': False, 'idempotent': True, 'event_id': event_id}
+    webhook_processor.enqueue(event_id)
+    return {'received': True, 'queued': True, 'idempotent': False, 'event_id': event_id, 'action': parsed['action']}
+
+
+@api_router.get('/admin/webhooks/stats')
+async def admin_webhook_stats(request: Request):
+    require_admin(request)
+    return await webhook_processor.stats()
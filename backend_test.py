@@ -18,6 +18,7 @@ load_dotenv('/app/frontend/.env')
 BASE_URL = os.getenv('REACT_APP_BACKEND_URL', 'https://summary-pro.preview.emergentagent.com')
 API_BASE = f"{BASE_URL}/api"
 WEBHOOK_SECRET = "0e8cafc1171045df9b30c23db25a53df"
+WEBHOOK_SETTLE_SECONDS = 2  # 202 means queued; give the workers time before checking keys
 
 # Test data
 TEST_EMAIL = "comprador@example.com"
@@ -66,9 +67,9 @@ class BackendTester:
                 timeout=10
             )
             
-            if response.status_code == 200:
+            if response.status_code == 202:
                 data = response.json()
-                success = data.get('received') and data.get('processed')
+                success = data.get('received') and data.get('queued')
                 self.log_result("Webhook Auth Bearer", success, f"Status: {response.status_code}, Response: {data}")
                 return success
             else:
@@ -103,9 +104,9 @@ class BackendTester:
                 timeout=10
             )
             
-            if response.status_code == 200:
+            if response.status_code == 202:
                 data = response.json()
-                success = data.get('received') and data.get('processed')
+                success = data.get('received') and data.get('queued')
                 self.log_result("Webhook Auth Token Header", success, f"Status: {response.status_code}, Response: {data}")
                 return success
             else:
@@ -172,9 +173,9 @@ class BackendTester:
                 timeout=10
             )
             
-            if response.status_code == 200:
+            if response.status_code == 202:
                 data = response.json()
-                success = data.get('received') and data.get('processed')
+                success = data.get('received') and data.get('queued')
                 self.log_result("Webhook Purchase Complete", success, f"Response: {data}")
                 return success
             else:
@@ -209,9 +210,9 @@ class BackendTester:
                 timeout=10
             )
             
-            if response.status_code == 200:
+            if response.status_code == 202:
                 data = response.json()
-                success = data.get('received') and data.get('processed')
+                success = data.get('received') and data.get('queued')
                 self.log_result("Webhook Refund", success, f"Response: {data}")
                 return success
             else:
@@ -246,9 +247,9 @@ class BackendTester:
                 timeout=10
             )
             
-            if response.status_code == 200:
+            if response.status_code == 202:
                 data = response.json()
-                success = data.get('received') and data.get('processed')
+                success = data.get('received') and data.get('queued')
                 self.log_result("Webhook Chargeback", success, f"Response: {data}")
                 return success
             else:
@@ -283,9 +284,9 @@ class BackendTester:
                 timeout=10
             )
             
-            if response.status_code == 200:
+            if response.status_code == 202:
                 data = response.json()
-                success = data.get('received') and data.get('processed')
+                success = data.get('received') and data.get('queued')
                 self.log_result("Webhook Order Cancel", success, f"Response: {data}")
                 return success
             else:
@@ -321,13 +322,13 @@ class BackendTester:
                 timeout=10
             )
             
-            if response1.status_code != 200:
+            if response1.status_code != 202:
                 self.log_result("Webhook Idempotency", False, f"First call failed: {response1.status_code}")
                 return False
             
             data1 = response1.json()
-            if not (data1.get('received') and data1.get('processed')):
-                self.log_result("Webhook Idempotency", False, f"First call not processed: {data1}")
+            if not (data1.get('received') and data1.get('queued')):
+                self.log_result("Webhook Idempotency", False, f"First call not queued: {data1}")
                 return False
             
             # Second call (should be idempotent)
@@ -338,13 +339,13 @@ class BackendTester:
                 timeout=10
             )
             
-            if response2.status_code != 200:
+            if response2.status_code != 202:
                 self.log_result("Webhook Idempotency", False, f"Second call failed: {response2.status_code}")
                 return False
             
             data2 = response2.json()
             success = (data2.get('received') and 
-                      not data2.get('processed') and 
+                      not data2.get('queued') and 
                       data2.get('idempotent'))
             
             self.log_result("Webhook Idempotency", success, 
@@ -382,9 +383,10 @@ class BackendTester:
                 timeout=10
             )
             
-            if webhook_response.status_code != 200:
+            if webhook_response.status_code != 202:
                 self.log_result("Premium Claim Valid", False, f"Webhook setup failed: {webhook_response.status_code}")
                 return False
+            time.sleep(WEBHOOK_SETTLE_SECONDS)  # webhooks are processed in the background
             
             # Now claim the key
             claim_payload = {"email": claim_email}
@@ -456,9 +458,10 @@ class BackendTester:
                 timeout=10
             )
             
-            if webhook_response.status_code != 200:
+            if webhook_response.status_code != 202:
                 self.log_result("Key Validation Active", False, f"Webhook setup failed: {webhook_response.status_code}")
                 return False
+            time.sleep(WEBHOOK_SETTLE_SECONDS)  # webhooks are processed in the background
             
             # Claim key
             claim_response = self.session.post(
@@ -528,9 +531,10 @@ class BackendTester:
                 timeout=10
             )
             
-            if webhook_response.status_code != 200:
+            if webhook_response.status_code != 202:
                 self.log_result("Key Validation Revoked", False, f"Webhook setup failed: {webhook_response.status_code}")
                 return False
+            time.sleep(WEBHOOK_SETTLE_SECONDS)  # webhooks are processed in the background
             
             # Claim key
             claim_response = self.session.post(
@@ -647,16 +651,16 @@ class BackendTester:
                 timeout=10
             )
             
-            if response1.status_code != 200:
+            if response1.status_code != 202:
                 self.log_result("Robustness Test 1", False, f"Bearer auth failed: {response1.status_code}")
                 return False
             
             data1 = response1.json()
-            if not (data1.get('received') and data1.get('processed')):
-                self.log_result("Robustness Test 1", False, f"Purchase not processed: {data1}")
+            if not (data1.get('received') and data1.get('queued')):
+                self.log_result("Robustness Test 1", False, f"Purchase not queued: {data1}")
                 return False
             
-            print(f"✅ Purchase webhook processed: {data1}")
+            print(f"✅ Purchase webhook queued: {data1}")
             
             # 2) Test webhook with secret in body (no header)
             print("\n--- Test 2: Webhook with secret in body ---")
@@ -675,16 +679,17 @@ class BackendTester:
                 timeout=10
             )
             
-            if response2.status_code != 200:
+            if response2.status_code != 202:
                 self.log_result("Robustness Test 2", False, f"Body secret auth failed: {response2.status_code}")
                 return False
             
             data2 = response2.json()
-            if not (data2.get('received') and data2.get('processed')):
-                self.log_result("Robustness Test 2", False, f"Body secret purchase not processed: {data2}")
+            if not (data2.get('received') and data2.get('queued')):
+                self.log_result("Robustness Test 2", False, f"Body secret purchase not queued: {data2}")
                 return False
             
-            print(f"✅ Body secret webhook processed: {data2}")
+            print(f"✅ Body secret webhook queued: {data2}")
+            time.sleep(WEBHOOK_SETTLE_SECONDS)  # webhooks are processed in the background
             
             # 3) Test premium claim for the first email
             print("\n--- Test 3: Premium claim ---")
@@ -722,16 +727,17 @@ class BackendTester:
                 timeout=10
             )
             
-            if response4.status_code != 200:
+            if response4.status_code != 202:
                 self.log_result("Robustness Test 4", False, f"Refund webhook failed: {response4.status_code}")
                 return False
             
             data4 = response4.json()
-            if not (data4.get('received') and data4.get('processed')):
-                self.log_result("Robustness Test 4", False, f"Refund not processed: {data4}")
+            if not (data4.get('received') and data4.get('queued')):
+                self.log_result("Robustness Test 4", False, f"Refund not queued: {data4}")
                 return False
             
-            print(f"✅ Refund webhook processed: {data4}")
+            print(f"✅ Refund webhook queued: {data4}")
+            time.sleep(WEBHOOK_SETTLE_SECONDS)  # webhooks are processed in the background
             
             # 5) Test premium claim again (should return 404)
             print("\n--- Test 5: Premium claim after refund ---")
@@ -0,0 +1,63 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'backend'))
+
+# Antes de importar o backend: os módulos leem o ambiente no import
+_tmp = tempfile.mkdtemp(prefix='backend-tests-')
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'test')
+os.environ.setdefault('ADMIN_KEY', 'test-admin-key')
+os.environ.setdefault('OPENROUTER_API_KEY', 'test-openrouter-key')
+os.environ['MONGO_SECONDARY_READS'] = '0'
+os.environ['HISTORY_FTS_PATH'] = os.path.join(_tmp, 'history_fts.sqlite3')
+os.environ['KEY_SNAPSHOT_PATH'] = os.path.join(_tmp, 'key_snapshot.json')
+os.environ['KEY_TABLE_DIR'] = os.path.join(_tmp, 'key_table')
+
+
+@pytest.fixture
+def anyio_backend():
+    return 'asyncio'
+
+
+@pytest.fixture
+def mongo():
+    # Banco em memória no lugar do Motor; core.db/core.client resolvem por _mongo
+    from mongomock_motor import AsyncMongoMockClient
+    import core
+    mock_client = AsyncMongoMockClient()
+    core._mongo.update(client=mock_client, db=mock_client['test'])
+    core._secondary_collections.clear()
+    yield mock_client['test']
+    core._mongo.clear()
+
+
+@pytest.fixture
+def http_mock(monkeypatch):
+    # URL -> função que devolve um httpx.Response; usado pelo cliente HTTP compartilhado
+    import httpx
+    import upstream
+    routes = {}
+
+    def handler(request):
+        return routes[str(request.url)]()
+
+    monkeypatch.setattr(upstream, '_http_client', httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    return routes
+
+
+@pytest.fixture
+def api(mongo):
+    # Só as rotas, sem o lifespan (tarefas de fundo) do app real
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+    import server  # noqa: F401 - registra as rotas em api_router
+    from core import api_router
+    app = FastAPI()
+    app.include_router(api_router)
+    with TestClient(app) as client:
+        yield client
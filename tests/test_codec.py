@@ -0,0 +1,46 @@
+import pytest
+import zlib
+
+from codec import COMPRESSION_MIN_BYTES, TextCodec, UnknownDictionaryError, train_zdict
+
+SUMMARY = ('1. Contexto: o relatório descreve o cenário econômico do trimestre.\n'
+           '- Inflação: os preços subiram acima da meta.\n- Juros: o banco central manteve a taxa.\n'
+           'EXPANSÕES:\n- Inflação\nA alta foi puxada por alimentos e energia.\n'
+           '- Juros\nA decisão considerou o câmbio e as expectativas do mercado.\n')
+
+
+def test_pack_round_trip_and_short_text_stays_raw():
+    codec = TextCodec()
+    assert len(SUMMARY.encode()) >= COMPRESSION_MIN_BYTES
+    text = SUMMARY * 4
+    packed = codec.pack(text)
+    assert isinstance(packed, bytes) and packed[:2] == b'Z1'
+    assert len(packed) < len(text.encode())
+    assert codec.unpack(packed) == text
+    short = 'x' * (COMPRESSION_MIN_BYTES - 1)
+    assert codec.pack(short) == short
+    assert codec.unpack('texto antigo em string') == 'texto antigo em string'
+    assert codec.pack(None) is None
+
+
+def test_trained_dictionary_beats_plain_deflate():
+    codec = TextCodec()
+    zdict = train_zdict([SUMMARY.replace('trimestre', f'trimestre {i}') for i in range(50)])
+    codec.dicts[1] = zdict
+    codec.active_id = 1
+    packed = codec.pack(SUMMARY)
+    deflate = zlib.compressobj(6, zlib.DEFLATED, -15)
+    plain = deflate.compress(SUMMARY.encode()) + deflate.flush()
+    assert len(packed) - 6 < len(plain)
+    assert codec.unpack(packed) == SUMMARY
+
+
+@pytest.mark.anyio
+async def test_other_worker_dictionary_is_loaded_on_demand(mongo):
+    trainer, reader = TextCodec(), TextCodec()
+    await trainer.train([SUMMARY] * 20)
+    packed = trainer.pack(SUMMARY)
+    with pytest.raises(UnknownDictionaryError):
+        reader.unpack(packed)
+    assert await reader.inflate(packed) == SUMMARY
+    assert reader.active_id == trainer.active_id
@@ -0,0 +1,82 @@
+import pytest
+
+import compaction
+from compaction import BoilerplateModel, compact_input
+
+
+@pytest.fixture(autouse=True)
+def fresh_model(monkeypatch):
+    model = BoilerplateModel(min_origins=3, max_entries=1000)
+    monkeypatch.setattr(compaction, 'boilerplate_model', model)
+    return model
+
+
+ARTICLE = [
+    'O conselho aprovou ontem o novo plano de mobilidade urbana para a região central.',
+    'A proposta prevê faixas exclusivas de ônibus e ciclovias em doze avenidas.',
+    'Segundo a prefeitura, as obras começam no segundo semestre e duram dois anos.',
+    'Moradores ouvidos pela reportagem elogiaram a medida, mas temem congestionamentos.',
+]
+NAV = ['Início', 'Esportes', 'Política', 'Contato', 'Aceitar todos os cookies']
+
+
+def _page(lines):
+    return '\n'.join(lines)
+
+
+def test_repeat_visits_to_one_site_never_become_boilerplate():
+    text = ' '.join(ARTICLE)
+    for i in range(10):
+        out, stats = compact_input(f'{text} Comentários: {i}.', 'long', 'https://news.example/a')
+    assert all(sentence in out for sentence in ARTICLE)
+    assert stats['removed_boilerplate'] == 0
+
+
+def test_sentences_shared_across_sites_are_kept():
+    text = ' '.join(ARTICLE)
+    for i in range(5):
+        out, stats = compact_input(text, 'long', f'https://site{i}.example/x')
+    assert all(sentence in out for sentence in ARTICLE)
+    assert stats['removed_boilerplate'] == 0
+
+
+def test_structural_lines_seen_on_many_sites_are_dropped():
+    for i in range(3):
+        compact_input(_page(NAV + ARTICLE), 'long', f'https://site{i}.example/p')
+    out, stats = compact_input(_page(NAV + ARTICLE), 'long', 'https://other.example/p')
+    assert stats['removed_boilerplate'] == len(NAV)
+    assert out == _page(ARTICLE)
+
+
+def test_same_origin_counts_once_and_missing_url_learns_nothing(fresh_model):
+    for _ in range(5):
+        compact_input(_page(NAV + ARTICLE), 'long', 'https://site.example/p')
+        compact_input(_page(NAV + ARTICLE), 'long', None)
+    _, stats = compact_input(_page(NAV + ARTICLE), 'long', 'https://site.example/q')
+    assert stats['removed_boilerplate'] == 0
+    assert all(len(origins) == 1 for origins in fresh_model.origins.values())
+
+
+def test_cookie_and_privacy_sentences_are_content():
+    text = ('O tribunal decidiu que sites não podem exigir cookies de rastreamento. '
+            'A política de privacidade precisa ser clara. ' + ' '.join(ARTICLE))
+    out, stats = compact_input(text, 'long', 'https://news.example/a')
+    assert 'cookies de rastreamento' in out and 'política de privacidade' in out
+    assert stats['removed_boilerplate'] == 0
+
+
+def test_exact_and_near_duplicate_paragraphs_removed():
+    para = ' '.join(ARTICLE)
+    text = _page([para, ARTICLE[0], para, para.replace('ontem', 'hoje')])
+    out, stats = compact_input(text, 'long')
+    assert out == _page([para, ARTICLE[0]])
+    assert stats['removed_duplicates'] == 2
+
+
+def test_fallback_to_original_reports_nothing_removed():
+    text = _page(['Linha curta de menu', 'Linha curta de menu', 'Linha curta de menu'])
+    out, stats = compact_input(text, 'long')
+    assert out == text
+    assert stats['reverted'] == 1
+    assert stats['removed_duplicates'] == stats['removed_boilerplate'] == stats['trimmed_units'] == 0
+    assert stats['tokens_saved'] == 0
@@ -0,0 +1,60 @@
+from datetime import datetime, timedelta
+
+import pytest
+from bson import ObjectId
+
+import history
+from history import _contiguous_prefix
+
+
+def _doc(seq, age_seconds=0):
+    inserted = datetime.utcnow() - timedelta(seconds=age_seconds)
+    return {'_id': ObjectId.from_datetime(inserted), 'seq': seq}
+
+
+def test_contiguous_items_advance_the_cursor():
+    docs = [_doc(4), _doc(5), _doc(6)]
+    assert _contiguous_prefix(3, docs) == (6, docs)
+    assert _contiguous_prefix(3, []) == (3, [])
+
+
+def test_cursor_stops_before_a_recent_gap():
+    # seq 5 foi reservada por um append concorrente que ainda não gravou
+    docs = [_doc(4), _doc(6), _doc(7)]
+    assert _contiguous_prefix(3, docs) == (4, docs[:1])
+    assert _contiguous_prefix(3, [_doc(5)]) == (3, [])
+
+
+def test_old_gap_from_a_failed_append_is_skipped():
+    old = history.HISTORY_GAP_GRACE_SECONDS + 60
+    docs = [_doc(4, old), _doc(6, old), _doc(8)]
+    assert _contiguous_prefix(3, docs) == (6, docs[:2])
+
+
+def _search(owner, q):
+    return [r[0] for r in history.history_search_index.search(owner, q, None, 'rank', 10, 0)]
+
+
+@pytest.mark.anyio
+async def test_sync_indexes_history_appended_by_other_hosts(mongo, tmp_path, monkeypatch):
+    monkeypatch.setattr(history, 'history_search_index', history.HistorySearchIndex(str(tmp_path / 'fts.sqlite3')))
+    owner = 'device:abc'
+
+    async def append_elsewhere(seq, title):
+        await mongo.summary_history.insert_one({'owner': owner, 'seq': seq, 'title': title, 'summary': '', 'url': '',
+                                                'timestamp': datetime.utcnow()})
+        await mongo.history_counters.update_one({'_id': owner}, {'$set': {'seq': seq}}, upsert=True)
+
+    await append_elsewhere(1, 'fotossíntese')
+    await history.sync_history_search_index()
+    await append_elsewhere(2, 'mitocôndria')
+    assert len(_search(owner, 'mitocondria')) == 0
+    await history.sync_history_search_index()
+    assert len(_search(owner, 'mitocondria')) == 1 and len(_search(owner, 'fotossintese')) == 1
+    assert history.history_search_index.sync_marks()[history._owner_tag(owner)] == (2, 0)
+
+    # clear feito em outro host
+    await mongo.summary_history.delete_many({'owner': owner})
+    await mongo.history_counters.update_one({'_id': owner}, {'$set': {'cleared_seq': 2}})
+    await history.sync_history_search_index()
+    assert _search(owner, 'mitocondria') == []
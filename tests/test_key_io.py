@@ -0,0 +1,54 @@
+import asyncio
+import json
+
+import pytest
+
+import validation
+from key_io import _iter_upload_records
+
+
+async def _records(chunks, fmt):
+    async def gen():
+        for c in chunks:
+            yield c
+    return [r async for r in _iter_upload_records(gen(), {'format': fmt})]
+
+
+def test_records_split_across_chunks_and_utf8_boundaries():
+    data = '{"key": "A"}\r\n{"email": "joão@example.com"}\n{"key": "C"}'.encode('utf-8')
+    chunks = [data[i:i + 3] for i in range(0, len(data), 3)]
+    records = asyncio.run(_records([b'\xef\xbb\xbf'] + chunks, 'ndjson'))
+    assert records == ['{"key": "A"}', '{"email": "joão@example.com"}', '{"key": "C"}']
+
+
+def test_csv_quoted_field_spans_lines():
+    data = b'key,email,note\nK1,a@example.com,"linha 1\nlinha 2"\nK2,b@example.com,x\n'
+    records = asyncio.run(_records([data[:20], data[20:]], 'csv'))
+    assert records == ['key,email,note', 'K1,a@example.com,"linha 1\nlinha 2"', 'K2,b@example.com,x']
+
+
+def test_overlong_line_is_rejected(monkeypatch):
+    import key_io
+    monkeypatch.setattr(key_io, 'IMPORT_MAX_LINE_BYTES', 10)
+    with pytest.raises(ValueError):
+        asyncio.run(_records([b'x' * 50], 'ndjson'))
+
+
+def test_unclosed_quote_cannot_grow_a_record_past_the_cap(monkeypatch):
+    import key_io
+    monkeypatch.setattr(key_io, 'IMPORT_MAX_LINE_BYTES', 64)
+    data = b'key,email\nK1,"aberta\n' + b'curta\n' * 40
+    with pytest.raises(ValueError, match='registro'):
+        asyncio.run(_records([data[i:i + 8] for i in range(0, len(data), 8)], 'csv'))
+
+
+def test_import_invalidates_cached_plans(api, monkeypatch):
+    monkeypatch.setitem(validation._plan_cache, 'IMPO-0000-0000-0001', ('free', float('inf')))
+    monkeypatch.setitem(validation.key_snapshot.states, 'IMPO-0000-0000-0001', {'status': 'revoked', 'expires_at': None})
+    body = json.dumps({'key': 'IMPO-0000-0000-0001', 'email': 'i@example.com', 'status': 'active'}) + '\n'
+    r = api.post('/api/admin/keys/import?format=ndjson', content=body,
+                 headers={'authorization': 'Bearer test-admin-key', 'content-type': 'application/x-ndjson'})
+    assert r.status_code == 200
+    assert json.loads(r.text.splitlines()[-1])['upserted'] == 1
+    assert 'IMPO-0000-0000-0001' not in validation._plan_cache
+    assert 'IMPO-0000-0000-0001' not in validation.key_snapshot.states
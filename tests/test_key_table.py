@@ -0,0 +1,39 @@
+from datetime import datetime
+
+from key_table import KeyTable, _decode_key_state, _encode_key_state
+
+
+def _table(tmp_path, rows, extra=None):
+    table = KeyTable(str(tmp_path))
+    encoded = [(k.encode(), *_encode_key_state(doc)) for k, doc in rows.items()]
+    table._install(*table._arrays([e[0] for e in encoded], [e[1] for e in encoded], [e[2] for e in encoded]),
+                   {k: _encode_key_state(doc) for k, doc in (extra or {}).items()})
+    return table
+
+
+def test_state_round_trip():
+    exp = datetime(2031, 2, 3, 4, 5, 6)
+    assert _decode_key_state(*_encode_key_state({'status': 'active', 'expires_at': exp})) == {'status': 'active', 'expires_at': exp}
+    assert _decode_key_state(*_encode_key_state({'status': 'revoked', 'expires_at': '2031-02-03T04:05:06'}))['expires_at'] == exp
+    assert _decode_key_state(*_encode_key_state({'status': 'weird'})) == {'status': 'unknown', 'expires_at': None}
+
+
+def test_lookup_finds_sorted_keys_and_misses_cleanly(tmp_path):
+    rows = {f'K{i:03d}-AAAA-BBBB-CCCC': {'status': 'active' if i % 2 else 'revoked'} for i in range(50, 0, -1)}
+    table = _table(tmp_path, rows)
+    assert table._lookup('K007-AAAA-BBBB-CCCC') == (0, 0)
+    assert table._lookup('K010-AAAA-BBBB-CCCC') == (1, 0)
+    assert table._lookup('K000-AAAA-BBBB-CCCC') is None
+    assert table._lookup('ZZZZ-ZZZZ-ZZZZ-ZZZZ') is None  # depois da última
+    assert table._lookup('K007-AAAA-BBBB-CCC') is None  # prefixo de uma existente
+    assert table._lookup('ÇÇÇÇ') is None
+
+
+def test_long_keys_live_in_extra_and_overlay_wins(tmp_path):
+    long_key = 'LEGACY-' + 'X' * 30
+    table = _table(tmp_path, {'AAAA-BBBB-CCCC-DDDD': {'status': 'active'}}, {long_key: {'status': 'expired'}})
+    assert table._lookup(long_key) == (2, 0)
+    table.overlay['AAAA-BBBB-CCCC-DDDD'] = (1, 0, 1)
+    assert table.get('AAAA-BBBB-CCCC-DDDD')['status'] == 'revoked'
+    assert table.get('NADA-NADA-NADA-NADA') is None
+    assert (table.hits, table.misses) == (1, 1)
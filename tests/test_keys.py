@@ -0,0 +1,145 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+import keys
+from keys import KeyReservoir, PremiumKey, _issue_key_pipeline, _stored_expiry
+
+
+def test_stored_expiry_reads_dates_and_legacy_strings():
+    d = datetime(2030, 5, 1, 12, 0)
+    assert _stored_expiry(d) == d
+    assert _stored_expiry('2030-05-01T12:00:00') == d
+    assert _stored_expiry('2030-05-01T09:00:00-03:00') == d
+    assert _stored_expiry('2030-05-01T12:00:00Z') == d
+    assert _stored_expiry('não é data') is None
+    assert _stored_expiry(None) is None
+    assert _stored_expiry(0) is None
+
+
+def test_pipeline_writes_client_values_as_literals():
+    now = datetime(2030, 1, 1)
+    pk = PremiumKey(key='NEWK-0000-0000-0001', email='a@example.com', product_code='$where', expires_at=now)
+    [stage] = _issue_key_pipeline(pk, now)
+    fields = stage['$set']
+    assert 'email' not in fields and 'status' not in fields
+    cond = fields['product_code']['$cond']
+    assert cond[1] == {'$literal': '$where'} and cond[2] == '$product_code'
+    assert fields['key']['$cond'][1] == {'$literal': 'NEWK-0000-0000-0001'}
+
+
+class FakeKeys:
+    # premium_keys de um documento só: devolve o "antes" que o servidor devolveria
+    def __init__(self, before):
+        self.before = before
+        self.calls = 0
+
+    async def find_one_and_update(self, *_args, **_kwargs):
+        self.calls += 1
+        return self.before
+
+
+@pytest.fixture
+def issue(monkeypatch):
+    reservoir = KeyReservoir(size=10, low_water=0)
+    reservoir.ready.extend(['CAND-0000-0000-0001', 'CAND-0000-0000-0002'])
+    monkeypatch.setattr(keys, 'key_reservoir', reservoir)
+    monkeypatch.setattr(keys, 'note_write', lambda *_: None)
+
+    async def run(before):
+        monkeypatch.setattr(keys, 'db', SimpleNamespace(premium_keys=FakeKeys(before)))
+        return await keys.issue_premium_key('a@example.com', 30), reservoir
+    return run
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('expires_at', [None, 'sem data', (datetime.utcnow() + timedelta(days=3)).isoformat()])
+async def test_active_key_without_past_expiry_is_reused(issue, expires_at):
+    (key, _), reservoir = await issue({'key': 'OLDK-0000-0000-0001', 'expires_at': expires_at})
+    assert key == 'OLDK-0000-0000-0001'
+    assert list(reservoir.ready)[0] == 'CAND-0000-0000-0001'  # candidata devolvida
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('expires_at', [datetime(2001, 1, 1), '2001-01-01T00:00:00'])
+async def test_past_expiry_rotates(issue, expires_at):
+    (key, exp), reservoir = await issue({'key': 'OLDK-0000-0000-0001', 'expires_at': expires_at})
+    assert key == 'CAND-0000-0000-0001' and exp > datetime.utcnow()
+    assert reservoir.used == ['CAND-0000-0000-0001']
+
+
+@pytest.mark.anyio
+async def test_first_key_for_email_is_inserted(issue):
+    (key, _), reservoir = await issue(None)
+    assert key == 'CAND-0000-0000-0001' and reservoir.used == [key]
+
+
+class RacingKeys:
+    # Primeira chamada falha com o erro dado; a segunda devolve o "antes" informado
+    def __init__(self, error, before):
+        self.error = error
+        self.before = before
+
+    async def find_one_and_update(self, *_args, **_kwargs):
+        if self.error:
+            error, self.error = self.error, None
+            raise error
+        return self.before
+
+
+def _dup(index, pattern):
+    from pymongo.errors import DuplicateKeyError
+    return DuplicateKeyError(f'E11000 duplicate key error collection: test.premium_keys index: {index}', 11000,
+                             {'keyPattern': pattern, 'errmsg': f'E11000 index: {index}'})
+
+
+@pytest.mark.anyio
+async def test_email_race_gives_candidate_back(issue, monkeypatch):
+    (_, reservoir) = await issue(None)
+    reservoir.ready.extend(['CAND-0000-0000-0003'])
+    reservoir.used.clear()
+    monkeypatch.setattr(keys, 'db', SimpleNamespace(premium_keys=RacingKeys(
+        _dup('email_active_unique', {'email': 1}), {'key': 'WINR-0000-0000-0001', 'expires_at': None})))
+    key, _ = await keys.issue_premium_key('a@example.com', 30)
+    assert key == 'WINR-0000-0000-0001'
+    assert list(reservoir.ready)[0] == 'CAND-0000-0000-0002' and reservoir.used == []
+
+
+@pytest.mark.anyio
+async def test_key_collision_discards_candidate(issue, monkeypatch):
+    (_, reservoir) = await issue(None)  # consome CAND-...-0001
+    reservoir.ready.extend(['CAND-0000-0000-0003'])
+    reservoir.used.clear()
+    monkeypatch.setattr(keys, 'db', SimpleNamespace(premium_keys=RacingKeys(_dup('key_1', {'key': 1}), None)))
+    key, _ = await keys.issue_premium_key('a@example.com', 30)
+    assert key == 'CAND-0000-0000-0003'
+    assert 'CAND-0000-0000-0002' not in reservoir.ready
+    assert reservoir.used == ['CAND-0000-0000-0002', 'CAND-0000-0000-0003'] and reservoir.collisions == 1
+
+
+@pytest.mark.anyio
+async def test_empty_reservoir_is_a_503(monkeypatch):
+    from fastapi import HTTPException
+    reservoir = KeyReservoir(size=0, low_water=0)
+
+    async def nothing():
+        return None
+    monkeypatch.setattr(reservoir, 'refill', nothing)
+    with pytest.raises(HTTPException) as exc:
+        await reservoir.take()
+    assert exc.value.status_code == 503 and reservoir.empty_takes == 1
+
+
+@pytest.mark.anyio
+async def test_refund_lookups_are_indexed(mongo):
+    await keys.ensure_premium_key_indexes()
+    indexed = {tuple(k for k, _ in spec['key']) for spec in (await mongo.premium_keys.index_information()).values()}
+    assert ('order_id',) in indexed and ('renewals.order',) in indexed
+
+
+@pytest.mark.anyio
+async def test_key_table_poll_is_indexed(mongo):
+    await keys.ensure_premium_key_indexes()
+    indexed = {tuple(k for k, _ in spec['key']) for spec in (await mongo.premium_keys.index_information()).values()}
+    assert ('updated_at',) in indexed
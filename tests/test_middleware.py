@@ -0,0 +1,117 @@
+import pytest
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+
+from middleware import IdempotencyMiddleware
+
+AUTH = {'authorization': 'Bearer test-admin-key'}
+
+
+@pytest.fixture
+def idem(mongo):
+    app = FastAPI()
+    calls = []
+
+    @app.post('/api/admin/thing')
+    async def thing(body: dict):
+        calls.append(body)
+        if body.get('fail'):
+            raise HTTPException(status_code=500, detail='falhou')
+        return {'n': len(calls)}
+
+    app.add_middleware(IdempotencyMiddleware)
+    with TestClient(app) as client:
+        yield client, calls
+
+
+def test_duplicate_request_replays_stored_response(idem, mongo):
+    client, calls = idem
+    headers = {**AUTH, 'idempotency-key': 'abc'}
+    first = client.post('/api/admin/thing', json={'x': 1}, headers=headers)
+    second = client.post('/api/admin/thing', json={'x': 1}, headers=headers)
+    assert first.json() == second.json() == {'n': 1}
+    assert second.headers['idempotent-replayed'] == 'true'
+    assert len(calls) == 1
+    doc = client.portal.call(mongo.idempotency_keys.find_one, {})
+    assert doc['status'] == 'completed' and doc['code'] == 200
+
+
+def test_same_key_with_other_body_is_rejected(idem):
+    client, calls = idem
+    headers = {**AUTH, 'idempotency-key': 'abc'}
+    client.post('/api/admin/thing', json={'x': 1}, headers=headers)
+    r = client.post('/api/admin/thing', json={'x': 2}, headers=headers)
+    assert r.status_code == 422 and len(calls) == 1
+
+
+def test_keys_are_scoped_per_credential_and_optional(idem):
+    client, calls = idem
+    client.post('/api/admin/thing', json={}, headers={**AUTH, 'idempotency-key': 'k'})
+    client.post('/api/admin/thing', json={}, headers={'authorization': 'Bearer outro', 'idempotency-key': 'k'})
+    client.post('/api/admin/thing', json={}, headers=AUTH)
+    client.post('/api/admin/thing', json={}, headers=AUTH)
+    assert len(calls) == 4
+
+
+def test_server_error_releases_the_key_for_retry(idem, mongo):
+    client, calls = idem
+    headers = {**AUTH, 'idempotency-key': 'retry'}
+    assert client.post('/api/admin/thing', json={'fail': True}, headers=headers).status_code == 500
+    assert client.portal.call(mongo.idempotency_keys.count_documents, {}) == 0
+    assert client.post('/api/admin/thing', json={'fail': True}, headers=headers).status_code == 500
+    assert len(calls) == 2
+
+
+def test_expired_placeholder_is_taken_over_by_the_retry(idem, mongo):
+    import hashlib
+    from datetime import datetime, timedelta
+    client, calls = idem
+    # Placeholder de um worker que morreu executando a mesma chave
+    owner = hashlib.sha256(AUTH['authorization'].encode()).hexdigest()[:16]
+    stale = {'_id': f'{owner}:dead', 'status': 'in_progress', 'fingerprint': 'x', 'created_at': datetime.utcnow(),
+             'locked_until': datetime.utcnow() - timedelta(seconds=1), 'lease': 'worker-morto'}
+    client.portal.call(mongo.idempotency_keys.insert_one, stale)
+    r = client.post('/api/admin/thing', json={'x': 2}, headers={**AUTH, 'idempotency-key': 'dead'})
+    assert r.status_code == 200 and len(calls) == 1
+    doc = client.portal.call(mongo.idempotency_keys.find_one, {})
+    assert doc['status'] == 'completed' and doc['lease'] != 'worker-morto'
+
+
+def test_unauthenticated_request_reserves_nothing(idem, mongo):
+    client, calls = idem
+    client.post('/api/admin/thing', json={}, headers={'authorization': 'Bearer outro', 'idempotency-key': 'k'})
+    assert client.portal.call(mongo.idempotency_keys.count_documents, {}) == 0
+    assert len(calls) == 1
+
+
+def test_body_over_the_cap_without_content_length_passes_through(idem, mongo, monkeypatch):
+    import middleware
+    monkeypatch.setattr(middleware, 'IDEMPOTENCY_MAX_BODY_BYTES', 16)
+    client, calls = idem
+
+    def chunks():
+        yield b'{"pad": "'
+        yield b'x' * 32
+        yield b'"}'
+    headers = {**AUTH, 'idempotency-key': 'big', 'content-type': 'application/json'}
+    for _ in range(2):
+        assert client.post('/api/admin/thing', content=chunks(), headers=headers).status_code == 200
+    assert len(calls) == 2 and calls[0] == {'pad': 'x' * 32}
+    assert client.portal.call(mongo.idempotency_keys.count_documents, {}) == 0
+
+
+@pytest.mark.parametrize('header,expected', [
+    ('br;q=0, gzip', 'gzip'),
+    ('gzip;q=0', None),
+    ('gzip, br', 'br'),
+    ('br;q=0.5, gzip;q=0.8', 'gzip'),
+    ('*', 'br'),
+    ('*;q=0, gzip', 'gzip'),
+    ('identity', None),
+    ('', None),
+])
+def test_accepted_encoding_honours_q_values(header, expected, monkeypatch):
+    import middleware
+    monkeypatch.setattr(middleware, 'brotli', object())
+    scope = {'headers': [(b'accept-encoding', header.encode())]}
+    assert middleware._accepted_encoding(scope) == expected
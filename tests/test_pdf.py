@@ -0,0 +1,95 @@
+import io
+import os
+
+import httpx
+import pytest
+from fastapi import HTTPException
+from pypdf import PdfWriter
+from starlette.requests import Request
+
+import pdf
+
+
+def _pdf_bytes(pages=2):
+    writer = PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(width=72, height=72)
+    buf = io.BytesIO()
+    writer.write(buf)
+    return buf.getvalue()
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize('url', [
+    'http://127.0.0.1/x.pdf',
+    'http://localhost/x.pdf',
+    'http://10.0.0.5/x.pdf',
+    'http://169.254.169.254/latest/meta-data',
+    'http://[::1]/x.pdf',
+    'http://[::ffff:127.0.0.1]/x.pdf',
+    'file:///etc/passwd',
+    'ftp://93.184.216.34/x.pdf',
+])
+async def test_private_and_non_http_urls_rejected(url):
+    with pytest.raises(HTTPException) as exc:
+        await pdf._check_public_url(url)
+    assert exc.value.status_code == 400
+
+
+@pytest.mark.anyio
+async def test_redirect_to_private_address_rejected(http_mock):
+    http_mock['http://93.184.216.34/doc.pdf'] = lambda: httpx.Response(302, headers={'location': 'http://169.254.169.254/latest/'})
+    with pytest.raises(HTTPException) as exc:
+        await pdf._download_pdf('http://93.184.216.34/doc.pdf', io.BytesIO())
+    assert exc.value.status_code == 400
+
+
+@pytest.mark.anyio
+async def test_relative_redirect_followed(http_mock):
+    body = _pdf_bytes()
+    http_mock['http://93.184.216.34/a'] = lambda: httpx.Response(301, headers={'location': '/b.pdf'})
+    http_mock['http://93.184.216.34/b.pdf'] = lambda: httpx.Response(200, content=body)
+    dest = io.BytesIO()
+    await pdf._download_pdf('http://93.184.216.34/a', dest)
+    assert dest.getvalue() == body
+
+
+@pytest.mark.anyio
+async def test_redirect_loop_stops(http_mock):
+    http_mock['http://93.184.216.34/loop'] = lambda: httpx.Response(302, headers={'location': '/loop'})
+    with pytest.raises(HTTPException) as exc:
+        await pdf._download_pdf('http://93.184.216.34/loop', io.BytesIO())
+    assert exc.value.status_code == 502
+
+
+@pytest.mark.anyio
+async def test_upstream_status_not_leaked(http_mock):
+    http_mock['http://93.184.216.34/missing.pdf'] = lambda: httpx.Response(404)
+    with pytest.raises(HTTPException) as exc:
+        await pdf._download_pdf('http://93.184.216.34/missing.pdf', io.BytesIO())
+    assert exc.value.status_code == 502
+    assert '404' not in exc.value.detail
+
+
+@pytest.mark.anyio
+async def test_temp_file_removed_when_stream_never_iterated(mongo):
+    body = _pdf_bytes()
+    sent = {'done': False}
+
+    async def receive():
+        if sent['done']:
+            return {'type': 'http.disconnect'}
+        sent['done'] = True
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    request = Request({'type': 'http', 'method': 'POST', 'path': '/api/pdf/extract',
+                       'headers': [(b'content-type', b'application/pdf')]}, receive)
+    try:
+        response = await pdf.extract_pdf_text(request)
+        path = response.background.args[0]
+        assert os.path.exists(path)
+        # Cliente sumiu antes do primeiro byte: só a background task roda
+        await response.background()
+        assert not os.path.exists(path)
+    finally:
+        pdf.shutdown_pdf_pool()
@@ -0,0 +1,28 @@
+from types import SimpleNamespace
+
+import pytest
+
+import plan_stats as plan_stats_module
+from plan_stats import PlanStats
+
+
+class GrowingKeys:
+    # premium_keys cuja agregação vê uma ativa; uma criação chega no meio da leitura
+    def __init__(self, stats):
+        self.stats = stats
+
+    async def aggregate(self, _pipeline):
+        self.stats.track({'product_code': 'pro', 'expires_at': None}, 'active', 1)
+        yield {'_id': {'status': 'active', 'product': 'pro', 'day': None}, 'n': 1}
+
+
+@pytest.mark.anyio
+async def test_reconcile_keeps_deltas_tracked_during_the_aggregation(mongo, monkeypatch):
+    stats = PlanStats()
+    monkeypatch.setattr(plan_stats_module, 'db', SimpleNamespace(premium_keys=GrowingKeys(stats), plan_stats=mongo.plan_stats))
+    stats.track({'product_code': 'pro', 'expires_at': None}, 'active', 1)
+    await stats.reconcile()
+    assert stats.pending == {'status.active': 1, 'products.pro.active': 1, 'expiry_days.none': 1}
+    await stats.flush()
+    doc = await mongo.plan_stats.find_one({'_id': plan_stats_module.PLAN_STATS_DOC_ID})
+    assert doc['status'] == {'active': 2}
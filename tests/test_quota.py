@@ -0,0 +1,42 @@
+import pytest
+
+from quota import QuotaLedger, _device_day
+
+
+@pytest.mark.anyio
+async def test_consume_until_limit_then_refuse(mongo):
+    ledger = QuotaLedger(3, 60)
+    results = [await ledger.consume('device-0001') for _ in range(4)]
+    assert [r.allowed for r in results] == [True, True, True, False]
+    assert results[2].remaining == 0 and results[3].count == 3
+    assert 'Limite diário' in results[3].error
+
+
+@pytest.mark.anyio
+async def test_refund_gives_the_slot_back(mongo):
+    ledger = QuotaLedger(1, 60)
+    first = await ledger.consume('device-0001')
+    ledger.refund('device-0001', first.day)
+    assert (await ledger.consume('device-0001')).allowed
+
+
+@pytest.mark.anyio
+async def test_flush_writes_increments_and_merges_other_workers(mongo):
+    a, b = QuotaLedger(10, 60), QuotaLedger(10, 60)
+    for _ in range(2):
+        await a.consume('device-0001')
+    await b.consume('device-0001')
+    await a.flush()
+    await b.flush()
+    doc_id = f"{_device_day(0)}:device-0001"
+    assert (await mongo.quota_daily.find_one({'_id': doc_id}))['count'] == 3
+    # b viu a escrita de a ao ressincronizar
+    assert (await b.peek('device-0001')).count == 3
+
+
+@pytest.mark.anyio
+async def test_counts_are_per_local_day(mongo):
+    ledger = QuotaLedger(1, 60)
+    assert (await ledger.consume('device-0001', -14 * 60)).allowed
+    # Fuso a 28h de distância cai em outro dia: cota independente
+    assert (await ledger.consume('device-0001', 14 * 60)).allowed
@@ -0,0 +1,17 @@
+import pytest
+
+import core
+import server
+
+
+@pytest.mark.anyio
+async def test_shutdown_runs_every_step_after_a_failure(mongo, monkeypatch):
+    closed = []
+
+    async def broken_stop():
+        raise RuntimeError('flush falhou')
+    monkeypatch.setattr(server.quota_ledger, 'stop', broken_stop)
+    monkeypatch.setattr(server, 'shutdown_pdf_pool', lambda: closed.append('pdf'))
+    monkeypatch.setattr(core, 'close_client', lambda: closed.append('mongo'))
+    await server.shutdown_db_client()
+    assert closed == ['pdf', 'mongo']
@@ -0,0 +1,156 @@
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+import summarize
+from summarize import NearDuplicateIndex, simhash_signature
+
+
+def _article(seed, n=400):
+    rnd = random.Random(seed)
+    words = [f'palavra{i}' for i in range(3000)]
+    return ' '.join(rnd.choice(words) for _ in range(n))
+
+
+def _similarity(a, b):
+    return 1 - bin(a ^ b).count('1') / 64
+
+
+def test_simhash_is_stable_and_64_bits():
+    text = _article(1)
+    assert simhash_signature(text) == simhash_signature(text)
+    assert 0 <= simhash_signature(text) < 1 << 64
+    assert simhash_signature('') == 0
+
+
+def test_simhash_close_for_small_edits_far_for_different_texts():
+    base = _article(1)
+    edited = base.replace('palavra1 ', 'palavra2 ', 3) + ' atualizado 12:45 comentários 31'
+    assert _similarity(simhash_signature(base), simhash_signature(edited)) >= 0.9
+    assert _similarity(simhash_signature(base), simhash_signature(_article(2))) < 0.8
+
+
+def test_index_finds_near_match_only_within_scope():
+    index = NearDuplicateIndex(0.92, 100)
+    sig = simhash_signature(_article(1))
+    index.add('a', 'scope1', sig)
+    best, sim = index.best_match('scope1', sig ^ 0b101)  # 2 bits diferentes
+    assert best == 'a' and sim == pytest.approx(62 / 64)
+    assert index.best_match('scope2', sig) == (None, 0.0)
+
+
+def test_index_evicts_oldest_and_cleans_buckets():
+    index = NearDuplicateIndex(0.92, 2)
+    for i, name in enumerate('abc'):
+        index.add(name, 's', simhash_signature(_article(i)))
+    assert list(index.entries) == ['b', 'c']
+    assert all('a' not in ids for ids in index.buckets.values())
+    index.remove('b')
+    index.remove('c')
+    assert index.buckets == {}
+
+
+@pytest.mark.anyio
+async def test_sync_pulls_entries_written_by_other_processes(mongo):
+    index = NearDuplicateIndex(0.92, 100)
+    now = datetime.utcnow().replace(microsecond=0)  # Mongo guarda milissegundos
+    await mongo.summary_cache.insert_one({'_id': 'old', 'scope': 's', 'simhash': 1, 'created_at': now - timedelta(minutes=5)})
+    await index.sync()
+    assert list(index.entries) == ['old'] and index.last_seen == now - timedelta(minutes=5)
+    # Outro processo grava depois da carga inicial
+    sig = simhash_signature(_article(3))
+    await mongo.summary_cache.insert_one({'_id': 'new', 'scope': 's', 'simhash': summarize._to_int64(sig), 'created_at': now})
+    await index.sync()
+    assert list(index.entries) == ['old', 'new']
+    assert index.entries['new'] == ('s', sig)
+    assert index.last_seen == now
+    # Passada sem novidades não duplica nem reordena
+    await index.sync()
+    assert list(index.entries) == ['old', 'new']
+
+
+@pytest.fixture
+def summarize_api(api, http_mock):
+    import quota
+    import upstream
+    http_mock[upstream.OR_URL] = lambda: __import__('httpx').Response(200, json={'choices': [{'message': {'content': 'Resumo.'}}]})
+    quota.quota_ledger.counts.clear()
+    quota.quota_ledger.pending.clear()
+    return api
+
+
+def test_free_caller_without_device_id_is_rejected(summarize_api):
+    r = summarize_api.post('/api/summarize', json={'text': 'x' * 200})
+    assert r.status_code == 400
+
+
+@pytest.mark.parametrize('device_id', ['short', 'd' * 129])
+def test_device_id_length_validated(summarize_api, device_id):
+    r = summarize_api.post('/api/summarize', json={'text': 'x' * 200, 'device_id': device_id})
+    assert r.status_code == 422
+
+
+def test_free_caller_consumes_quota(summarize_api, monkeypatch):
+    import quota
+    monkeypatch.setattr(quota.quota_ledger, 'limit', 1)
+    body = {'text': 'Um texto qualquer com conteúdo suficiente para o resumo. ' * 4, 'device_id': 'device-0001'}
+    assert summarize_api.post('/api/summarize', json=body).status_code == 200
+    assert summarize_api.post('/api/summarize', json={**body, 'text': body['text'] + ' Outro.'}).status_code == 429
+
+
+def test_premium_caller_needs_no_device_id(summarize_api, mongo):
+    from datetime import datetime, timedelta
+    summarize_api.portal.call(mongo.premium_keys.insert_one, {
+        'key': 'PREM-0000-0000-0001', 'email': 'p@example.com', 'status': 'active',
+        'expires_at': datetime.utcnow() + timedelta(days=3)})
+    r = summarize_api.post('/api/summarize', json={'text': 'y' * 200, 'key': 'PREM-0000-0000-0001'})
+    assert r.status_code == 200
+
+
+def test_cache_is_keyed_by_raw_text_and_checked_before_compaction(summarize_api, monkeypatch, mongo):
+    summarize_api.portal.call(mongo.premium_keys.insert_one, {
+        'key': 'PREM-0000-0000-0002', 'email': 'c@example.com', 'status': 'active',
+        'expires_at': datetime.utcnow() + timedelta(days=3)})
+    body = {'text': 'Um artigo com conteúdo suficiente para gerar um resumo. ' * 4, 'key': 'PREM-0000-0000-0002'}
+    first = summarize_api.post('/api/summarize', json=body)
+    assert first.status_code == 200 and first.json()['compaction'] is not None
+
+    def fail(*_args):
+        raise AssertionError('compactação não deveria rodar num acerto de cache')
+
+    monkeypatch.setattr(summarize, 'compact_input', fail)
+    second = summarize_api.post('/api/summarize', json=body)
+    assert second.status_code == 200
+    assert second.json()['cache'] == 'exact'
+
+
+def test_parse_outline_items_subitems_and_expansions_cutoff():
+    text = ('Título\n1. Primeiro item\n- sub a\n• sub b\n2) Segundo item\n'
+            '- sub c\n- órfão não\nEXPANSÕES:\n3. Ignorado\n- também ignorado')
+    assert summarize.parse_outline(text) == [('Primeiro item', ['sub a', 'sub b']), ('Segundo item', ['sub c', 'órfão não'])]
+    assert summarize.parse_outline('- sem item antes\ntexto solto') == []
+
+
+@pytest.mark.anyio
+async def test_deep_mapreduce_expands_against_the_source(monkeypatch):
+    source = 'Parágrafo da fonte original com números: 42 casos.\n\n' * 3
+    seen = []
+
+    async def fake_map(kind, pieces, *_args):
+        return [f'parcial {i}' for i in range(len(pieces))]
+
+    async def fake_or(messages, *_args):
+        return {'text': '1. Item\n- sub', 'model': 'm'}
+
+    async def fake_expand(item, sub, src, *_args):
+        seen.append(src)
+        return 'expansão'
+
+    monkeypatch.setattr(summarize, '_map_chunks', fake_map)
+    monkeypatch.setattr(summarize, 'or_with_fallback', fake_or)
+    monkeypatch.setattr(summarize, '_expand_subitem', fake_expand)
+    req = summarize.SummarizeRequest(text=source, mode='mapreduce', settings={'detail_level': 'profundo'})
+    result = await summarize.summarize_document(req, 'k')
+    assert result.mode == 'mapreduce'
+    assert seen == [source]
@@ -0,0 +1,49 @@
+import random
+
+from text_utils import estimate_tokens, split_into_chunks
+
+
+def _paragraphs(n, seed=1):
+    rnd = random.Random(seed)
+    words = ['alpha', 'beta', 'gamma', 'delta', 'epsilon', 'zeta', 'eta', 'theta']
+    out = []
+    for _ in range(n):
+        sentences = [' '.join(rnd.choice(words) for _ in range(rnd.randint(4, 20))).capitalize() + '.'
+                     for _ in range(rnd.randint(1, 6))]
+        out.append(' '.join(sentences))
+    return '\n\n'.join(out)
+
+
+def test_short_text_is_single_chunk():
+    assert split_into_chunks('Uma frase.\n\nOutra frase.', 100) == ['Uma frase.\n\nOutra frase.']
+
+
+def test_chunks_respect_budget_including_separators():
+    # Muitos parágrafos pequenos: o separador e o arredondamento pesam no total
+    text = '\n\n'.join(['abcd'] * 5000)
+    chunks = split_into_chunks(text, 600)
+    assert len(chunks) > 1
+    assert max(estimate_tokens(c) for c in chunks) <= 600
+
+
+def test_chunks_respect_budget_on_mixed_text():
+    text = _paragraphs(2000)
+    for budget in (50, 300, 6000):
+        chunks = split_into_chunks(text, budget)
+        assert max(estimate_tokens(c) for c in chunks) <= budget
+
+
+def test_long_paragraph_split_by_sentence_and_giant_sentence_cut():
+    para = ' '.join(['Frase número %d com algum texto.' % i for i in range(200)])
+    giant = 'x' * 5000
+    chunks = split_into_chunks(f'{para}\n\n{giant}', 100)
+    assert all(estimate_tokens(c) <= 100 for c in chunks)
+    # Nenhum conteúdo perdido (só separadores mudam)
+    assert ''.join(c.replace(' ', '').replace('\n', '') for c in chunks) == (para + giant).replace(' ', '')
+
+
+def test_paragraph_order_preserved():
+    paras = [f'Parágrafo {i}.' for i in range(300)]
+    chunks = split_into_chunks('\n\n'.join(paras), 40)
+    rejoined = '\n\n'.join(chunks).split('\n\n')
+    assert rejoined == paras
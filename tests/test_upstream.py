@@ -0,0 +1,124 @@
+import asyncio
+
+import pytest
+
+from upstream import UpstreamError, UpstreamScheduler
+
+
+def _scheduler(global_cap=1, model_cap=1, max_queue=10, deadline=5.0):
+    s = UpstreamScheduler(global_cap, model_cap, {'premium': 3, 'free': 1}, max_queue, deadline)
+    s.avg_service = 0.01  # a estimativa de espera não rejeita na entrada
+    return s
+
+
+@pytest.mark.anyio
+async def test_idle_scheduler_grants_immediately_and_releases():
+    s = _scheduler()
+    async with s.slot('m', 'free'):
+        assert s.active == 1 and s.active_by_model == {'m': 1}
+    assert s.active == 0 and s.active_by_model == {}
+
+
+@pytest.mark.anyio
+async def test_weighted_round_robin_favours_premium():
+    s = _scheduler()
+    await s.acquire('m', 'free')  # ocupa a única vaga
+    order = []
+
+    async def client(plan):
+        await s.acquire('m', plan)
+        order.append(plan)
+        s._release('m', 0.0)
+
+    tasks = [asyncio.create_task(client(p)) for p in ['free'] * 4 + ['premium'] * 4]
+    await asyncio.sleep(0)
+    s._release('m', 0.0)
+    await asyncio.gather(*tasks)
+    assert order[:4] == ['premium', 'premium', 'free', 'premium']
+    assert sorted(order) == sorted(['free'] * 4 + ['premium'] * 4)
+
+
+@pytest.mark.anyio
+async def test_saturated_model_does_not_block_other_models():
+    s = _scheduler(global_cap=2, model_cap=1)
+    await s.acquire('a', 'free')
+    waiting_a = asyncio.create_task(s.acquire('a', 'free'))
+    await asyncio.sleep(0)
+    await asyncio.wait_for(s.acquire('b', 'free'), 1)  # passa na frente de quem espera 'a'
+    assert s.active_by_model == {'a': 1, 'b': 1}
+    s._release('a', None)
+    await asyncio.wait_for(waiting_a, 1)
+
+
+@pytest.mark.anyio
+async def test_full_queue_rejects_with_retry_after():
+    s = _scheduler(max_queue=1)
+    await s.acquire('m', 'free')
+    waiter = asyncio.create_task(s.acquire('m', 'free'))
+    await asyncio.sleep(0)
+    with pytest.raises(UpstreamError) as exc:
+        await s.acquire('m', 'free')
+    assert exc.value.status == 429 and exc.value.retry_after >= 1
+    assert s.rejected['free'] == 1
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    assert not s.queues['free']
+
+
+@pytest.mark.anyio
+async def test_queue_deadline_expires_waiter():
+    s = _scheduler(deadline=0.05)
+    await s.acquire('m', 'free')
+    with pytest.raises(UpstreamError) as exc:
+        await s.acquire('m', 'free')
+    assert exc.value.status == 503
+    assert s.expired['free'] == 1 and not s.queues['free']
+
+
+@pytest.mark.anyio
+async def test_scheduler_rejection_skips_model_fallback(monkeypatch, http_mock):
+    import upstream
+    s = _scheduler(max_queue=0)
+    monkeypatch.setattr(upstream, 'upstream_scheduler', s)
+    monkeypatch.setattr(upstream, 'upstream_cooldowns', upstream.UpstreamCooldowns())
+    for model in [upstream.PRIMARY_MODEL, *upstream.FALLBACK_MODELS]:
+        s.active_by_model[model] = s.model_cap  # todas as vagas ocupadas
+    s.active = s.global_cap
+    with pytest.raises(upstream.SchedulerRejected) as exc:
+        await upstream.or_with_fallback([{'role': 'user', 'content': 'oi'}], 10, 'k')
+    assert exc.value.status == 429 and exc.value.retry_after >= 1
+    assert s.rejected['free'] == 1
+
+
+def test_key_quota_429_cools_only_that_key_on_that_model():
+    from upstream import UpstreamCooldowns
+    c = UpstreamCooldowns()
+    c.record('m', 'user-key', 429, 600, 'Rate limit exceeded: free-models-per-day')
+    assert c.model_remaining('m', 'user-key') > 0
+    assert c.model_remaining('m', 'other-key') == 0
+    assert c.key_remaining('user-key') > 0 and c.key_remaining('other-key') == 0
+    c.record('n', 'user-key', 429, None, 'Too Many Requests')
+    assert c.model_remaining('n', 'user-key') > 0 and c.model_remaining('n', 'other-key') == 0
+
+
+def test_model_wide_limits_cool_the_model_for_everyone():
+    from upstream import UpstreamCooldowns
+    c = UpstreamCooldowns()
+    c.record('m', 'a', 429, 30, 'm is temporarily rate-limited upstream')
+    c.record('n', 'a', 503, 30, 'Service Unavailable')
+    for model in ('m', 'n'):
+        assert c.model_remaining(model, 'b') > 0
+    assert c.min_model_remaining(['m', 'n', 'o'], 'b') == 0
+
+
+@pytest.mark.anyio
+async def test_pair_cooldowns_sync_between_workers(mongo):
+    from datetime import datetime, timedelta
+    from upstream import UpstreamCooldowns, _key_id
+    until = datetime.utcnow() + timedelta(seconds=60)
+    await mongo.upstream_cooldowns.insert_one({'_id': f"pair:deepseek/deepseek-r1:free|{_key_id('a')}", 'until': until})
+    c = UpstreamCooldowns()
+    await c.sync()
+    assert c.model_remaining('deepseek/deepseek-r1:free', 'a') > 0
+    assert c.model_remaining('deepseek/deepseek-r1:free', 'b') == 0
@@ -0,0 +1,17 @@
+import pytest
+
+import validation
+
+
+@pytest.mark.anyio
+async def test_plan_cache_is_bounded_lru(mongo, monkeypatch):
+    monkeypatch.setattr(validation, 'PLAN_CACHE_MAX_ENTRIES', 3)
+    monkeypatch.setattr(validation, '_plan_cache', validation.OrderedDict())
+    for i in range(3):
+        assert await validation.resolve_plan(f'RAND-0000-0000-000{i}') == 'free'
+    await validation.resolve_plan('RAND-0000-0000-0000')  # acerto: vira a mais recente
+    await validation.resolve_plan('RAND-0000-0000-0003')
+    assert list(validation._plan_cache) == ['RAND-0000-0000-0002', 'RAND-0000-0000-0000', 'RAND-0000-0000-0003']
+    for i in range(4, 9):
+        await validation.resolve_plan(f'RAND-0000-0000-000{i}')
+    assert len(validation._plan_cache) == 3
@@ -0,0 +1,83 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import keys
+import webhooks
+from webhooks import parse_webhook_event, _webhook_dedup_key
+
+
+def test_parse_purchase_event_from_buyer_paths():
+    parsed = parse_webhook_event({'event': 'Compra Completa', 'order_id': 'ORD-1', 'data': {'buyer': {'email': 'Ana@Example.com'}}})
+    assert parsed['action'] == 'purchase' and parsed['email'] == 'ana@example.com' and parsed['order_id'] == 'ORD-1'
+    assert _webhook_dedup_key(parsed, b'{}') == 'compra completa:ORD-1'
+
+
+def test_email_outside_buyer_paths_is_ignored():
+    parsed = parse_webhook_event({'event': 'order_paid', 'affiliate': {'email': 'afiliado@example.com'},
+                                  'note': 'suporte: help@example.com'})
+    assert parsed['email'] is None
+
+
+@pytest.fixture
+def renew(mongo, monkeypatch):
+    # A emissão real é um pipeline de update, que o mongomock não roda: aqui ela insere
+    # a KEY quando o e-mail não tem ativa e senão devolve a existente, como no servidor
+    async def fake_issue(email, days, product_code=None, order_id=None, renewal=None):
+        doc = await mongo.premium_keys.find_one({'email': email, 'status': 'active'})
+        if doc:
+            return doc['key'], doc.get('expires_at')
+        exp = datetime.utcnow().replace(microsecond=0) + timedelta(days=days)
+        await mongo.premium_keys.insert_one({'key': 'RENW-0000-0000-0001', 'email': email, 'status': 'active', 'order_id': order_id,
+                                             'expires_at': exp, 'renewals': [{'order': renewal, 'days': days}]})
+        return 'RENW-0000-0000-0001', exp
+    monkeypatch.setattr(keys, 'issue_premium_key', fake_issue)
+    monkeypatch.setattr(keys, 'note_write', lambda *_: None)
+    return mongo
+
+
+async def _insert(mongo, expires_at, renewals=()):
+    await mongo.premium_keys.insert_one({'key': 'RENW-0000-0000-0001', 'email': 'r@example.com', 'status': 'active',
+                                         'expires_at': expires_at, 'renewals': list(renewals)})
+
+
+@pytest.mark.anyio
+async def test_purchase_by_active_holder_extends_once_per_order(renew):
+    start = datetime.utcnow().replace(microsecond=0) + timedelta(days=3)
+    await _insert(renew, start, [{'order': 'ORD-1', 'days': 30}])
+    key, exp = await keys.renew_premium_key('r@example.com', 30, 'ORD-2')
+    assert key == 'RENW-0000-0000-0001' and exp == start + timedelta(days=30)
+    _, again = await keys.renew_premium_key('r@example.com', 30, 'ORD-2')
+    assert again == exp
+    doc = await renew.premium_keys.find_one({'key': key})
+    assert doc['expires_at'] == exp and [r['order'] for r in doc['renewals']] == ['ORD-1', 'ORD-2']
+
+
+@pytest.mark.anyio
+async def test_key_without_expiry_is_not_extended(renew):
+    await _insert(renew, None)
+    _, exp = await keys.renew_premium_key('r@example.com', 30, 'ORD-3')
+    assert exp is None
+    assert (await renew.premium_keys.find_one({}))['expires_at'] is None
+
+
+@pytest.mark.anyio
+async def test_refund_of_a_renewal_rolls_back_only_its_days(renew):
+    from webhooks import webhook_processor
+
+    def event(action, order):
+        return {'_id': f'{action}:{order}', 'action': action, 'email': 'r@example.com', 'order_id': order}
+
+    await webhook_processor._apply(event('purchase', 'ORD-1'))
+    first = (await renew.premium_keys.find_one({}))['expires_at']
+    await webhook_processor._apply(event('purchase', 'ORD-2'))
+    assert (await renew.premium_keys.find_one({}))['expires_at'] == first + timedelta(days=webhooks.WEBHOOK_KEY_DAYS)
+
+    await webhook_processor._apply(event('revoke', 'ORD-2'))
+    await webhook_processor._apply(event('revoke', 'ORD-2'))  # reprocessado: não devolve duas vezes
+    doc = await renew.premium_keys.find_one({})
+    assert doc['status'] == 'active' and doc['expires_at'] == first
+    assert [r['order'] for r in doc['renewals']] == ['ORD-1']
+
+    await webhook_processor._apply(event('revoke', 'ORD-1'))
+    assert (await renew.premium_keys.find_one({}))['status'] == 'revoked'